@@ -0,0 +1,212 @@
+"""Time the polishing workflow on synthetic data and compare against earlier runs
+
+In stub mode minimap2, samtools and Pilon are replaced by the scripts in benchmarks/bin so only the
+workflow's own overhead is measured, in real mode the installed tools are used. Each run is appended
+to a JSON lines history and compared with the last run of the same mode and parameters.
+
+    python benchmarks/run_benchmarks.py --mode stub --genome-size 200000 --depth 30
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from statistics import median
+from typing import Dict, List, Tuple
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARK_DIR), "src"))
+
+from synthetic import make_dataset
+from Workflows import PolishWorkflow, PolishAssembly, MAPPERS
+from resources import ResourceBudget
+
+
+STUB_BIN = os.path.join(BENCHMARK_DIR, "bin")
+DEFAULT_HISTORY = os.path.join(BENCHMARK_DIR, "results", "history.jsonl")
+REAL_TOOLS = ["samtools", "java"]
+PILON_JAR = "/usr/bin/pilon.jar"
+NOISE_FLOOR = 0.05 # seconds, differences smaller than this are never reported as regressions
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARK_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def busy_time(records) -> float:
+    """Seconds in which at least one step was running, overlapping pipeline stages are counted once
+    """
+    intervals = sorted((i.started, i.started + i.wall_time) for i in records if not i.cached)
+    total = 0.0
+    end = None
+    for start, stop in intervals:
+        if end is None or start > end:
+            total += stop - start
+            end = stop
+        elif stop > end:
+            total += stop - end
+            end = stop
+    return total
+
+
+def step_times(records) -> Dict[str, Dict[str, float]]:
+    """Total wall, cpu time and peak memory of each kind of step across every iteration
+    """
+    steps = {}
+    for record in records:
+        step = steps.setdefault(record.step, {"calls": 0, "wall_time": 0.0, "cpu_time": 0.0, "max_rss_kb": 0})
+        step["calls"] += 1
+        step["wall_time"] += record.wall_time
+        step["cpu_time"] += record.user_time + record.system_time
+        step["max_rss_kb"] = max(step["max_rss_kb"], record.max_rss_kb)
+    return steps
+
+
+def run_once(dataset, work_dir: str, params) -> Dict:
+    out_dir = tempfile.mkdtemp(prefix="run_", dir=work_dir)
+    resources = ResourceBudget(threads=params.threads, memory=params.memory, pilon_ram=params.ram)
+    start = time.perf_counter()
+    workflow = PolishWorkflow(contigs=dataset.draft, ram=params.ram, reads=dataset.reads, out_dir=out_dir,
+                              Polisher_=PolishAssembly, Mapper_=MAPPERS[params.mapper], prefix="bench", max_iter=params.max_iter,
+                              resources=resources, shards=params.shards, incremental=params.incremental, target_depth=params.target_depth)
+    total = time.perf_counter() - start
+    records = workflow.report.records
+    busy = busy_time(records)
+    if not params.keep:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return {"total": total, "iterations": workflow.Iteration, "tool_time": busy, "overhead": total - busy,
+            "steps": step_times(records)}
+
+
+def summarise(runs: List[Dict]) -> Dict:
+    """Median of every measurement across repeated runs
+    """
+    steps = {}
+    for name in runs[0]["steps"]:
+        steps[name] = {key: median(run["steps"][name][key] for run in runs if name in run["steps"])
+                       for key in runs[0]["steps"][name]}
+    return {"total": median(i["total"] for i in runs), "tool_time": median(i["tool_time"] for i in runs),
+            "overhead": median(i["overhead"] for i in runs), "iterations": runs[0]["iterations"], "steps": steps}
+
+
+def load_history(history: str) -> List[Dict]:
+    if not os.path.isfile(history):
+        return []
+    with open(history, "r") as results:
+        return [json.loads(i) for i in results if i.strip()]
+
+
+def previous_result(history: List[Dict], mode: str, params: Dict) -> Dict:
+    for result in reversed(history):
+        if result["mode"] == mode and result["params"] == params:
+            return result
+    return None
+
+
+def compare(current: Dict, previous: Dict, tolerance: float) -> Tuple[List[str], int]:
+    """Lines describing each measurement against the previous run, flagging those that slowed down
+    by more than the tolerance
+    """
+    pairs = [("total", current["total"], previous["total"]), ("overhead", current["overhead"], previous["overhead"])]
+    for name, step in current["steps"].items():
+        if name in previous["steps"]:
+            pairs.append((f"{name} wall", step["wall_time"], previous["steps"][name]["wall_time"]))
+    lines = []
+    regressions = 0
+    for name, now, before in pairs:
+        change = (now - before) / before if before > 0 else 0.0
+        regressed = change > tolerance and now - before > NOISE_FLOOR
+        regressions += regressed
+        lines.append(f"{name:<24} {before:>9.3f}s -> {now:>9.3f}s  {change:+.1%}{'  REGRESSION' if regressed else ''}")
+    return lines, regressions
+
+
+def describe(result: Dict) -> str:
+    lines = [f"{result['mode']} mode, {result['iterations']} iterations: {result['total']:.3f}s total, "
+             f"{result['tool_time']:.3f}s in tools, {result['overhead']:.3f}s workflow overhead"]
+    for name, step in result["steps"].items():
+        lines.append(f"  {name:<10} {step['calls']:>4.0f} calls {step['wall_time']:>9.3f}s wall {step['cpu_time']:>9.3f}s cpu "
+                     f"{step['max_rss_kb']:>9.0f}KB peak")
+    return "\n".join(lines)
+
+
+def use_tools(mode: str, mapper: str):
+    """Put the stub tools first in the path, or check the real tools are installed
+    """
+    if mode == "stub":
+        os.environ["PATH"] = os.pathsep.join([STUB_BIN, os.environ.get("PATH", "")])
+        return
+    missing = [i for i in [MAPPERS[mapper].program.binary, *REAL_TOOLS] if shutil.which(i) is None]
+    if not os.path.isfile(PILON_JAR):
+        missing.append(PILON_JAR)
+    if missing:
+        print(f"Real mode needs {', '.join(missing)}, use --mode stub to benchmark without them", flush=True)
+        sys.exit(-1)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Benchmark the polishing workflow on synthetic data")
+    parser.add_argument("--mode", choices=["stub", "real"], default="stub", help="Stub tools or installed tools. Default: stub")
+    parser.add_argument("--mapper", choices=list(MAPPERS), default="minimap2", help="Mapper backend. Default: minimap2")
+    parser.add_argument("--genome-size", type=int, default=100_000, help="Synthetic genome size in bp. Default: 100000")
+    parser.add_argument("--contigs", type=int, default=3, help="Contigs the genome is split into. Default: 3")
+    parser.add_argument("--depth", type=int, default=30, help="Read depth to simulate. Default: 30")
+    parser.add_argument("--read-length", type=int, default=150, help="Simulated read length. Default: 150")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the synthetic data. Default: 1")
+    parser.add_argument("--threads", type=int, default=4, help="Threads given to the workflow. Default: 4")
+    parser.add_argument("--memory", type=int, default=4, help="Memory in GB given to the workflow. Default: 4")
+    parser.add_argument("--ram", type=int, default=None, help="Pilon heap in GB. Default: estimated by the workflow")
+    parser.add_argument("--max-iter", type=int, default=4, help="Polishing iterations. Default: 4")
+    parser.add_argument("--shards", type=int, default=1, help="Pilon shards. Default: 1")
+    parser.add_argument("--target-depth", type=float, default=None, help="Downsample the reads to this depth first. Default: no downsampling")
+    parser.add_argument("--incremental", action="store_true", default=False, help="Freeze converged contigs")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs to take the median of. Default: 3")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Fractional slow down reported as a regression. Default: 0.2")
+    parser.add_argument("--history", default=DEFAULT_HISTORY, help=f"JSON lines file of earlier results. Default: {DEFAULT_HISTORY}")
+    parser.add_argument("--work-dir", default=None, help="Directory for the synthetic data and runs. Default: a temporary directory")
+    parser.add_argument("--keep", action="store_true", default=False, help="Keep the synthetic data and run outputs")
+    parser.add_argument("--no-record", action="store_true", default=False, help="Compare without appending to the history")
+    parser.add_argument("--fail-on-regression", action="store_true", default=False, help="Exit non zero when a regression is found")
+    return parser.parse_args(args)
+
+
+def main(args=sys.argv[1:]):
+    params = parse_args(args)
+    use_tools(params.mode, params.mapper)
+    work_dir = params.work_dir if params.work_dir is not None else tempfile.mkdtemp(prefix="pilonpolisher_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    dataset = make_dataset(os.path.join(work_dir, "data"), genome_size=params.genome_size, contigs=params.contigs,
+                           depth=params.depth, read_length=params.read_length, seed=params.seed)
+    print(f"Synthetic genome of {dataset.genome_size}bp with {dataset.snps} SNPs and {dataset.indels} indels at {dataset.depth}x", flush=True)
+    runs = [run_once(dataset, work_dir, params) for _ in range(max(1, params.repeats))]
+    run_params = {i: getattr(params, i) for i in ["genome_size", "contigs", "depth", "read_length", "seed", "threads", "memory",
+                                                   "ram", "max_iter", "shards", "incremental", "target_depth", "mapper"]}
+    result = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": git_commit(), "host": platform.node(),
+              "cpus": os.cpu_count(), "mode": params.mode, "params": run_params, "repeats": len(runs), **summarise(runs)}
+    if params.work_dir is None and not params.keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print(describe(result), flush=True)
+    previous = previous_result(load_history(params.history), params.mode, run_params)
+    regressions = 0
+    if previous is not None:
+        lines, regressions = compare(result, previous, params.tolerance)
+        print(f"Compared with {previous['commit']} from {previous['timestamp']}:", flush=True)
+        print("\n".join(lines), flush=True)
+    if not params.no_record:
+        os.makedirs(os.path.dirname(os.path.abspath(params.history)), exist_ok=True)
+        with open(params.history, "a") as history:
+            history.write(json.dumps(result) + "\n")
+    if regressions and params.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+"""Stand ins for minimap2, bwa-mem2, samtools, bgzip, racon and the Pilon JVM that accept the same arguments as the real
+tools but do almost no work, so a benchmark with them measures only the workflow's own overhead
+
+Alignments are passed around as plain SAM text under the .bam name. Pilon makes STUB_PILON_CHANGES
+substitutions per contig for the first STUB_PILON_ROUNDS - 1 iterations then reports no changes, so
+a run converges after STUB_PILON_ROUNDS iterations. minimap2 -x writes PAF overlaps, which racon counts
+per contig and writes each contig back unchanged with racon's header tags. With STUB_PILON_HEAP_PER_CONTIG set Pilon fails
+with an OutOfMemoryError unless its -Xmx heap covers that many GB for every contig it polishes.
+With STUB_SORT_OOM set samtools sort fails as it would when it cannot allocate its buffers.
+
+sbatch, squeue, sacct and scancel stand in for a SLURM cluster on one machine: each job or array
+task runs its script as a detached local process, and its state is kept as files in STUB_SLURM_DIR.
+"""
+import os
+import sys
+import fcntl
+import gzip
+import signal
+import subprocess
+from typing import Dict, List, Tuple
+
+
+PILON_SUFFIX = "_pilon"
+STUB_VERSION = "stub"
+
+
+def read_fasta(path: str) -> List[Tuple[str, str]]:
+    records = []
+    with open(path, "r") as fasta:
+        for line in fasta:
+            line = line.strip()
+            if line.startswith(">"):
+                records.append([line[1:].split()[0], []])
+            elif line:
+                records[-1][1].append(line)
+    return [(name, "".join(seq)) for name, seq in records]
+
+
+def write_fasta(records: List[Tuple[str, str]], path: str):
+    with open(path, "w") as fasta:
+        for name, seq in records:
+            fasta.write(f">{name}\n")
+            for start in range(0, len(seq), 80):
+                fasta.write(f"{seq[start:start + 80]}\n")
+
+
+def option_values(args: List[str], flags: Dict[str, bool]) -> Tuple[Dict[str, str], List[str]]:
+    """Split arguments into options and positionals, flags maps an option to whether it takes a value
+    """
+    options = {}
+    positional = []
+    args = iter(args)
+    for arg in args:
+        if arg in flags:
+            options[arg] = next(args) if flags[arg] else True
+        elif arg.startswith("-") and arg != "-":
+            options[arg] = True
+        else:
+            positional.append(arg)
+    return options, positional
+
+
+def minimap2(args: List[str]):
+    if "--version" in args:
+        print(f"2.26-{STUB_VERSION}")
+        return
+    options, positional = option_values(args, {"-d": True, "-t": True, "-ax": True, "-x": True, "-o": True})
+    if "-d" in options:
+        open(options["-d"], "w").close()
+        return
+    contigs = read_fasta(positional[0])
+    records = int(os.environ.get("STUB_MM2_RECORDS", 100))
+    out = open(options["-o"], "w") if "-o" in options else sys.stdout
+    if "-x" in options:
+        for name, seq in contigs:
+            for idx in range(records):
+                start = idx * max(1, len(seq) - 150) // records
+                out.write(f"read{idx}\t150\t0\t150\t+\t{name}\t{len(seq)}\t{start}\t{start + 150}\t150\t150\t60\n")
+        out.flush()
+        return
+    out.write("@HD\tVN:1.6\tSO:unsorted\n")
+    out.writelines(f"@SQ\tSN:{name}\tLN:{len(seq)}\n" for name, seq in contigs)
+    for name, seq in contigs:
+        for idx in range(records):
+            position = 1 + idx * max(1, len(seq) - 150) // records
+            out.write(f"read{idx}\t0\t{name}\t{position}\t60\t150M\t*\t0\t0\t{seq[position - 1:position + 149]}\t*\n")
+    out.flush()
+
+
+def bwa_mem2(args: List[str]):
+    if not args or args[0] == "version":
+        print(f"2.2.1-{STUB_VERSION}")
+        return
+    command, args = args[0], args[1:]
+    options, positional = option_values(args, {"-p": True, "-t": True, "-o": True})
+    if command == "index":
+        for ext in [".0123", ".amb", ".ann", ".bwt.2bit.64", ".pac"]:
+            with open(f"{options['-p']}{ext}", "w") as index:
+                index.write(positional[0] if ext == ".ann" else "")
+        return
+    with open(f"{positional[0]}.ann", "r") as ann:
+        contigs = ann.read().strip()
+    minimap2(["-ax", "sr", *(["-o", options["-o"]] if "-o" in options else []), contigs, *positional[1:]])
+
+
+def samtools(args: List[str]):
+    if not args or args[0] == "--version":
+        print(f"samtools 1.17-{STUB_VERSION}")
+        return
+    command, args = args[0], args[1:]
+    options, positional = option_values(args, {"-@": True, "-m": True, "-T": True, "-o": True, "-L": True, "-l": True})
+    if command == "sort" and os.environ.get("STUB_SORT_OOM"):
+        print("samtools sort: couldn't allocate memory for bam_mem: Cannot allocate memory", file=sys.stderr)
+        sys.exit(1)
+    if command in ("sort", "view", "merge"):
+        if command == "merge":
+            inputs = [open(i, "r").readlines() for i in positional]
+            lines = [i for i in inputs[0] if i.startswith("@")] + [i for records in inputs for i in records if not i.startswith("@")]
+        else:
+            source = sys.stdin if not positional or positional[0] == "-" else open(positional[0], "r")
+            lines = source.readlines()
+        if "-L" in options:
+            regions = {}
+            with open(options["-L"], "r") as bed:
+                for region in bed:
+                    if region.strip():
+                        name, start, stop = region.split("\t")[:3]
+                        regions.setdefault(name, []).append((int(start), int(stop)))
+
+            def overlaps(fields):
+                start = int(fields[3]) - 1
+                return any(i < start + len(fields[9]) and start < j for i, j in regions.get(fields[2], []))
+            lines = [i for i in lines if i.startswith("@") or overlaps(i.split("\t"))]
+        if "-H" in options:
+            lines = [i for i in lines if i.startswith("@")]
+        output = options.get("-o", "-")
+        index = None
+        if "##idx##" in output:
+            output, index = output.split("##idx##")
+        out = sys.stdout if output == "-" else open(output, "w")
+        out.writelines(lines)
+        out.flush()
+        if index is not None:
+            open(index, "w").close()
+    elif command == "index":
+        open(f"{positional[0]}{'.crai' if positional[0].endswith('.cram') else '.bai'}", "w").close()
+    elif command == "idxstats":
+        mapped = {}
+        lengths = {}
+        with open(positional[0], "r") as alignments:
+            for line in alignments:
+                fields = line.split("\t")
+                if line.startswith("@SQ"):
+                    lengths[fields[1][3:]] = int(fields[2][3:])
+                elif not line.startswith("@"):
+                    mapped[fields[2]] = mapped.get(fields[2], 0) + 1
+        for name, length in lengths.items():
+            print(f"{name}\t{length}\t{mapped.get(name, 0)}\t0")
+        print("*\t0\t0\t0")
+    else:
+        print(f"samtools stub does not implement {command}", file=sys.stderr)
+        sys.exit(1)
+
+
+def racon(args: List[str]):
+    if "--version" in args:
+        print(f"v1.5.0-{STUB_VERSION}")
+        return
+    options, positional = option_values(args, {"-t": True, "-u": False})
+    overlaps = {}
+    with open(positional[1], "r") as paf:
+        for line in paf:
+            contig = line.split("\t")[5]
+            overlaps[contig] = overlaps.get(contig, 0) + 1
+    for name, seq in read_fasta(positional[2]):
+        if name in overlaps or "-u" in options:
+            sys.stdout.write(f">{name} LN:i:{len(seq)} RC:i:{overlaps.get(name, 0)} XC:f:1.000000\n{seq}\n")
+    sys.stdout.flush()
+
+
+def pilon(args: List[str], heap: int = None):
+    if "--version" in args:
+        print(f"Pilon version 1.24 {STUB_VERSION}")
+        return
+    options, _ = option_values(args, {"--genome": True, "--bam": True, "--output": True, "--outdir": True,
+                                      "--targets": True, "--threads": True, "--fix": True})
+    rounds = int(os.environ.get("STUB_PILON_ROUNDS", 3))
+    per_contig = int(os.environ.get("STUB_PILON_CHANGES", 5))
+    targets = None
+    if "--targets" in options:
+        with open(options["--targets"], "r") as target_list:
+            targets = {i.strip() for i in target_list if i.strip()}
+    heap_per_contig = float(os.environ.get("STUB_PILON_HEAP_PER_CONTIG", 0))
+    contigs = read_fasta(options["--genome"])
+    polishing = len(targets) if targets is not None else len(contigs)
+    if heap is not None and heap < heap_per_contig * polishing:
+        print('Exception in thread "main" java.lang.OutOfMemoryError: Java heap space', file=sys.stderr)
+        sys.exit(1)
+    prefix = os.path.join(options.get("--outdir", "."), options.get("--output", "pilon"))
+    polished = []
+    changes = []
+    for name, seq in contigs:
+        if targets is not None and name not in targets:
+            continue
+        seq = list(seq)
+        iteration = name.count(PILON_SUFFIX)
+        if iteration < rounds - 1:
+            for idx in range(min(per_contig, len(seq) // 100)):
+                position = idx * 100 + iteration + 1
+                original = seq[position - 1]
+                seq[position - 1] = "A" if original != "A" else "C"
+                changes.append(f"{name}:{position} {name}{PILON_SUFFIX}:{position} {original} {seq[position - 1]}\n")
+        polished.append((f"{name}{PILON_SUFFIX}", "".join(seq)))
+    write_fasta(polished, f"{prefix}.fasta")
+    if "--changes" in options:
+        with open(f"{prefix}.changes", "w") as out:
+            out.writelines(changes)
+    if "--vcf" in options:
+        with open(f"{prefix}.vcf", "w") as out:
+            out.write("##fileformat=VCFv4.1\n")
+            out.writelines(f"##contig=<ID={name[:-len(PILON_SUFFIX)]},length={len(seq)}>\n" for name, seq in polished)
+            out.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+
+
+def java(args: List[str]):
+    """Drop the JVM options and jar path then behave as Pilon with the -Xmx heap
+    """
+    heap = None
+    while args and args[0].startswith("-X"):
+        if args[0].startswith("-Xmx"):
+            heap = int(args[0][4:].rstrip("G"))
+        args = args[1:]
+    if args[:1] == ["-jar"]:
+        args = args[2:]
+    pilon(args, heap)
+
+
+def bgzip(args: List[str]):
+    """Compress stdin to stdout as plain gzip, which readers of bgzf also accept
+    """
+    with gzip.open(sys.stdout.buffer, "wb", compresslevel=1) as out:
+        for block in iter(lambda: sys.stdin.buffer.read(1 << 16), b""):
+            out.write(block)
+
+
+def slurm_dir() -> str:
+    path = os.environ.get("STUB_SLURM_DIR", os.path.join(os.environ.get("TMPDIR", "/tmp"), f"stub_slurm_{os.getuid()}"))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def next_job_id(path: str) -> int:
+    with open(os.path.join(path, "next_id"), "a+") as counter:
+        fcntl.flock(counter, fcntl.LOCK_EX)
+        counter.seek(0)
+        job_id = int(counter.read() or 1000)
+        counter.seek(0)
+        counter.truncate()
+        counter.write(str(job_id + 1))
+    return job_id
+
+
+def array_tasks(spec: str) -> List[int]:
+    """Task ids of an --array range such as 0-9%2 or 1,3,5, the throttle is ignored
+    """
+    tasks = []
+    for part in spec.split("%")[0].split(","):
+        start, _, end = part.partition("-")
+        tasks.extend(range(int(start), int(end or start) + 1))
+    return tasks
+
+
+def sbatch(args: List[str]):
+    """Start the script once per task in its own session, recording the exit code or cancellation when it ends
+    """
+    options, positionals = {}, []
+    for arg in args:
+        if arg.startswith("--") and "=" in arg:
+            key, value = arg[2:].split("=", 1)
+            options[key] = value
+        elif arg.startswith("--"):
+            options[arg[2:]] = True
+        else:
+            positionals.append(arg)
+    path = slurm_dir()
+    job_id = next_job_id(path)
+    tasks = array_tasks(options["array"]) if "array" in options else [None]
+    for task in tasks:
+        task_id = f"{job_id}" if task is None else f"{job_id}_{task}"
+        log = options.get("output", f"slurm-{job_id}.out").replace("%A", str(job_id)).replace("%a", str(task)).replace("%j", str(job_id))
+        env = dict(os.environ, SLURM_JOB_ID=str(job_id), SLURM_CPUS_PER_TASK=str(options.get("cpus-per-task", 1)),
+                   SLURM_JOB_NAME=str(options.get("job-name", "")))
+        if task is not None:
+            env.update(SLURM_ARRAY_JOB_ID=str(job_id), SLURM_ARRAY_TASK_ID=str(task))
+        exit_file = os.path.join(path, f"{task_id}.exit")
+        runner = 'bash "$0" > "$1" 2>&1; echo $? > "$2.tmp"; [ -e "$2" ] || mv "$2.tmp" "$2"'
+        proc = subprocess.Popen(["bash", "-c", runner, positionals[0], log, exit_file], env=env, cwd=options.get("chdir"),
+                                start_new_session=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open(os.path.join(path, f"{task_id}.pid"), "w") as pid_file:
+            pid_file.write(str(proc.pid))
+    print(job_id if "parsable" in options else f"Submitted batch job {job_id}")
+
+
+def known_tasks(job_ids: List[str]) -> List[str]:
+    path = slurm_dir()
+    names = [i[:-len(".pid")] for i in os.listdir(path) if i.endswith(".pid")]
+    return sorted(i for i in names if i.split("_")[0] in job_ids or i in job_ids)
+
+
+def task_state(task_id: str) -> Tuple[str, str]:
+    exit_file = os.path.join(slurm_dir(), f"{task_id}.exit")
+    if not os.path.isfile(exit_file):
+        return "RUNNING", "0:0"
+    with open(exit_file, "r") as exit_code:
+        code = exit_code.read().strip()
+    if code == "CANCELLED":
+        return "CANCELLED", "0:15"
+    return ("COMPLETED" if code == "0" else "FAILED"), f"{code}:0"
+
+
+def job_ids_option(args: List[str]) -> List[str]:
+    for idx, arg in enumerate(args):
+        if arg in ("-j", "--jobs"):
+            return args[idx + 1].split(",")
+        if arg.startswith("--jobs="):
+            return arg.split("=", 1)[1].split(",")
+    return []
+
+
+def squeue(args: List[str]):
+    for task_id in known_tasks(job_ids_option(args)):
+        state, _ = task_state(task_id)
+        if state == "RUNNING":
+            print(f"{task_id} {state}")
+
+
+def sacct(args: List[str]):
+    for task_id in known_tasks(job_ids_option(args)):
+        state, exit_code = task_state(task_id)
+        print(f"{task_id}|{state}|{exit_code}")
+
+
+def scancel(args: List[str]):
+    for task_id in known_tasks(args):
+        if task_state(task_id)[0] != "RUNNING":
+            continue
+        with open(os.path.join(slurm_dir(), f"{task_id}.pid"), "r") as pid_file:
+            pid = int(pid_file.read())
+        with open(os.path.join(slurm_dir(), f"{task_id}.exit"), "w") as exit_file:
+            exit_file.write("CANCELLED")
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+TOOLS = {"minimap2": minimap2, "bwa-mem2": bwa_mem2, "samtools": samtools, "java": java, "bgzip": bgzip, "racon": racon,
+         "sbatch": sbatch, "squeue": squeue, "sacct": sacct, "scancel": scancel}
+
+
+def main():
+    TOOLS[os.path.basename(sys.argv[0])](sys.argv[1:])
+
+
+if __name__ == "__main__":
+    main()
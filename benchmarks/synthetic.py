@@ -0,0 +1,105 @@
+"""Generate synthetic polishing inputs without any network access or external tools
+
+A random reference genome is split into contigs, a draft assembly is made from it by injecting SNPs
+and small indels, and error free paired-end reads are sampled from the reference at a given depth.
+"""
+import os
+import gzip
+import random
+from typing import Dict, List, Tuple
+from dataclasses import dataclass
+
+
+BASES = "ACGT"
+COMPLEMENT = str.maketrans(BASES, BASES[::-1])
+LINE_WIDTH = 80
+
+
+@dataclass(frozen=True)
+class SyntheticDataset:
+    reference: str
+    draft: str
+    reads: List[str]
+    genome_size: int
+    depth: int
+    snps: int
+    indels: int
+
+
+def random_genome(genome_size: int, contigs: int, rng: random.Random) -> Dict[str, str]:
+    """Contigs of decreasing length that add up to genome_size
+    """
+    weights = [1 / (i + 1) for i in range(contigs)]
+    lengths = [max(1000, int(genome_size * i / sum(weights))) for i in weights]
+    return {f"contig_{idx + 1}": "".join(rng.choices(BASES, k=length)) for idx, length in enumerate(lengths)}
+
+
+def mutate(sequence: str, snps: int, indels: int, rng: random.Random) -> Tuple[str, int, int]:
+    """Inject SNPs and one to three base insertions or deletions at random positions
+    """
+    seq = list(sequence)
+    positions = sorted(rng.sample(range(50, len(seq) - 50), min(snps + indels, max(0, len(seq) - 100))), reverse=True)
+    kinds = ["snp"] * snps + ["indel"] * indels
+    rng.shuffle(kinds)
+    for position, kind in zip(positions, kinds):
+        if kind == "snp":
+            seq[position] = rng.choice([i for i in BASES if i != seq[position]])
+        elif rng.random() < 0.5:
+            seq[position:position] = rng.choices(BASES, k=rng.randint(1, 3))
+        else:
+            del seq[position:position + rng.randint(1, 3)]
+    return "".join(seq), kinds.count("snp"), kinds.count("indel")
+
+
+def write_fasta(records: Dict[str, str], output: str):
+    with open(output, "w") as fasta:
+        for name, seq in records.items():
+            fasta.write(f">{name}\n")
+            for start in range(0, len(seq), LINE_WIDTH):
+                fasta.write(f"{seq[start:start + LINE_WIDTH]}\n")
+
+
+def simulate_pairs(genome: Dict[str, str], depth: int, read_length: int, insert_size: int, prefix: str,
+                   rng: random.Random, compress: bool = True) -> List[str]:
+    """Sample error free read pairs in forward-reverse orientation, mates share a name
+    """
+    opener = gzip.open if compress else open
+    ext = ".fastq.gz" if compress else ".fastq"
+    outputs = [f"{prefix}_R1{ext}", f"{prefix}_R2{ext}"]
+    quality = "I" * read_length
+    with opener(outputs[0], "wt") as r1, opener(outputs[1], "wt") as r2:
+        read_id = 0
+        for name, seq in genome.items():
+            fragment = min(insert_size, len(seq))
+            for _ in range(len(seq) * depth // (2 * read_length)):
+                start = rng.randint(0, len(seq) - fragment)
+                mate1 = seq[start:start + read_length]
+                mate2 = seq[start + fragment - read_length:start + fragment].translate(COMPLEMENT)[::-1]
+                read_id += 1
+                r1.write(f"@read{read_id}/1\n{mate1}\n+\n{quality[:len(mate1)]}\n")
+                r2.write(f"@read{read_id}/2\n{mate2}\n+\n{quality[:len(mate2)]}\n")
+    return outputs
+
+
+def make_dataset(out_dir: str, genome_size: int = 100_000, contigs: int = 3, depth: int = 30, read_length: int = 150,
+                 insert_size: int = 400, snps_per_100kb: int = 20, indels_per_100kb: int = 10, seed: int = 1,
+                 compress: bool = True) -> SyntheticDataset:
+    """Write a reference, a mutated draft and reads sampled from the reference into out_dir
+    """
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    reference = random_genome(genome_size, contigs, rng)
+    draft = {}
+    snps = indels = 0
+    for name, seq in reference.items():
+        scale = len(seq) / 100_000
+        draft[name], contig_snps, contig_indels = mutate(seq, round(snps_per_100kb * scale), round(indels_per_100kb * scale), rng)
+        snps += contig_snps
+        indels += contig_indels
+    reference_path = os.path.join(out_dir, "reference.fasta")
+    draft_path = os.path.join(out_dir, "draft.fasta")
+    write_fasta(reference, reference_path)
+    write_fasta(draft, draft_path)
+    reads = simulate_pairs(reference, depth, read_length, insert_size, os.path.join(out_dir, "reads"), rng, compress)
+    return SyntheticDataset(reference=reference_path, draft=draft_path, reads=reads, genome_size=sum(len(i) for i in reference.values()),
+                            depth=depth, snps=snps, indels=indels)
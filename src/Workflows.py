@@ -5,8 +5,28 @@ Matthew Wells: 2023-05-18
 import os
 import sys
 import copy
-from typing import List, Union
-from tools import Executor, Minimap2Settings, FlyeInputs, Minimap2, Pilon, Samtools
+import csv
+import glob
+import heapq
+import shutil
+from enum import StrEnum
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple, Union
+from convergence import ConvergenceTracker, PilonChanges
+from downsample import ReadDownsampler
+from liftover import EditMap
+from pilon_qc import PilonQC, ContigQC
+from read_cache import ReadCache
+from scratch import ScratchSpace, exit_on_termination
+from fasta import contig_lengths, partition_contigs, read_fasta, write_fasta
+from resources import ResourceBudget, HeapEstimate, parse_idxstats, sample_read_length
+from scheduler import ResourceScheduler
+from report import RunReport
+from cache import StepCache
+from engine import WorkflowEngine
+from slurm import SlurmCluster, shell_command
+from tools import Executor, ExecutionContext, ContainerInstance, OutOfMemoryFailure, Minimap2Settings, BwaMem2Settings, FlyeInputs, Minimap2, BwaMem2, Pilon, Samtools
 
 
 class Polisher:
@@ -19,13 +39,65 @@ class Polisher:
         pass
 
 class Mapper:
-    """Base class for read mapping classes
+    """Base class for read mapping backends
 
-    Returns:
-        _type_: _description_
+    A backend builds or reuses any index it needs in prepare_index and creates an executor writing
+    SAM to stdout, or to an output name, in mapping_executor. Mapping and streaming into samtools
+    sort is shared by every backend.
     """
-    def __init__(self) -> None:
-        pass
+    name = None
+    program = None
+    index_ext = None
+
+    def __init__(self, contigs: str, reads: List[str], output_name, mapping_setting: Minimap2Settings = Minimap2Settings.map_illumina,
+                 resources: ResourceBudget = ResourceBudget(), context: ExecutionContext = None) -> None:
+        self.contigs = os.path.abspath(contigs)
+        self.reads = [os.path.abspath(i) for i in reads]
+        self.output_name = output_name
+        self.mapping_setting = mapping_setting
+        self.resources = resources
+        self.context = context if context is not None else ExecutionContext()
+        self.bind_paths = [os.path.dirname(i) for i in self.reads]
+        self.bind_paths.append(os.path.dirname(self.contigs))   
+        if self.output_name is not None:
+            self.bind_paths.append(os.path.dirname(os.path.abspath(self.output_name)))
+        self.bind_mounts = ",".join(set(self.bind_paths))
+
+    @classmethod
+    def index_prefix(cls, alignments: str) -> str:
+        """Index built for the alignments of an iteration, named after them so it is removed along with them
+        """
+        if cls.index_ext is None:
+            return None
+        return f"{os.path.splitext(os.path.abspath(alignments))[0]}{cls.index_ext}"
+
+    def prepare_index(self, alignments: str):
+        """Queue building the index mapping needs, backends indexing on the fly need nothing
+        """
+
+    def mapping_executor(self, output_name: str = None) -> Executor:
+        raise NotImplementedError
+
+    def map_reads(self):
+        """Map reads to an assembly
+        """
+        self.prepare_index(self.output_name)
+        self.context.submit(self.mapping_executor(output_name=self.output_name))
+
+    def map_reads_sorted(self, bam: str, regions: str = None):
+        """Stream alignments from the mapper straight into samtools sort, writing an indexed bam
+        and never materialising the sam file. Given a bed file of regions only alignments
+        overlapping them are kept
+        """
+        self.prepare_index(bam)
+        bind_mounts = ",".join(set([*self.bind_paths, os.path.dirname(os.path.abspath(bam))]))
+        stages = [self.mapping_executor()]
+        if regions is not None:
+            stages.append(Executor("Samtools", bind_mounts, "view", "-u", "-L", regions, "-", context=self.context, inputs=[regions]))
+        stages.append(Executor("Samtools", bind_mounts, "sort", *self.resources.sort_args(), "--write-index", "-T", f"{bam}.tmp",
+                               "-o", f"{bam}##idx##{bam}.bai", "-", context=self.context, outputs=[bam, f"{bam}.bai"],
+                               threads=self.resources.sort_threads, memory=self.resources.sort_memory))
+        self.context.submit(*stages)
 
 
 class AssembleLongReads:
@@ -34,10 +106,14 @@ class AssembleLongReads:
     TODO Try and generalize the path binding operations to the Program class
     """
 
-    def __init__(self, long_reads: List[str], output_dir: str):
+    def __init__(self, long_reads: List[str], output_dir: str, context: ExecutionContext = None, timeout: float = None, threads: int = None):
         self.long_reads = [os.path.abspath(i) for i in long_reads]
         self.output_dir = os.path.abspath(output_dir)
+        self.threads = threads
         self.bind_mounts = self.create_bind_paths()
+        self.context = context if context is not None else ExecutionContext()
+        if self.context.engine is None:
+            self.context.engine = WorkflowEngine(self.context, timeout=timeout)
 
     def create_bind_paths(self):
         """Create paths of directories to bind for the singularity image
@@ -50,29 +126,26 @@ class AssembleLongReads:
         """Run flye on long read data
         """
 
-        flye = Executor("Flye", bind_mounts=self.bind_mounts, mode=FlyeInputs.nano_hq, input_files=self.long_reads, out_dir=self.output_dir)
+        flye = Executor("Flye", bind_mounts=self.bind_mounts, context=self.context, mode=FlyeInputs.nano_hq, input_files=self.long_reads,
+                        out_dir=self.output_dir, threads=self.threads)
         #if not os.path.isdir(self.output_dir):
         #    print(f"Creating output directory for flye: {self.output_dir}", flush=True)
         #    os.mkdir(self.output_dir)
-        flye.execute()
+        self.context.submit(flye)
+        self.context.flush()
+        return flye.initialized.outputs()[0]
 
 
 class IdxMapReads(Mapper):
     """Index assemblies, and map reads to them
-        TODO Racon need overlaps of reads, so an the ava-ont option mat be able to be run
         TODO follow up on when to use ava, I dont think it is needed here
     """
+    name = "minimap2"
+    program = Minimap2
 
-
-    def __init__(self, contigs: str, reads: List[str], output_name, mapping_setting: Minimap2Settings = Minimap2Settings.map_ont) -> None:
-        self.contigs = os.path.abspath(contigs)
-        self.reads = [os.path.abspath(i) for i in reads]
-        self.output_name = output_name
-        self.mapping_setting = mapping_setting
-        self.bind_paths = [os.path.dirname(i) for i in self.reads]
-        self.bind_paths.append(os.path.dirname(self.contigs))   
-        self.bind_paths.append(os.getcwd())   
-        self.bind_mounts = ",".join(set(self.bind_paths))
+    def __init__(self, contigs: str, reads: List[str], output_name, mapping_setting: Minimap2Settings = Minimap2Settings.map_ont,
+                 resources: ResourceBudget = ResourceBudget(), context: ExecutionContext = None) -> None:
+        super().__init__(contigs, reads, output_name, mapping_setting, resources, context)
 
     def alignment_dance(self):
         """index contigs, and map reads to the alignment
@@ -85,35 +158,198 @@ class IdxMapReads(Mapper):
     def index_reads(self):
         """Create an index for a new assembly
         """
-        mm2_index = Executor("Minimap2", bind_mounts=self.bind_mounts, 
+        mm2_index = Executor("Minimap2", bind_mounts=self.bind_mounts, context=self.context,
                             setting=Minimap2Settings.create_index, output_name=self.output_name, contigs=self.contigs)
-        mm2_index.execute()
-    
-    def map_reads(self):
-        """Map reads to an assembly
+        self.context.submit(mm2_index)
+
+    def mapping_executor(self, output_name: str = None):
+        """Create the minimap2 mapping executor, without an output name the alignments are written to stdout
+        """
+        return Executor(prog="Minimap2", bind_mounts=self.bind_mounts, context=self.context, setting=self.mapping_setting, 
+                        reads=self.reads, output_name=output_name, contigs=self.contigs, threads=self.resources.mapper_threads)
+
+
+class BwaMem2MapReads(Mapper):
+    """Map paired short reads with bwa-mem2, whose alignments Pilon was developed against
+
+    The index is built beside the alignments of each iteration and reused while it is newer than
+    the contigs, bwa-mem2 selects its SSE4.1, AVX2 or AVX-512 build for the host at run time.
+    """
+    name = "bwa-mem2"
+    program = BwaMem2
+    index_ext = ".bwa"
+
+    def __init__(self, contigs: str, reads: List[str], output_name, mapping_setting: Minimap2Settings = Minimap2Settings.map_illumina,
+                 resources: ResourceBudget = ResourceBudget(), context: ExecutionContext = None) -> None:
+        super().__init__(contigs, reads, output_name, mapping_setting, resources, context)
+        self.index = None
+
+    def index_is_current(self, index_files: List[str]) -> bool:
+        contigs_mtime = os.path.getmtime(self.contigs)
+        return all(os.path.isfile(i) and os.path.getmtime(i) >= contigs_mtime for i in index_files)
+
+    def prepare_index(self, alignments: str):
+        """Queue an index build for the contigs unless a current index already sits beside the alignments
         """
-        mm2_map = Executor(prog="Minimap2", bind_mounts=self.bind_mounts, setting=Minimap2Settings.map_ont, 
-                        reads=self.reads, output_name=self.output_name, contigs=self.contigs)
-        mm2_map.execute()
+        self.index = self.index_prefix(alignments)
+        build = Executor("BwaMem2", ",".join(set([os.path.dirname(self.contigs), os.path.dirname(self.index)])), context=self.context,
+                         setting=BwaMem2Settings.create_index, index=self.index, contigs=self.contigs)
+        if self.index_is_current(build.initialized.index_files()):
+            print(f"Reusing bwa-mem2 index {self.index}", flush=True)
+            return
+        self.context.submit(build)
+
+    def mapping_executor(self, output_name: str = None):
+        """Create the bwa-mem2 mapping executor, without an output name the alignments are written to stdout
+        """
+        bind_mounts = ",".join(set([*self.bind_paths, os.path.dirname(self.index)]))
+        return Executor(prog="BwaMem2", bind_mounts=bind_mounts, context=self.context, setting=BwaMem2Settings.map_reads,
+                        reads=self.reads, index=self.index, output_name=output_name, threads=self.resources.mapper_threads)
+
+
+MAPPERS = {i.name: i for i in [IdxMapReads, BwaMem2MapReads]}
 
 class ContigConsensus:
-    """Run Racon on created assemblies
+    """Polish a long read assembly with Racon so Pilon starts from contigs without most of their
+    long read indel errors
 
-    TODO implement racon later, currently I dont want to deal with the reads as duplicates issue till later
+    Each round maps the long reads to the contigs with minimap2 map-ont as PAF overlaps, then splits
+    the contigs into chunks of similar total length, as racon's --split does, each polished by its
+    own Racon process given only the overlaps onto its contigs. concurrent chunks are run at once
+    and share the threads. Contigs without overlaps are kept unpolished and the chunks are merged
+    back in the original contig order. Racon reads a single file, so several long read files are
+    joined into one first.
     """
+    paf_ext = ".paf"
+    fasta_ext = ".fasta"
+    chunk_dir = "racon_chunks"
 
-    def __init__(self, contigs: str, sam_file: str, reads: List[str], output_name: str) -> None:
-        self.contigs = contigs
-        self.sam_file = sam_file
-        self.reads = reads
-        self.output_name = output_name
+    def __init__(self, contigs: str, long_reads: List[str], out_dir: str, prefix: str, rounds: int = 1, chunks: int = 1,
+                 concurrent: int = None, resources: ResourceBudget = None, context: ExecutionContext = None) -> None:
+        self.contigs = os.path.abspath(contigs)
+        self.long_reads = [os.path.abspath(i) for i in long_reads]
+        self.out_dir = os.path.abspath(out_dir)
+        os.makedirs(self.out_dir, exist_ok=True)
+        self.prefix = prefix
+        self.rounds = rounds
+        self.chunks = max(1, chunks)
+        self.concurrent = concurrent or self.chunks
+        self.resources = resources if resources is not None else ResourceBudget()
+        self.context = context if context is not None else ExecutionContext()
+        if self.context.engine is None:
+            self.context.engine = WorkflowEngine(self.context, jobs=self.concurrent)
+
+    def output(self, name: str) -> str:
+        return os.path.join(self.out_dir, f"{self.prefix}_{name}")
+
+    def joined_reads(self) -> str:
+        """Long reads as one file, concatenated when there are several. Concatenated gzip members
+        are themselves a valid gzip file
+        """
+        if len(self.long_reads) == 1:
+            return self.long_reads[0]
+        name = os.path.basename(self.long_reads[0])
+        ext = name[name.index("."):] if "." in name else ""
+        joined = self.output(f"long_reads{ext}")
+        with open(joined, "wb") as out:
+            for reads in self.long_reads:
+                with open(reads, "rb") as data:
+                    shutil.copyfileobj(data, out)
+        return joined
+
+    def polish(self) -> str:
+        """Run every round of Racon, returning the final consensus
+        """
+        reads = self.joined_reads()
+        assembly = self.contigs
+        for round_ in range(self.rounds):
+            assembly = self.polish_round(assembly, reads, round_)
+        if reads not in self.long_reads:
+            PolishWorkflow.remove_files([reads])
+        return assembly
+
+    def polish_round(self, assembly: str, reads: str, round_: int) -> str:
+        overlaps = self.output(f"racon_{round_}{self.paf_ext}")
+        consensus = self.output(f"racon_{round_}{self.fasta_ext}")
+        bind_mounts = ",".join(set([os.path.dirname(reads), os.path.dirname(assembly), self.out_dir]))
+        self.context.submit(Executor("Minimap2", bind_mounts, context=self.context, setting=Minimap2Settings.map_ont, reads=[reads],
+                                     contigs=assembly, output_name=overlaps, threads=self.resources.threads, paf=True))
+        self.context.flush()
+
+        lengths = contig_lengths(assembly)
+        groups = partition_contigs(lengths, self.chunks)
+        concurrent = min(len(groups), self.concurrent)
+        threads = max(1, self.resources.threads // concurrent)
+        chunk_out = self.output(f"racon_{round_}_{self.chunk_dir}")
+        os.makedirs(chunk_out, exist_ok=True)
+        chunk_prefixes = [os.path.join(chunk_out, f"chunk{idx}") for idx in range(len(groups))]
+        owner = {name: idx for idx, group in enumerate(groups) for name in group}
+        for idx, records in enumerate(self.chunk_records(assembly, groups, owner)):
+            write_fasta(records, f"{chunk_prefixes[idx]}{self.fasta_ext}")
+        self.split_overlaps(overlaps, chunk_prefixes, owner)
+        print(f"Racon round {round_ + 1} of {self.rounds}: {len(lengths)} contigs in {len(groups)} chunks, "
+              f"{concurrent} at once with {threads} threads each", flush=True)
+        for chunk_prefix in chunk_prefixes:
+            self.context.submit(Executor("Racon", bind_mounts, context=self.context, reads=reads, overlaps=f"{chunk_prefix}{self.paf_ext}",
+                                         contigs=f"{chunk_prefix}{self.fasta_ext}", output_name=f"{chunk_prefix}_consensus{self.fasta_ext}",
+                                         threads=threads))
+        self.context.flush()
+
+        polished = {}
+        for chunk_prefix in chunk_prefixes:
+            polished.update(read_fasta(f"{chunk_prefix}_consensus{self.fasta_ext}"))
+        missing = [i for i in lengths if i not in polished]
+        if missing:
+            print(f"Racon did not return contigs {', '.join(missing)}", flush=True)
+            sys.exit(-1)
+        write_fasta(((i, polished[i]) for i in lengths), consensus)
+        PolishWorkflow.remove_files([overlaps, chunk_out])
+        return consensus
+
+    @staticmethod
+    def chunk_records(assembly: str, groups: List[List[str]], owner: Dict[str, int]) -> List[List[Tuple[str, str]]]:
+        chunks = [[] for _ in groups]
+        for name, seq in read_fasta(assembly):
+            chunks[owner[name]].append((name, seq))
+        return chunks
+
+    def split_overlaps(self, overlaps: str, chunk_prefixes: List[str], owner: Dict[str, int]):
+        """Write each overlap to the chunk holding its target contig, the sixth PAF column
+        """
+        handles = [open(f"{i}{self.paf_ext}", "w") for i in chunk_prefixes]
+        try:
+            with open(overlaps, "r") as paf:
+                for line in paf:
+                    fields = line.split("\t", 6)
+                    if len(fields) > 6 and fields[5] in owner:
+                        handles[owner[fields[5]]].write(line)
+        finally:
+            for handle in handles:
+                handle.close()
     
 
 class PolishAssembly(Polisher):
     """Polish an assemblies with short read data using Pilon
+
+    With more than one shard the contigs are split into groups of similar total length, each group
+    is polished by its own Pilon process using --targets and a slice of the heap and threads, and
+    the outputs of every shard are merged back in the original contig order.
+
+    Given targets only those contigs are polished, the remaining contigs are copied into the output
+    unchanged but renamed as Pilon would so contig names stay consistent between iterations.
+
+    With per_contig every contig is polished by its own Pilon process. Only as many shards as the
+    workflow engine runs steps at once, or concurrent when given, share the heap and threads rather
+    than all of them.
     """
+    assembly_ext = ".fasta"
+    changes_ext = ".changes"
+    vcf_ext = ".vcf"
+    targets_ext = ".targets"
+    shard_dir = "shards"
 
-    def __init__(self, contigs: str, bam: str, output_prefix: str, out_dir: str, ram: int, **kwargs):
+    def __init__(self, contigs: str, bam: str, output_prefix: str, out_dir: str, ram: int, shards: int = 1,
+                 context: ExecutionContext = None, targets: List[str] = None, per_contig: bool = False, concurrent: int = None, **kwargs):
         self.contigs = os.path.abspath(contigs)
         self.bam = os.path.abspath(bam)
         self.output_prefix = output_prefix
@@ -121,6 +357,11 @@ class PolishAssembly(Polisher):
         self.out_dir = os.path.abspath(out_dir)
         if not os.path.isdir(self.out_dir):
             os.mkdir(self.out_dir)
+        self.shards = shards
+        self.context = context if context is not None else ExecutionContext()
+        self.targets = targets
+        self.per_contig = per_contig
+        self.concurrent = concurrent
         self.kwargs = kwargs
 
     def create_bind_mounts(self):
@@ -128,62 +369,540 @@ class PolishAssembly(Polisher):
         """
         return ",".join(set([os.path.dirname(self.bam), os.path.dirname(self.contigs), self.out_dir]))
 
-    def polish_assembly(self):
-        """Run pilon on the assembly
+    def polish_assembly(self, recoverable: Tuple[type, ...] = ()):
+        """Run pilon on the assembly, failures of the recoverable types are raised to the caller
         """
-        pilon_exc = Executor(prog="Pilon", bind_mounts=self.create_bind_mounts(), 
+        if self.shards > 1 or self.targets is not None or self.per_contig:
+            self.polish_sharded(recoverable)
+            return
+        pilon_exc = Executor(prog="Pilon", bind_mounts=self.create_bind_mounts(), context=self.context,
                             contigs=self.contigs, bam_file=self.bam, out_dir=self.out_dir, 
                             output=self.output_prefix, ram=self.ram, **self.kwargs)
-        pilon_exc.execute()
+        self.context.submit(pilon_exc, recoverable=recoverable)
+
+    def running_steps(self) -> int:
+        """Steps the workflow engine runs at once, None without one
+        """
+        return self.context.engine.jobs if self.context.engine is not None else None
+
+    def polish_sharded(self, recoverable: Tuple[type, ...] = ()):
+        """Run a Pilon process per group of contigs concurrently then merge their outputs
+        """
+        lengths = contig_lengths(self.contigs)
+        contig_order = list(lengths)
+        if self.targets is not None:
+            lengths = {i: lengths[i] for i in contig_order if i in set(self.targets)}
+        if not lengths:
+            print("No contigs to polish, copying the assembly unchanged", flush=True)
+            self.merge_shards([], [], contig_order)
+            return
+        groups = [[i] for i in lengths] if self.per_contig else partition_contigs(lengths, self.shards)
+        concurrent = min(len(groups), self.concurrent or self.running_steps() or len(groups))
+        shard_out = os.path.join(self.out_dir, f"{self.output_prefix}_{self.shard_dir}")
+        if not os.path.isdir(shard_out):
+            os.mkdir(shard_out)
+        kwargs = dict(self.kwargs)
+        threads = max(1, (kwargs.pop("threads", None) or 1) // concurrent)
+        heap = max(1, self.ram // concurrent)
+        print(f"Polishing {len(lengths)} contigs in {len(groups)} shards with -Xmx{heap}G each", flush=True)
+        bind_mounts = ",".join(set([os.path.dirname(self.bam), os.path.dirname(self.contigs), shard_out]))
+        shard_prefixes = []
+        executors = []
+        for idx, group in enumerate(groups):
+            shard_prefix = f"{self.output_prefix}_shard{idx}"
+            targets = os.path.join(shard_out, f"{shard_prefix}{self.targets_ext}")
+            with open(targets, "w") as target_list:
+                target_list.write("".join(f"{i}\n" for i in group))
+            shard_prefixes.append(os.path.join(shard_out, shard_prefix))
+            executors.append(Executor(prog="Pilon", bind_mounts=bind_mounts, context=self.context, contigs=self.contigs, bam_file=self.bam,
+                                      out_dir=shard_out, output=shard_prefix, ram=heap, threads=threads,
+                                      targets=targets, **kwargs))
+        if self.context.engine is not None:
+            for executor in executors:
+                self.context.submit(executor)
+            self.context.flush(recoverable)
+        else:
+            with ThreadPoolExecutor(max_workers=concurrent) as pool:
+                list(pool.map(lambda i: i.execute(recoverable), executors))
+        self.merge_shards(shard_prefixes, groups, contig_order)
+
+    def merge_shards(self, shard_prefixes: List[str], groups: List[List[str]], contig_order: List[str]):
+        """Merge the fasta, changes and vcf output of each shard in the original contig order, contigs
+        not assigned to any shard are taken from the input assembly
+        """
+        order = {name: idx for idx, name in enumerate(contig_order)}
+        owner = {name: shard for shard, group in enumerate(groups) for name in group}
+        output = os.path.join(self.out_dir, self.output_prefix)
+
+        def polished_contigs(shard):
+            for name, seq in read_fasta(f"{shard_prefixes[shard]}{self.assembly_ext}"):
+                contig = name[:-len(PilonChanges.pilon_suffix)] if name.endswith(PilonChanges.pilon_suffix) else name
+                if owner.get(contig) == shard:
+                    yield order[contig], (name, seq)
+
+        def unpolished_contigs():
+            for name, seq in read_fasta(self.contigs):
+                if name not in owner:
+                    yield order[name], (f"{name}{PilonChanges.pilon_suffix}", seq)
+
+        merged = list(heapq.merge(unpolished_contigs(), *[polished_contigs(i) for i in range(len(groups))], key=lambda i: i[0]))
+        if len(merged) != len(order):
+            print(f"Sharded Pilon output is missing {len(order) - len(merged)} contigs", flush=True)
+            sys.exit(-1)
+        write_fasta((record for _, record in merged), f"{output}{self.assembly_ext}")
+        self.merge_lines(shard_prefixes, self.changes_ext, f"{output}{self.changes_ext}", order, owner,
+                         lambda line: line.split()[0].rsplit(":", 1)[0])
+        self.merge_lines(shard_prefixes, self.vcf_ext, f"{output}{self.vcf_ext}", order, owner,
+                         lambda line: line.split("\t", 1)[0])
+
+    @staticmethod
+    def merge_lines(shard_prefixes: List[str], ext: str, output: str, order: Dict[str, int], owner: Dict[str, int], contig_of):
+        """Stream merge line based outputs ordered by contig, header lines of the first shard are kept
+        along with every shards ##contig lines
+        """
+        shard_files = [f"{i}{ext}" for i in shard_prefixes]
+        if not all(os.path.isfile(i) for i in shard_files):
+            return
+        if not shard_files:
+            open(output, "w").close()
+            return
+        handles = [open(i, "r") for i in shard_files]
+        header = []
+        contig_headers = []
+        for shard, handle in enumerate(handles):
+            for line in handle:
+                if not line.startswith("#"):
+                    break
+                if line.startswith("##contig="):
+                    contig_headers.append(line)
+                elif shard == 0:
+                    header.append(line)
+            handle.seek(0)
+
+        def records(shard, handle):
+            for line in handle:
+                if line.startswith("#") or not line.strip():
+                    continue
+                contig = contig_of(line)
+                if owner.get(contig) == shard:
+                    yield order[contig], line
+
+        with open(output, "w") as out:
+            out.writelines([i for i in header if not i.startswith("#CHROM")])
+            out.writelines(sorted(contig_headers, key=lambda i: order.get(i.split("ID=", 1)[-1].split(",")[0].rstrip(">\n"), len(order))))
+            out.writelines([i for i in header if i.startswith("#CHROM")])
+            for _, line in heapq.merge(*[records(i, j) for i, j in enumerate(handles)], key=lambda i: i[0]):
+                out.write(line)
+        for handle in handles:
+            handle.close()
+
+
+class Retention(StrEnum):
+    """Which iteration outputs are kept once polishing no longer needs them
+    """
+    keep_all = "keep-all"
+    keep_final = "keep-final"
+    keep_final_changes = "keep-final-plus-changes"
 
 
 class PolishWorkflow:
     """Call Pilon -> Minimap2 cycle for iterative pilon polishing
+
+    Unless every file is retained, an iterations alignments are deleted once the next iteration
+    starts and each assembly once the iteration polishing it has finished. The final iterations
+    assembly, changes and alignments are always kept, with keep-final-plus-changes so are the
+    changes of every iteration. Retained alignments can be stored as CRAM against the assembly
+    they were mapped to, which is then kept as well.
+
+    With liftover, iterations after the first lift the previous iterations alignments onto the
+    assembly it polished and only realign the read pairs near Pilon's edits, unless the edited
+    windows cover more than liftover_max_fraction of the assembly. The alignments of an iteration
+    are then kept until the next iteration has lifted them.
+
+    With a read cache the reads are decoded, checked and paired once into the cache and every
+    mapping reads them from there, as do later runs polishing the same reads.
     """
     sam_ext = ".sam"
     bam_ext = ".bam"
+    cram_ext = ".cram"
     assembly_ext = ".fasta"
+    changes_ext = ".changes"
+    vcf_ext = ".vcf"
+    regions_ext = ".active.bed"
+    report_ext = "_report.jsonl"
+    qc_ext = "_qc.tsv"
+    heap_growth = 2
+    liftover_max_fraction = 0.25
 
-    def __init__(self, contigs: str, ram: int, reads: List[str], out_dir: str, Polisher_: Polisher, Mapper_: Mapper, prefix: str, max_iter:int = 10):
+    def __init__(self, contigs: str, ram: int, reads: List[str], out_dir: str, Polisher_: Polisher, Mapper_: Mapper, prefix: str, max_iter:int = 10,
+                 piped: bool = True, min_changes: int = 0, resources: ResourceBudget = None, shards: int = 1, resume: bool = False,
+                 scheduler: ResourceScheduler = None, incremental: bool = False, container: bool = False, prometheus_dir: str = None,
+                 parallel_steps: int = None, step_timeout: float = None, target_depth: float = None,
+                 retention: Retention = Retention.keep_all, cram: bool = False, pilon_vcf: bool = False, scratch: str = None,
+                 cluster: SlurmCluster = None, liftover: bool = False, liftover_flank: int = 200, read_cache: ReadCache = None):
         self.Iteration = 0
-        self.ram = ram
+        self.resources = resources if resources is not None else ResourceBudget(pilon_ram=ram)
+        self.ram = self.resources.pilon_heap
         self.max_iter = max_iter
         self.prefix = prefix
         self.mapping_string = "{prefix}_{iteration}{ext}"
         self.assembly_string = "{prefix}_{iteration}"
         self.contigs = contigs
+        self.draft = os.path.abspath(contigs)
         self.reads = reads
-        self.out_dir = out_dir
+        self.downsampled = []
+        self.out_dir = os.path.abspath(out_dir)
+        os.makedirs(self.out_dir, exist_ok=True)
         self.Polisher = Polisher_
         self.Mapper = Mapper_
-        self.polish_till_endpoint()
+        self.piped = piped
+        self.shards = shards
+        self.incremental = incremental
+        self.retention = Retention(retention)
+        self.cram = cram
+        self.pilon_vcf = pilon_vcf
+        self.frozen = set()
+        self.heap_estimates: List[HeapEstimate] = []
+        self.pilon_heap_floor = 0
+        self.pilon_per_contig = False
+        self.qc: List[ContigQC] = []
+        self.resume = resume
+        self.scheduler = scheduler
+        self.container = container
+        self.prometheus = os.path.join(prometheus_dir, f"pilonpolisher_{self.prefix}.prom") if prometheus_dir is not None else None
+        self.parallel_steps = parallel_steps if parallel_steps is not None else shards
+        self.step_timeout = step_timeout
+        self.target_depth = target_depth
+        self.liftover = liftover
+        self.liftover_flank = liftover_flank
+        self.cluster = cluster
+        self.read_cache = read_cache
+        self.convergence = ConvergenceTracker(min_changes=min_changes)
+        if scratch is not None and resume:
+            # a fresh scratch directory holds none of the previous run's outputs or cache records
+            print(f"Not working in scratch directory {scratch} as --resume needs the outputs kept in {self.out_dir}", flush=True)
+            scratch = None
+        if scratch is None:
+            self.run()
+            return
+        destination = self.out_dir
+        with ScratchSpace(scratch, self.prefix, exclude=[StepCache.cache_dir_name]) as space:
+            self.out_dir = space.work_dir
+            self.run(space)
+            space.sync(destination)
+            self.final_assembly = space.final_path(self.final_assembly, destination)
+            self.report.report = space.final_path(self.report.report, destination)
+        self.out_dir = destination
+
+    def run(self, scratch: ScratchSpace = None):
+        """Polish in out_dir, staging the contigs and reads into scratch first when given one. Reads
+        are downsampled before staging so deep read sets are only read over the network once, reads
+        taken from the read cache are left where they are
+        """
+        self.report = RunReport(os.path.join(self.out_dir, f"{self.prefix}{self.report_ext}"), sample=self.prefix, prometheus=self.prometheus,
+                                resume=self.resume)
+        self.context = ExecutionContext(cache=StepCache(self.out_dir, resume=self.resume), scheduler=self.scheduler, report=self.report,
+                                        cluster=self.cluster)
+        self.context.engine = WorkflowEngine(self.context, jobs=self.parallel_steps, timeout=self.step_timeout)
+        self.qc_table = os.path.join(self.out_dir, f"{self.prefix}{self.qc_ext}")
+        if os.path.isfile(self.qc_table) and not self.resume:
+            os.remove(self.qc_table)
+        print(self.resources.describe(), flush=True)
+        with ExitStack() as cached:
+            if self.read_cache is not None:
+                self.reads = cached.enter_context(self.read_cache.use(self.reads))
+            if self.target_depth:
+                self.reads = self.downsample_reads(self.target_depth)
+            if scratch is not None:
+                self.contigs = scratch.stage(self.contigs)
+                self.reads = [i if self.read_cache is not None and self.read_cache.contains(i) else scratch.stage(i) for i in self.reads]
+            self.read_length = sample_read_length(self.reads) if self.resources.pilon_ram is None else None
+            if not self.container:
+                self.polish_till_endpoint()
+            else:
+                bind_paths = [os.path.dirname(os.path.abspath(i)) for i in [self.draft, self.contigs, *self.reads]]
+                with ContainerInstance([*bind_paths, self.out_dir]) as instance:
+                    self.context.instance = instance
+                    self.polish_till_endpoint()
+        if self.retention != Retention.keep_all:
+            self.remove_files(self.downsampled)
     
     def polish_till_endpoint(self):
-        """polish the assembly till a specified end point is reached
-        """
-        bam = self.map_reads(contigs=self.contigs, reads=self.reads, setting=Minimap2Settings.map_illumina, iteration=self.Iteration)
-        assembly = self.pilon_polish(contigs=self.contigs, bam=bam, iteration=self.Iteration)
-        self.Iteration += 1
-        # polish till a specified end point is reached, need to add in support for the vcf and changes from pilon
-        while(self.Iteration < self.max_iter):
-            bam = self.map_reads(contigs=assembly, reads=self.reads, setting=Minimap2Settings.map_illumina, iteration=self.Iteration)
-            assembly = self.pilon_polish(contigs=assembly, bam=bam, iteration=self.Iteration)
-            if os.path.isfile(assembly):
-                print(f"{assembly} exists")
-            else:
-                print(f"Assembly ({assembly}) does not exist")
-                sys.exit(-1)
+        """polish the assembly till a specified end point is reached, when resuming from the last
+        iteration a previous run finished
+        """
+        assembly, converged = self.resume_iterations() if self.resume else (None, False)
+        if assembly is None:
+            self.context.iteration = self.Iteration
+            bam = self.map_reads(contigs=self.contigs, reads=self.reads, setting=Minimap2Settings.map_illumina, iteration=self.Iteration)
+            assembly = self.pilon_polish(contigs=self.contigs, bam=bam, iteration=self.Iteration)
+            converged = self.finish_iteration(assembly)
+            self.Iteration += 1
+        # polish till the changes made by pilon converge or the iteration limit is reached
+        while(not converged and self.Iteration < self.max_iter):
+            self.context.iteration = self.Iteration
+            active = self.active_contigs(assembly)
+            bam = self.map_reads(contigs=assembly, reads=self.reads, setting=Minimap2Settings.map_illumina, iteration=self.Iteration,
+                                 active=active)
+            assembly = self.pilon_polish(contigs=assembly, bam=bam, iteration=self.Iteration,
+                                         targets=list(active) if active is not None else None)
+            converged = self.finish_iteration(assembly)
             self.Iteration += 1
+        self.final_assembly = assembly
+
+    def finished_iterations(self) -> List[int]:
+        """Iterations a previous run wrote QC rows for, which happens once their assembly is complete
+        """
+        if not os.path.isfile(self.qc_table):
+            return []
+        with open(self.qc_table, "r") as table:
+            next(table, None)
+            return sorted({int(i.split("\t", 1)[0]) for i in table if i.strip()})
+
+    def resume_iterations(self) -> Tuple[str, bool]:
+        """Continue from the last finished iteration whose assembly and changes were retained, as the
+        step cache can only skip steps whose outputs were kept. The changes of the earlier iterations
+        still present are replayed to restore the convergence state
+        """
+        resumed = None
+        for iteration in reversed(self.finished_iterations()):
+            assembly = os.path.join(self.out_dir, self.assembly_string.format(prefix=self.prefix, iteration=iteration))
+            if iteration < self.max_iter and os.path.isfile(f"{assembly}{self.assembly_ext}") and os.path.isfile(f"{assembly}{self.changes_ext}"):
+                resumed = iteration
+                break
+        self.trim_qc_table(resumed)
+        if resumed is None:
+            return None, False
+        assembly = f"{assembly}{self.assembly_ext}"
+        converged = False
+        for iteration in range(resumed + 1):
+            changes = os.path.join(self.out_dir, self.assembly_string.format(prefix=self.prefix, iteration=iteration) + self.changes_ext)
+            if os.path.isfile(changes):
+                self.Iteration = iteration
+                converged = self.converged(iteration)
+                self.freeze_contigs(assembly)
+        self.Iteration = resumed + 1
+        print(f"Resuming after iteration {resumed} from {assembly}", flush=True)
+        return assembly, converged
+
+    def trim_qc_table(self, last_iteration: int = None):
+        """Drop the QC rows after the iteration being resumed from, or the whole table when starting over
+        """
+        if not os.path.isfile(self.qc_table):
+            return
+        if last_iteration is None:
+            os.remove(self.qc_table)
+            return
+        with open(self.qc_table, "r") as table:
+            lines = table.readlines()
+        with open(self.qc_table, "w") as table:
+            table.writelines(lines[:1] + [i for i in lines[1:] if i.strip() and int(i.split("\t", 1)[0]) <= last_iteration])
+
+    def downsample_reads(self, target_depth: float) -> List[str]:
+        """Downsample the reads once to the target depth over the draft assembly, every iteration then
+        maps the downsampled reads. Reads from the read cache stay uncompressed once downsampled
+        """
+        downsampler = ReadDownsampler(self.reads, genome_size=sum(contig_lengths(self.contigs).values()), out_dir=self.out_dir,
+                                      prefix=self.prefix, target_depth=target_depth, cache=self.context.cache,
+                                      compress=self.read_cache is None or self.read_cache.bgzf)
+        reads = downsampler.downsample()
+        if reads != downsampler.reads:
+            self.downsampled = reads
+        return reads
 
-    def pilon_polish(self, contigs, bam, iteration):
+    def alignment_files(self, iteration) -> List[str]:
+        """Alignments made in an iteration and the files derived from them
+        """
+        bam = os.path.join(self.out_dir, self.mapping_string.format(prefix=self.prefix, iteration=iteration, ext=self.bam_ext))
+        files = [os.path.join(self.out_dir, self.mapping_string.format(prefix=self.prefix, iteration=iteration, ext=self.sam_ext)),
+                 bam, f"{bam}.bai", f"{bam}.idxstats",
+                 os.path.join(self.out_dir, self.mapping_string.format(prefix=self.prefix, iteration=iteration, ext=self.regions_ext))]
+        index = self.Mapper.index_prefix(bam)
+        if index is not None:
+            files.extend(glob.glob(f"{glob.escape(index)}.*"))
+        return files
+
+    def assembly_files(self, iteration, keep_reference: bool = False) -> List[str]:
+        """Pilon outputs of an iteration that may be deleted under the retention policy
+        """
+        prefix = os.path.join(self.out_dir, self.assembly_string.format(prefix=self.prefix, iteration=iteration))
+        files = [f"{prefix}{self.vcf_ext}", f"{prefix}_{PolishAssembly.shard_dir}"]
+        if not keep_reference:
+            files.extend([f"{prefix}{self.assembly_ext}", f"{prefix}{self.assembly_ext}.fai"])
+        if self.retention != Retention.keep_final_changes:
+            files.append(f"{prefix}{self.changes_ext}")
+        return files
+
+    def reference(self, iteration) -> str:
+        """Assembly the reads of an iteration were mapped to
+        """
+        if iteration == 0:
+            return self.draft
+        return os.path.join(self.out_dir, self.assembly_string.format(prefix=self.prefix, iteration=iteration - 1) + self.assembly_ext)
+
+    def compress_alignments(self, iteration):
+        """Replace an iterations bam with a CRAM referenced against the assembly it was mapped to
+        """
+        bam = os.path.join(self.out_dir, self.mapping_string.format(prefix=self.prefix, iteration=iteration, ext=self.bam_ext))
+        cram = os.path.join(self.out_dir, self.mapping_string.format(prefix=self.prefix, iteration=iteration, ext=self.cram_ext))
+        reference = self.reference(iteration)
+        bind_mounts = ",".join(set([self.out_dir, os.path.dirname(reference)]))
+        self.context.submit(Executor("Samtools", bind_mounts, "view", "-C", "-T", reference, "-@", str(self.resources.threads), "-o", cram, bam,
+                                     context=self.context, inputs=[bam, reference], outputs=[cram], threads=self.resources.threads))
+        self.context.submit(Executor("Samtools", bind_mounts, "index", cram, context=self.context, inputs=[cram], outputs=[f"{cram}.crai"]))
+        self.context.flush()
+        self.remove_files([bam, f"{bam}.bai"])
+
+    def retain_outputs(self, iteration, final: bool):
+        """Delete the files of earlier iterations nothing downstream needs anymore
+        """
+        if self.cram and (final or self.retention == Retention.keep_all):
+            self.compress_alignments(iteration)
+        if self.retention == Retention.keep_all:
+            return
+        if self.liftover:
+            # the next iteration lifts these alignments over, so the previous iterations go instead
+            removed = self.alignment_files(iteration - 1) if iteration > 0 else []
+        else:
+            removed = [] if final else self.alignment_files(iteration)
+        if iteration > 0:
+            removed.extend(self.assembly_files(iteration - 1, keep_reference=final and self.cram))
+        self.remove_files(removed)
+
+    @staticmethod
+    def remove_files(paths: List[str]):
+        removed = 0
+        freed = 0
+        for path in paths:
+            if os.path.isdir(path):
+                freed += sum(os.path.getsize(os.path.join(root, i)) for root, _, files in os.walk(path) for i in files)
+                shutil.rmtree(path)
+            elif os.path.isfile(path):
+                freed += os.path.getsize(path)
+                os.remove(path)
+            else:
+                continue
+            removed += 1
+        if removed:
+            print(f"Removed {removed} intermediate files, {freed / 1e6:.1f}MB freed", flush=True)
+
+    def finish_iteration(self, assembly) -> bool:
+        """Check convergence, record QC and remove files no longer needed once an iteration is polished
+        """
+        converged = self.converged(self.Iteration)
+        self.freeze_contigs(assembly)
+        self.iteration_qc(self.Iteration)
+        self.retain_outputs(self.Iteration, final=converged or self.Iteration + 1 >= self.max_iter)
+        self.summarise_iteration()
+        return converged
+
+    def iteration_qc(self, iteration):
+        """Append per contig metrics from an iterations changes, and VCF when Pilon wrote one, to the QC table
+        """
+        prefix = os.path.join(self.out_dir, self.assembly_string.format(prefix=self.prefix, iteration=iteration))
+        qc = PilonQC(iteration)
+        for name in contig_lengths(f"{prefix}{self.assembly_ext}"):
+            qc.contig(name) # contigs pilon left unchanged still get a row
+        qc.add_changes(f"{prefix}{self.changes_ext}")
+        if os.path.isfile(f"{prefix}{self.vcf_ext}"):
+            qc.add_vcf(f"{prefix}{self.vcf_ext}")
+        qc.write(self.qc_table)
+        self.qc.append(qc.total())
+        print(qc.describe(), flush=True)
+
+    def summarise_iteration(self):
+        print(f"Iteration {self.Iteration} steps:\n{self.report.summary(self.Iteration)}", flush=True)
+
+    def freeze_contigs(self, assembly):
+        """In incremental mode contigs that pilon made no changes to are not polished again
+        """
+        if not self.incremental:
+            return
+        edited = self.convergence.history[-1].per_contig()
+        for name in contig_lengths(assembly):
+            contig = PilonChanges.base_contig(name)
+            if contig not in edited:
+                self.frozen.add(contig)
+        print(f"{len(self.frozen)} contigs frozen after iteration {self.Iteration}", flush=True)
+
+    def active_contigs(self, assembly) -> Dict[str, int]:
+        """Lengths of the contigs in an assembly still being polished, None when every contig is
+        """
+        if not self.frozen:
+            return None
+        lengths = contig_lengths(assembly)
+        return {i: j for i, j in lengths.items() if PilonChanges.base_contig(i) not in self.frozen}
+
+    def converged(self, iteration):
+        """Check the changes pilon made in an iteration to determine if polishing should stop
+        """
+        changes = os.path.join(self.out_dir, self.assembly_string.format(prefix=self.prefix, iteration=iteration) + self.changes_ext)
+        return self.convergence.update(changes, iteration)
+
+    def fit_pilon_heap(self, contigs, bam, targets: List[str] = None) -> int:
+        """Size the Pilon heap from the polished contigs lengths and the reads mapped to them, unless
+        a heap size was given
+        """
+        if self.resources.pilon_ram is not None:
+            return self.resources.pilon_ram
+        idxstats = f"{bam}.idxstats"
+        stats = Executor("Samtools", os.path.dirname(os.path.abspath(bam)), "idxstats", bam, context=self.context,
+                         inputs=[bam, f"{bam}.bai"], stdout=idxstats)
+        self.context.submit(stats)
+        self.context.flush()
+        mapped = parse_idxstats(idxstats)
+        lengths = contig_lengths(contigs)
+        if targets is not None:
+            lengths = {i: lengths[i] for i in targets}
+        estimate = HeapEstimate(genome_size=sum(lengths.values()), mapped_reads=sum(mapped.get(i, 0) for i in lengths),
+                                read_length=self.read_length)
+        self.heap_estimates.append(estimate)
+        print(estimate.describe(), flush=True)
+        return self.resources.fit_heap(estimate)
+
+    def pilon_polish(self, contigs, bam, iteration, targets: List[str] = None):
         """Run pilon to polish assemblies
+
+        When Pilon runs out of memory it is run again on the same alignments, first with the heap
+        grown up to the memory budget and then with a Pilon process per contig sharing that heap
+        between the processes run at once. Later iterations start from whatever finally worked.
         """
         prefix = self.assembly_string.format(prefix=self.prefix, iteration=iteration)
-        polish_data = PolishAssembly(contigs=contigs, bam=bam, output_prefix=prefix, out_dir=os.getcwd(), ram=self.ram)
-        polish_data.polish_assembly()
-        return f"{prefix}{self.assembly_ext}"
+        ram = max(self.fit_pilon_heap(contigs, bam, targets), self.pilon_heap_floor)
+        # finish the mapping first so only Pilon's own failures are retried
+        self.context.flush()
+        budget = max(self.resources.memory, ram)
+        polishing = len(targets) if targets is not None else len(contig_lengths(contigs))
+        per_contig = self.pilon_per_contig
+        while True:
+            polish_data = self.Polisher(contigs=contigs, bam=bam, output_prefix=prefix, out_dir=self.out_dir, ram=ram,
+                                        shards=self.shards, context=self.context, targets=targets, threads=self.resources.pilon_threads,
+                                        vcf=self.pilon_vcf, per_contig=per_contig, concurrent=self.parallel_steps if per_contig else None)
+            try:
+                polish_data.polish_assembly(recoverable=(OutOfMemoryFailure,))
+                self.context.flush(recoverable=(OutOfMemoryFailure,))
+                break
+            except OutOfMemoryFailure as failure:
+                print(failure.describe(), flush=True)
+                if ram < budget:
+                    ram = min(budget, ram * self.heap_growth)
+                    self.pilon_heap_floor = ram
+                    print(f"Retrying Pilon for iteration {iteration} with a {ram}G heap", flush=True)
+                elif not per_contig and polishing > 1:
+                    per_contig = True
+                    self.pilon_per_contig = True
+                    print(f"Retrying Pilon for iteration {iteration} with a process per contig, "
+                          f"{min(polishing, self.parallel_steps)} at once sharing {ram}G", flush=True)
+                else:
+                    print(f"Pilon ran out of memory within the {budget}G budget, increase --memory", flush=True)
+                    sys.exit(-1)
+        assembly = os.path.join(self.out_dir, f"{prefix}{self.assembly_ext}")
+        if not os.path.isfile(assembly):
+            print(f"Pilon did not write the polished assembly {assembly}", flush=True)
+            sys.exit(-1)
+        return assembly
 
-    def map_reads(self, contigs, reads, setting: Minimap2Settings, iteration):
+    def map_reads(self, contigs, reads, setting: Minimap2Settings, iteration, active: Dict[str, int] = None):
         """_summary_
 
         Args:
@@ -191,25 +910,180 @@ class PolishWorkflow:
             reads (_type_): _description_
             setting (_type_): _description_
             output_name (_type_): _description_
+            active: lengths of the contigs still being polished, alignments to other contigs are dropped
         """
-        mapping_sam = self.mapping_string.format(prefix=self.prefix, iteration=iteration, ext=self.sam_ext)
-        mapping = self.Mapper(contigs=contigs, reads=reads, output_name=mapping_sam, mapping_setting=setting)
+        regions = None
+        if active is not None:
+            regions = os.path.join(self.out_dir, self.mapping_string.format(prefix=self.prefix, iteration=iteration, ext=self.regions_ext))
+            with open(regions, "w") as bed:
+                bed.write("".join(f"{i}\t0\t{j}\n" for i, j in active.items()))
+        if self.liftover and iteration > 0:
+            lifted = self.lift_alignments(contigs, iteration, regions)
+            if lifted is not None:
+                return lifted
+        if self.piped:
+            mapping_bam = os.path.join(self.out_dir, self.mapping_string.format(prefix=self.prefix, iteration=iteration, ext=self.bam_ext))
+            mapping = self.Mapper(contigs=contigs, reads=reads, output_name=None, mapping_setting=setting, resources=self.resources, context=self.context)
+            mapping.map_reads_sorted(mapping_bam, regions=regions)
+            return mapping_bam
+        mapping_sam = os.path.join(self.out_dir, self.mapping_string.format(prefix=self.prefix, iteration=iteration, ext=self.sam_ext))
+        mapping = self.Mapper(contigs=contigs, reads=reads, output_name=mapping_sam, mapping_setting=setting, resources=self.resources, context=self.context)
         mapping.map_reads()
-        mapping_bam = self.mapping_string.format(prefix=self.prefix, iteration=iteration, ext=self.bam_ext)
+        mapping_bam = os.path.join(self.out_dir, self.mapping_string.format(prefix=self.prefix, iteration=iteration, ext=self.bam_ext))
         samtools_bind_paths = ",".join([os.path.dirname(os.path.abspath(mapping_sam))])
-        convert_to_bam = Executor("Samtools", samtools_bind_paths, "view", "-bu", "-o", mapping_bam, mapping_sam)
-        convert_to_bam.execute()
+        threads = ["-@", str(self.resources.threads)]
+        region_args = ["-L", regions] if regions is not None else []
+        convert_to_bam = Executor("Samtools", samtools_bind_paths, "view", *threads, *region_args, "-bu", "-o", mapping_bam, mapping_sam,
+                                  context=self.context, inputs=[mapping_sam, *region_args[1:]], outputs=[mapping_bam], threads=self.resources.threads)
+        self.context.submit(convert_to_bam)
         #sort
-        sort_bam = Executor("Samtools", samtools_bind_paths, "sort", "-o", mapping_bam, mapping_bam)
-        sort_bam.execute()
+        sort_bam = Executor("Samtools", samtools_bind_paths, "sort", *self.resources.sort_args(), "-o", mapping_bam, mapping_bam,
+                            context=self.context, inputs=[mapping_bam], outputs=[mapping_bam], threads=self.resources.sort_threads,
+                            memory=self.resources.sort_memory)
+        self.context.submit(sort_bam)
         #index
-        index_bam = Executor("Samtools", samtools_bind_paths, "index", mapping_bam)
-        index_bam.execute()
+        index_bam = Executor("Samtools", samtools_bind_paths, "index", *threads, mapping_bam,
+                             context=self.context, inputs=[mapping_bam], outputs=[f"{mapping_bam}.bai"], threads=self.resources.threads)
+        self.context.submit(index_bam)
         return mapping_bam
 
 
+    def previous_alignments(self, iteration) -> str:
+        """Indexed alignments of the previous iteration, None once they have been removed
+        """
+        for ext, index_ext in [(self.bam_ext, ".bai"), (self.cram_ext, ".crai")]:
+            alignments = os.path.join(self.out_dir, self.mapping_string.format(prefix=self.prefix, iteration=iteration - 1, ext=ext))
+            if os.path.isfile(alignments) and os.path.isfile(f"{alignments}{index_ext}"):
+                return alignments
+        return None
+
+    def lift_alignments(self, assembly, iteration, regions: str = None) -> str:
+        """Lift the previous iterations alignments onto the assembly Pilon polished from them, realign
+        the read pairs near its edits and merge both into a sorted and indexed bam. None when lifting
+        would not save time or the previous alignments are gone
+        """
+        previous = self.previous_alignments(iteration)
+        if previous is None or self.container:
+            return None
+        changes = os.path.join(self.out_dir, self.assembly_string.format(prefix=self.prefix, iteration=iteration - 1) + self.changes_ext)
+        edits = EditMap(changes, self.liftover_flank)
+        fraction = edits.window_bases() / max(1, sum(contig_lengths(assembly).values()))
+        if fraction > self.liftover_max_fraction:
+            print(f"Edits of iteration {iteration - 1} cover {fraction:.0%} of the assembly, remapping every read", flush=True)
+            return None
+        print(f"Lifting iteration {iteration - 1} alignments over, realigning reads within {self.liftover_flank}bp of an edit "
+              f"({fraction:.2%} of the assembly)", flush=True)
+
+        def output(ext):
+            return os.path.join(self.out_dir, self.mapping_string.format(prefix=self.prefix, iteration=iteration, ext=ext))
+        bam = output(self.bam_ext)
+        header, windows, affected = output("_previous_header.sam"), output(".edited.bed"), output("_affected.sam")
+        lifted, realigned = output("_lifted.bam"), output("_realigned.bam")
+        reads_out = [output("_realign_R1.fastq"), output("_realign_R2.fastq")]
+        reference = ["-T", self.reference(iteration - 1)] if previous.endswith(self.cram_ext) else []
+        bind_mounts = ",".join(set([self.out_dir, os.path.dirname(os.path.abspath(assembly))]))
+        self.context.submit(Executor("Samtools", bind_mounts, "view", "-H", "-o", header, previous, context=self.context,
+                                     inputs=[previous], outputs=[header]))
+        self.context.flush()
+        with open(header, "r") as sam_header:
+            fields = [dict(i.split(":", 1) for i in line.rstrip("\n").split("\t")[1:]) for line in sam_header if line.startswith("@SQ")]
+        edits.write_bed([i["SN"] for i in fields], windows)
+        self.context.submit(Executor("Samtools", bind_mounts, "view", *reference, "-L", windows, "-o", affected, previous,
+                                     context=self.context, inputs=[previous, windows], outputs=[affected]))
+        self.context.submit(Executor("Samtools", bind_mounts, "view", "-h", *reference, previous, context=self.context, inputs=[previous]),
+                            Executor("LiftOver", bind_mounts, context=self.context, changes=changes, assembly=assembly, affected=affected,
+                                     flank=self.liftover_flank, reads_out=reads_out, active=regions),
+                            Executor("Samtools", bind_mounts, "view", "-b", "-o", lifted, "-", context=self.context, outputs=[lifted]))
+        mapping = self.Mapper(contigs=assembly, reads=reads_out, output_name=None, mapping_setting=Minimap2Settings.map_illumina,
+                              resources=self.resources, context=self.context)
+        mapping.map_reads_sorted(realigned, regions=regions)
+        self.context.submit(Executor("Samtools", bind_mounts, "merge", "-f", "-@", str(self.resources.threads), "--write-index",
+                                     "-o", f"{bam}##idx##{bam}.bai", lifted, realigned, context=self.context, inputs=[lifted, realigned],
+                                     outputs=[bam, f"{bam}.bai"], threads=self.resources.threads))
+        self.context.flush()
+        index = self.Mapper.index_prefix(realigned)
+        self.remove_files([header, windows, affected, lifted, realigned, f"{realigned}.bai", *reads_out,
+                           *(glob.glob(f"{glob.escape(index)}.*") if index is not None else [])])
+        return bam
+
+
+class PolishBatch:
+    """Polish many samples at once, every step of every sample is admitted through one scheduler
+    so concurrent Pilon JVMs and sorts cannot oversubscribe the node
+
+    Each sample is polished in its own directory named after its prefix within out_dir.
+    """
+    sample_fields = ["contigs", "r1", "r2", "prefix"]
+
+    def __init__(self, samples: List[Dict[str, str]], out_dir: str, scheduler: ResourceScheduler, jobs: int, **workflow_kwargs):
+        self.samples = samples
+        self.out_dir = os.path.abspath(out_dir)
+        self.scheduler = scheduler
+        self.jobs = max(1, jobs)
+        self.workflow_kwargs = workflow_kwargs
+        self.failed = []
+
+    @classmethod
+    def read_sample_sheet(cls, sample_sheet: str) -> List[Dict[str, str]]:
+        """Read a tab or comma separated sample sheet with a header of contigs, r1, r2 and prefix,
+        relative paths are resolved against the directory of the sample sheet
+        """
+        sheet_dir = os.path.dirname(os.path.abspath(sample_sheet))
+        with open(sample_sheet, "r", newline="") as sheet:
+            header = sheet.readline()
+            sheet.seek(0)
+            rows = list(csv.DictReader(sheet, delimiter="\t" if "\t" in header else ","))
+        samples = []
+        for row in rows:
+            missing = [i for i in cls.sample_fields if not row.get(i)]
+            if missing:
+                print(f"Sample sheet {sample_sheet} row {row} is missing {', '.join(missing)}", flush=True)
+                sys.exit(-1)
+            sample = {i: row[i].strip() for i in cls.sample_fields}
+            for field in ["contigs", "r1", "r2"]:
+                sample[field] = os.path.join(sheet_dir, sample[field])
+            samples.append(sample)
+        prefixes = [i["prefix"] for i in samples]
+        if len(set(prefixes)) != len(prefixes):
+            print(f"Sample sheet {sample_sheet} contains duplicate prefixes", flush=True)
+            sys.exit(-1)
+        return samples
+
+    def polish_sample(self, sample: Dict[str, str]):
+        try:
+            PolishWorkflow(contigs=sample["contigs"], reads=[sample["r1"], sample["r2"]], prefix=sample["prefix"],
+                           out_dir=os.path.join(self.out_dir, sample["prefix"]), scheduler=self.scheduler, **self.workflow_kwargs)
+        except SystemExit:
+            print(f"Polishing failed for sample {sample['prefix']}", flush=True)
+            self.failed.append(sample["prefix"])
+
+    def polish_samples(self):
+        # samples run on worker threads which cannot handle signals, so scratch is cleaned from here
+        with exit_on_termination(), ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            list(pool.map(self.polish_sample, self.samples))
+        self.report_failures()
+
+    def submit_samples(self, cluster: SlurmCluster, command: List[str]):
+        """Polish each sample as a task of one SLURM job array, at most jobs tasks running at once.
+        The command polishes the single sample whose index it is given after --sample-index
+        """
+        resources = self.workflow_kwargs.get("resources") or ResourceBudget()
+        job = cluster.submit("pilonpolisher_batch", [f'{shell_command([command])} --sample-index "$SLURM_ARRAY_TASK_ID"'],
+                             threads=resources.threads, memory=max(resources.memory, resources.pilon_ram or 0), tasks=len(self.samples), max_running=self.jobs)
+        cluster.wait([job])
+        for idx, task_id in enumerate(job.task_ids()):
+            if task_id in job.failed():
+                print(f"Polishing failed for sample {self.samples[idx]['prefix']} in SLURM {job.describe(task_id)}", flush=True)
+                self.failed.append(self.samples[idx]["prefix"])
+        self.report_failures()
+
+    def report_failures(self):
+        if self.failed:
+            print(f"{len(self.failed)} of {len(self.samples)} samples failed: {', '.join(self.failed)}", flush=True)
+            sys.exit(-1)
+
+
 if __name__ == "__main__":
-    #TODO need to add in BWA-MEM
     workflow_start = PolishWorkflow(contigs=sys.argv[1], reads=[sys.argv[2], sys.argv[3]], out_dir=os.getcwd(), 
                                     Polisher_=PolishAssembly, Mapper_=IdxMapReads, max_iter=4, prefix="test")
 
@@ -0,0 +1,90 @@
+"""Content addressed cache of completed steps so interrupted runs can resume
+
+A step is keyed by its command line, the version of the tool run and a cheap fingerprint of each
+input file. Once a step succeeds the fingerprints of its outputs are recorded under that key, a
+later run with the same key can skip the step as long as its outputs are unchanged.
+"""
+import os
+import json
+import hashlib
+import subprocess
+from functools import lru_cache
+from typing import Dict, List
+
+
+SAMPLE_SIZE = 1 << 16 # bytes hashed from the start, middle and end of a file
+
+
+def sampled_hash(path: str, size: int) -> str:
+    """Hash of the blocks at the start, middle and end of a file
+    """
+    sampled = hashlib.sha256()
+    with open(path, "rb") as data:
+        for offset in sorted({0, max(0, size // 2 - SAMPLE_SIZE // 2), max(0, size - SAMPLE_SIZE)}):
+            data.seek(offset)
+            sampled.update(data.read(SAMPLE_SIZE))
+    return sampled.hexdigest()
+
+
+def fingerprint(path: str) -> Dict:
+    """Size, modification time and a hash of three sampled blocks of a file
+    """
+    if not os.path.isfile(path):
+        return {"missing": True}
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sample": sampled_hash(path, stat.st_size)}
+
+
+@lru_cache(maxsize=None)
+def tool_version(command: tuple) -> str:
+    """First line a tool prints when asked for its version, probed once per process
+    """
+    try:
+        proc = subprocess.run(list(command), capture_output=True, text=True, timeout=60)
+    except (OSError, subprocess.TimeoutExpired):
+        return "unknown"
+    for line in (proc.stdout + proc.stderr).splitlines():
+        if line.strip():
+            return line.strip()
+    return "unknown"
+
+
+class StepCache:
+    """Record completed steps in a cache directory and, when resuming, report which can be skipped
+    """
+    cache_dir_name = ".pilonpolisher_cache"
+    record_ext = ".json"
+
+    def __init__(self, out_dir: str, resume: bool = False):
+        self.cache_dir = os.path.join(os.path.abspath(out_dir), self.cache_dir_name)
+        self.resume = resume
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(commands: List[List[str]], versions: List[str], inputs: List[str]) -> str:
+        step = {"commands": commands, "versions": versions,
+                "inputs": {os.path.abspath(i): fingerprint(i) for i in sorted(set(inputs))}}
+        return hashlib.sha256(json.dumps(step, sort_keys=True).encode()).hexdigest()
+
+    def record_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}{self.record_ext}")
+
+    def is_current(self, key: str, outputs: List[str]) -> bool:
+        """True when resuming and the outputs recorded for a key are present and unchanged
+        """
+        if not self.resume or not outputs or not os.path.isfile(self.record_path(key)):
+            return False
+        with open(self.record_path(key), "r") as record:
+            recorded = json.load(record)
+        return all(recorded.get(os.path.abspath(i)) == fingerprint(i) for i in outputs) \
+            and not any(fingerprint(i).get("missing") for i in outputs)
+
+    def record(self, key: str, outputs: List[str]):
+        """Store the fingerprints of a completed steps outputs, written atomically
+        """
+        if not outputs:
+            return
+        tmp_record = f"{self.record_path(key)}.tmp"
+        with open(tmp_record, "w") as record:
+            json.dump({os.path.abspath(i): fingerprint(i) for i in outputs}, record)
+        os.replace(tmp_record, self.record_path(key))
@@ -6,7 +6,15 @@
 import argparse
 import sys
 import os
-from Workflows import PolishAssembly, IdxMapReads, PolishWorkflow
+from Workflows import PolishAssembly, IdxMapReads, PolishWorkflow, PolishBatch, Retention, MAPPERS, AssembleLongReads, ContigConsensus
+from mapper_benchmark import MapperBenchmark, AUTO
+from resources import ResourceBudget, available_threads
+from scheduler import ResourceScheduler
+from slurm import SlurmCluster
+from read_cache import ReadCache
+from cache import StepCache
+from tools import ExecutionContext
+from engine import WorkflowEngine
 
 
 class Main:
@@ -14,10 +22,24 @@ class Main:
     """
     max_iter_default = 4
     default_ram = 4
+    target_depth_default = 0
+    read_cache_size_default = 100
+    racon_chunks_default = 4
+    mapper_default = IdxMapReads.name
+    flye_dir = "flye"
+
+    batch_command = "batch"
+    slurm_steps = "steps"
+    slurm_samples = "samples"
+    slurm_log_dir = "slurm_logs"
 
     def __init__(self, args, **kwargs) -> None:
         self.args = args[1:]
         self.kwargs = kwargs
+        if self.args and self.args[0] == self.batch_command:
+            self.out_args = self.batch_parser(self.args[1:])
+            self.polish_batch(self.out_args)
+            return
         self.out_args = self.cmd_parser(self.args)
         self.polish_assembly(self.out_args)
 
@@ -25,9 +47,194 @@ class Main:
         """Run the polishing workflow
             TODO improve outdir usage
         """
-        PolishWorkflow(contigs=params.contigs, reads=params.reads, out_dir=os.getcwd(), 
-                        Polisher_=PolishAssembly, Mapper_=IdxMapReads, max_iter=params.max_iter, 
-                        prefix=params.prefix, ram=params.ram)
+        if params.slurm == self.slurm_samples:
+            print(f"--slurm {self.slurm_samples} submits the samples of a {self.batch_command}, use --slurm {self.slurm_steps} for one sample", flush=True)
+            sys.exit(-1)
+        resources = ResourceBudget(threads=params.threads, memory=params.memory, pilon_ram=params.ram)
+        contigs = params.contigs
+        if params.long_reads:
+            contigs = self.long_read_consensus(params, resources)
+        PolishWorkflow(contigs=contigs, reads=params.reads, out_dir=os.getcwd(), prefix=params.prefix,
+                        resources=resources, **self.workflow_kwargs(params))
+
+    def long_read_consensus(self, params, resources):
+        """Polish the contigs with Racon and the long reads before Pilon, assembling the long reads
+        with Flye first when no contigs are given
+        """
+        context = ExecutionContext(cache=StepCache(os.getcwd(), resume=params.resume))
+        context.engine = WorkflowEngine(context, jobs=params.parallel_steps or params.racon_chunks, timeout=params.step_timeout)
+        contigs = params.contigs
+        if contigs is None:
+            contigs = AssembleLongReads(params.long_reads, os.path.join(os.getcwd(), self.flye_dir), context=context,
+                                        threads=resources.threads).run_flye()
+        if not params.racon_rounds:
+            return contigs
+        consensus = ContigConsensus(contigs, params.long_reads, out_dir=os.getcwd(), prefix=params.prefix, rounds=params.racon_rounds,
+                                    chunks=params.racon_chunks, concurrent=params.parallel_steps, resources=resources, context=context)
+        return consensus.polish()
+
+    def workflow_kwargs(self, params):
+        """Workflow options shared by single sample and batch polishing
+        """
+        return dict(Polisher_=PolishAssembly, Mapper_=self.select_mapper(params), max_iter=params.max_iter, ram=params.ram,
+                    min_changes=params.min_changes, shards=params.shards, resume=params.resume,
+                    incremental=params.incremental, container=params.container, prometheus_dir=params.prometheus_dir,
+                    parallel_steps=params.parallel_steps, step_timeout=params.step_timeout, target_depth=params.target_depth or None,
+                    retention=params.retention, cram=params.cram, pilon_vcf=params.pilon_vcf,
+                    scratch=None if params.no_scratch or params.slurm == self.slurm_steps else params.scratch,
+                    cluster=self.slurm_cluster(params) if params.slurm == self.slurm_steps else None,
+                    liftover=params.liftover, liftover_flank=params.liftover_flank, read_cache=self.read_cache(params))
+
+    def read_cache(self, params):
+        """Cache of preprocessed reads shared by every sample and run given the same directory
+        """
+        if params.read_cache is None:
+            return None
+        return ReadCache(params.read_cache, max_bytes=int(params.read_cache_size * 1e9), bgzf=params.read_cache_bgzf, threads=params.threads)
+
+    def slurm_cluster(self, params, log_dir: str = None):
+        """SLURM cluster to submit jobs to, steps submitted from a container instance could not reach it
+        """
+        if params.container:
+            print("--container runs steps in an instance on this host and cannot be combined with --slurm", flush=True)
+            sys.exit(-1)
+        cluster = SlurmCluster(log_dir=log_dir or os.path.join(os.getcwd(), self.slurm_log_dir), partition=params.slurm_partition,
+                               account=params.slurm_account, time_limit=params.slurm_time, poll_interval=params.slurm_poll)
+        cluster.check()
+        return cluster
+
+    @staticmethod
+    def without_option(args, option):
+        """Arguments with an option and its value removed
+        """
+        kept = []
+        skip = False
+        for arg in args:
+            if skip:
+                skip = False
+            elif arg == option:
+                skip = True
+            elif not arg.startswith(f"{option}="):
+                kept.append(arg)
+        return kept
+
+    def select_mapper(self, params):
+        """Mapper backend to use, auto picks the fastest installed backend on this host. The container
+        image only ships minimap2
+        """
+        if params.mapper != AUTO:
+            return MAPPERS[params.mapper]
+        if params.container:
+            return IdxMapReads
+        return MAPPERS[MapperBenchmark(MAPPERS, threads=params.threads).choose()]
+
+    def sample_budget(self, params) -> ResourceBudget:
+        """Budget of each sample, --threads and --memory unless given per sample. It does not shrink
+        with the number of samples, the shared scheduler admits their steps by what each declares
+        """
+        threads = params.sample_threads if params.sample_threads is not None else params.threads
+        memory = params.sample_memory if params.sample_memory is not None else params.memory
+        return ResourceBudget(threads=threads, memory=memory, pilon_ram=params.ram)
+
+    def polish_batch(self, params):
+        """Polish every sample in a sample sheet against a shared thread and memory budget
+        """
+        samples = PolishBatch.read_sample_sheet(params.samples)
+        jobs = params.jobs if params.jobs is not None else len(samples)
+        resources = self.sample_budget(params)
+        sample_threads, sample_memory = resources.threads, resources.memory
+        if params.sample_index is not None:
+            samples = samples[params.sample_index:params.sample_index + 1]
+        if params.slurm == self.slurm_samples:
+            cluster = self.slurm_cluster(params, os.path.join(os.path.abspath(params.out_dir), self.slurm_log_dir))
+            print(f"Submitting a batch of {len(samples)} samples as a SLURM job array, {jobs} at once with {sample_threads} threads "
+                  f"and {sample_memory}GB each", flush=True)
+            # every task runs this batch command for its own sample on the node it is given
+            task_command = [sys.executable, os.path.abspath(__file__), self.batch_command, *self.without_option(self.args[1:], "--slurm")]
+            batch = PolishBatch(samples=samples, out_dir=params.out_dir, scheduler=None, jobs=jobs, resources=resources)
+            batch.submit_samples(cluster, task_command)
+            return
+        print(f"Batch of {len(samples)} samples, {jobs} at once with up to {sample_threads} threads and {sample_memory}GB each "
+              f"within {params.threads} threads and {params.memory}GB", flush=True)
+        batch = PolishBatch(samples=samples, out_dir=params.out_dir, scheduler=ResourceScheduler(params.threads, params.memory), jobs=jobs,
+                            resources=resources, **self.workflow_kwargs(params))
+        batch.polish_samples()
+
+    def add_polishing_args(self, parser):
+        """Options shared by single sample and batch polishing
+        """
+        parser.add_argument("-m", "--max-iter", help=f"Max number of iterations to perform with Pilon. Default: {self.max_iter_default}", type=int,
+                            default=self.max_iter_default, required=False)
+        parser.add_argument("-a", "--ram", help=f"Memory to be passed to Pilon JVM. Default: estimated each iteration from the assembly size and read depth, capped at --memory", required=False, type=int)
+        parser.add_argument("-t", "--threads", help=f"Threads to divide between minimap2, samtools and Pilon. Default: {available_threads()}",
+                            type=int, default=available_threads(), required=False)
+        parser.add_argument("--memory", help=f"Memory in GB to divide between samtools sort and the Pilon JVM. Default: {self.default_ram}GB",
+                            type=int, default=self.default_ram, required=False)
+        parser.add_argument("--shards", help="Split the contigs into this many groups polished by concurrent Pilon processes, each given an equal share of the heap. Default: 1",
+                            type=int, default=1, required=False)
+        parser.add_argument("--min-changes", help="Stop polishing once an iteration makes this many changes or fewer. Default: 0", type=int,
+                            default=0, required=False)
+        parser.add_argument("--resume", help="Skip steps whose cached outputs match their command, tool version and inputs",
+                            action="store_true", default=False, required=False)
+        parser.add_argument("--container", help="Run every tool inside the HybridPolisher.sif image through one persistent apptainer or singularity instance per sample",
+                            action="store_true", default=False, required=False)
+        parser.add_argument("--prometheus-dir", help="Node exporter textfile collector directory to write per step metrics to as pilonpolisher_<prefix>.prom",
+                            required=False)
+        parser.add_argument("--target-depth", help=f"Downsample read pairs deeper than this over the assembly before polishing, 0 keeps every read. Default: {self.target_depth_default}, every read is kept",
+                            type=float, default=self.target_depth_default, required=False)
+        parser.add_argument("--mapper", help=f"Short read mapper, {AUTO} uses the fastest installed mapper on this host from a benchmark recorded on first use. Default: {self.mapper_default}",
+                            choices=[AUTO, *MAPPERS], default=self.mapper_default, required=False)
+        parser.add_argument("--retention", help=f"Iteration outputs to keep. Default: {Retention.keep_final_changes}",
+                            choices=[i.value for i in Retention], default=Retention.keep_final_changes, required=False)
+        parser.add_argument("--cram", help="Store retained alignments as CRAM against the assembly they were mapped to",
+                            action="store_true", default=False, required=False)
+        parser.add_argument("--pilon-vcf", help="Have Pilon write its per base VCF each iteration",
+                            action="store_true", default=False, required=False)
+        parser.add_argument("--scratch", help=f"Node local directory, such as /dev/shm, to stage the reads and contigs in and run every iteration in, "
+                            f"only the retained outputs are copied back. Default: $TMPDIR ({os.environ.get('TMPDIR')})",
+                            default=os.environ.get("TMPDIR"), required=False)
+        parser.add_argument("--no-scratch", help="Work directly in the output directory even when $TMPDIR is set, as --resume always does",
+                            action="store_true", default=False, required=False)
+        parser.add_argument("--parallel-steps", help="Independent steps of a sample, such as Pilon shards, to run at once. Default: --shards",
+                            type=int, required=False)
+        parser.add_argument("--step-timeout", help="Seconds any single step may run before the sample is stopped. Default: no limit",
+                            type=float, required=False)
+        parser.add_argument("--slurm", help=f"Submit each step as a SLURM job ({self.slurm_steps}), or each sample of a batch as a task of "
+                            f"one job array ({self.slurm_samples}). Output directories must be on a filesystem the compute nodes share, "
+                            f"{self.slurm_steps} works in the output directory rather than in scratch",
+                            choices=[self.slurm_steps, self.slurm_samples], required=False)
+        parser.add_argument("--slurm-partition", help="SLURM partition to submit to. Default: the cluster default", required=False)
+        parser.add_argument("--slurm-account", help="SLURM account to charge jobs to", required=False)
+        parser.add_argument("--slurm-time", help="Time limit of each SLURM job, such as 04:00:00. Default: the partition limit", required=False)
+        parser.add_argument("--slurm-poll", help="Seconds between squeue polls of submitted jobs. Default: 10", type=float, default=10.0, required=False)
+        parser.add_argument("--liftover", help="After the first iteration lift the previous alignments onto the polished assembly and only realign "
+                            "read pairs near Pilon's edits, rather than remapping every read", action="store_true", default=False, required=False)
+        parser.add_argument("--liftover-flank", help="Read pairs aligned within this many bases of an edit are realigned with --liftover. Default: 200",
+                            type=int, default=200, required=False)
+        parser.add_argument("--read-cache", help="Directory to decode, check and pair the reads into once, every iteration and any later run "
+                            "polishing the same reads maps them from there. Best on fast local storage", required=False)
+        parser.add_argument("--read-cache-size", help=f"GB the read cache may hold before the least recently used reads are removed. Default: {self.read_cache_size_default}",
+                            type=float, default=self.read_cache_size_default, required=False)
+        parser.add_argument("--read-cache-bgzf", help="Store cached reads compressed as bgzf by a multithreaded bgzip rather than uncompressed",
+                            action="store_true", default=False, required=False)
+        parser.add_argument("--incremental", help="Stop polishing contigs once Pilon makes no changes to them, later iterations only polish the remaining contigs",
+                            action="store_true", default=False, required=False)
+
+    def batch_parser(self, args):
+        """Parse cmd line opts for polishing a batch of samples
+        """
+        parser = argparse.ArgumentParser(prog=f"PilonIterator {self.batch_command}", description="Polish many assemblies at once within a shared thread and memory budget")
+        parser.add_argument("-s", "--samples", help="Tab or comma separated sample sheet with the columns contigs, r1, r2 and prefix", required=True)
+        parser.add_argument("-o", "--out-dir", help="Directory to create a directory per sample prefix in. Default: current directory",
+                            default=os.getcwd(), required=False)
+        parser.add_argument("-j", "--jobs", help="Samples to polish at once. Default: every sample", type=int, required=False)
+        parser.add_argument("--sample-threads", help="Threads given to the tools of each sample, their steps share --threads. Default: --threads",
+                            type=int, required=False)
+        parser.add_argument("--sample-memory", help="Memory in GB given to the tools of each sample, their steps share --memory. Default: --memory",
+                            type=int, required=False)
+        parser.add_argument("--sample-index", help=argparse.SUPPRESS, type=int, required=False)
+        self.add_polishing_args(parser)
+        return parser.parse_args(args)
 
     def cmd_parser(self, args):
         """Parse cmd line opts for polishing
@@ -39,9 +246,14 @@ class Main:
         parser.add_argument("-c", "--contigs", help="Path to assembled contigs", required=False)
         parser.add_argument("-r", "--reads", nargs='+', help="Paired end reads used for generation of the assembly",
                             required=False)
-        parser.add_argument("-m", "--max-iter", help=f"Max number of iterations to perform with Pilon. Default: {self.max_iter_default}", type=int,
-                            default=self.max_iter_default, required=False)
-        parser.add_argument("-a", "--ram", help=f"Memory to be passed to Pilon JVM. Default: {self.default_ram}GB", required=False, type=int)
+        parser.add_argument("-l", "--long-reads", nargs='+', help="Nanopore reads to polish the contigs with Racon before Pilon, "
+                            "the contigs are assembled from them with Flye when --contigs is not given", required=False)
+        parser.add_argument("--racon-rounds", help="Rounds of Racon polishing with --long-reads, 0 skips Racon. Default: 1",
+                            type=int, default=1, required=False)
+        parser.add_argument("--racon-chunks", help=f"Split the contigs into this many chunks each polished by its own Racon process, "
+                            f"--parallel-steps of them at once. Default: {self.racon_chunks_default}",
+                            type=int, default=self.racon_chunks_default, required=False)
+        self.add_polishing_args(parser)
         parser.add_argument("-p", "--prefix", help="Prefix name to use for outputs", required=False, type=str)
         if not args:
             parser.print_help()
@@ -0,0 +1,25 @@
+"""Fixtures shared by the tests that run the workflow with the benchmark stub tools on synthetic data
+"""
+
+import os
+import sys
+import pytest
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks")
+sys.path.insert(0, BENCHMARK_DIR)
+
+from synthetic import make_dataset
+
+
+@pytest.fixture
+def stub_tools(monkeypatch):
+    """Put the stand in tools of the benchmarks first on the PATH
+    """
+    monkeypatch.setenv("PATH", os.pathsep.join([os.path.join(BENCHMARK_DIR, "bin"), os.environ["PATH"]]))
+
+
+@pytest.fixture
+def dataset(tmp_path, stub_tools):
+    """A small synthetic draft and read set to polish with the stub tools
+    """
+    return make_dataset(str(tmp_path / "data"), genome_size=20_000, contigs=2, depth=5)
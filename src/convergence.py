@@ -0,0 +1,146 @@
+"""Track the changes Pilon makes each iteration to decide when polishing has converged
+
+Pilon's --changes output holds one edit per line in the form:
+    original_contig:start[-stop] polished_contig:start[-stop] original_bases polished_bases
+where a deletion or insertion uses "." for the missing bases.
+"""
+import re
+from typing import Dict, Iterator, List, Set, Tuple
+from dataclasses import dataclass, field
+from resources import read_lines
+
+
+@dataclass(frozen=True)
+class PilonChange:
+    """A single edit from a Pilon changes file
+    """
+    contig: str
+    start: int
+    stop: int
+    polished_start: int
+    polished_stop: int
+    original: str
+    polished: str
+
+    @property
+    def is_snp(self) -> bool:
+        return len(self.original) == len(self.polished) and "." not in (self.original, self.polished)
+
+    def signature(self) -> Tuple[str, int, str, str]:
+        """Edit as it appears in the polished assembly, used to spot edits undone in the next iteration
+        """
+        return (self.contig, self.polished_start, self.original, self.polished)
+
+    def reverse_signature(self) -> Tuple[str, int, str, str]:
+        """Signature of the edit this change would undo from the previous iteration
+        """
+        return (self.contig, self.start, self.polished, self.original)
+
+
+@dataclass
+class IterationChanges:
+    """Changes made in a single Pilon iteration
+    """
+    iteration: int
+    changes: List[PilonChange] = field(default_factory=list)
+
+    @property
+    def total(self) -> int:
+        return len(self.changes)
+
+    def per_contig(self) -> Dict[str, int]:
+        counts = {}
+        for change in self.changes:
+            counts[change.contig] = counts.get(change.contig, 0) + 1
+        return counts
+
+    def signatures(self) -> Set[Tuple[str, int, str, str]]:
+        return {i.signature() for i in self.changes}
+
+
+class PilonChanges:
+    """Parse a Pilon changes file
+    """
+    pilon_suffix = "_pilon"
+    __coordinate = re.compile(r"^(?P<contig>.+):(?P<start>\d+)(?:-(?P<stop>\d+))?$")
+
+    @classmethod
+    def base_contig(cls, contig: str) -> str:
+        """Remove the suffixes Pilon appends to a contig name each iteration
+        """
+        while contig.endswith(cls.pilon_suffix):
+            contig = contig[:-len(cls.pilon_suffix)]
+        return contig
+
+    @classmethod
+    def parse_coordinate(cls, coordinate: str) -> Tuple[str, int, int]:
+        match = cls.__coordinate.match(coordinate)
+        if match is None:
+            raise ValueError(f"Malformed Pilon change coordinate: {coordinate}")
+        start = int(match.group("start"))
+        stop = int(match.group("stop")) if match.group("stop") is not None else start
+        return match.group("contig"), start, stop
+
+    @classmethod
+    def records(cls, changes_file: str) -> Iterator[PilonChange]:
+        """Stream the changes in a plain or bgzipped changes file
+        """
+        for line in read_lines(changes_file):
+            fields = line.split()
+            if not fields:
+                continue
+            if len(fields) != 4:
+                raise ValueError(f"Malformed line in {changes_file}: {line.strip()}")
+            contig, start, stop = cls.parse_coordinate(fields[0])
+            _, polished_start, polished_stop = cls.parse_coordinate(fields[1])
+            yield PilonChange(contig=cls.base_contig(contig), start=start, stop=stop, polished_start=polished_start,
+                              polished_stop=polished_stop, original=fields[2], polished=fields[3])
+
+    @classmethod
+    def parse(cls, changes_file: str, iteration: int = 0) -> IterationChanges:
+        """Read every change in a changes file
+        """
+        return IterationChanges(iteration=iteration, changes=list(cls.records(changes_file)))
+
+
+class ConvergenceTracker:
+    """Decide after each iteration whether further polishing is worthwhile
+
+    Polishing stops once an iteration makes no more than min_changes edits, or when at least
+    oscillation_fraction of an iterations edits undo the edits made by the iteration before it.
+    """
+
+    def __init__(self, min_changes: int = 0, oscillation_fraction: float = 0.5):
+        self.min_changes = min_changes
+        self.oscillation_fraction = oscillation_fraction
+        self.history: List[IterationChanges] = []
+        self.reason = None
+
+    def reverted(self, current: IterationChanges) -> int:
+        """Count edits in the current iteration that undo an edit from the previous iteration
+        """
+        if not self.history:
+            return 0
+        previous = self.history[-1].signatures()
+        return sum(1 for i in current.changes if i.reverse_signature() in previous)
+
+    def oscillating(self, current: IterationChanges) -> bool:
+        if not current.total:
+            return False
+        return self.reverted(current) / current.total >= self.oscillation_fraction
+
+    def update(self, changes_file: str, iteration: int) -> bool:
+        """Record an iterations changes and return True if polishing has converged
+        """
+        current = PilonChanges.parse(changes_file, iteration)
+        oscillating = self.oscillating(current)
+        self.history.append(current)
+        print(f"Iteration {iteration}: {current.total} changes across {len(current.per_contig())} contigs", flush=True)
+        if current.total <= self.min_changes:
+            self.reason = f"{current.total} changes is within the threshold of {self.min_changes}"
+        elif oscillating:
+            self.reason = f"changes in iteration {iteration} undo those of the previous iteration"
+        else:
+            return False
+        print(f"Polishing converged: {self.reason}", flush=True)
+        return True
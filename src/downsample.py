@@ -0,0 +1,220 @@
+"""Estimate the read depth against an assembly and downsample read pairs to a target depth
+
+Pairs are kept or dropped on a hash of their read name, so the same pairs are chosen every time the
+same reads are downsampled and both mates are always kept or dropped together. The depth is
+estimated from a prefix of each read file scaled up by the share of the file it was read from, so
+the reads are only decompressed in full once, while the kept pairs are written.
+"""
+import os
+import sys
+import gzip
+import zlib
+import hashlib
+from typing import Iterator, List, Tuple
+from dataclasses import dataclass
+from resources import open_reads
+from cache import StepCache
+
+
+HASH_RANGE = 1 << 64
+SAMPLE_CHUNK = 1 << 14 # compressed bytes decoded at a time while sampling
+GZIP_WBITS = zlib.MAX_WBITS | 16
+
+
+def fastq_records(fastq) -> Iterator[Tuple[str, ...]]:
+    """Yield the four lines of each fastq record
+    """
+    while True:
+        record = tuple(fastq.readline() for _ in range(4))
+        if not record[0]:
+            return
+        if not record[0].startswith("@") or not record[3]:
+            print(f"Malformed fastq record in {fastq.name}: {record[0].strip()}", flush=True)
+            sys.exit(-1)
+        yield record
+
+
+def read_name(header: str) -> str:
+    """Read name shared by both mates, without the @, comment or /1 /2 suffix
+    """
+    name = header[1:].split(maxsplit=1)[0]
+    return name[:-2] if name.endswith(("/1", "/2")) else name
+
+
+def paired_records(reads: List[str]) -> Iterator[Tuple[Tuple[str, ...], ...]]:
+    """Step through each read file together, exiting if the mates fall out of sync
+    """
+    handles = [open_reads(i) for i in reads]
+    try:
+        for records in zip(*[fastq_records(i) for i in handles]):
+            names = {read_name(i[0]) for i in records}
+            if len(names) != 1:
+                print(f"Read files {', '.join(reads)} are out of sync at {', '.join(sorted(names))}", flush=True)
+                sys.exit(-1)
+            yield records
+        if any(i.readline() for i in handles):
+            print(f"Read files {', '.join(reads)} hold different numbers of reads", flush=True)
+            sys.exit(-1)
+    finally:
+        for handle in handles:
+            handle.close()
+
+
+def keep_pair(name: str, fraction: float, seed: int = 0) -> bool:
+    digest = hashlib.blake2b(f"{seed}:{name}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") < fraction * HASH_RANGE
+
+
+@dataclass(frozen=True)
+class DepthEstimate:
+    """Bases sequenced against the length of the assembly they are polishing
+    """
+    genome_size: int
+    bases: int
+    pairs: int
+    sampled: bool = False
+
+    @property
+    def depth(self) -> float:
+        return self.bases / self.genome_size if self.genome_size else 0.0
+
+    def fraction(self, target_depth: float) -> float:
+        """Fraction of pairs to keep to reach the target depth, 1 when already at or below it
+        """
+        if not target_depth or self.depth <= target_depth:
+            return 1.0
+        return target_depth / self.depth
+
+    def describe(self) -> str:
+        estimated = "an estimated " if self.sampled else ""
+        return f"{estimated}{self.pairs} read pairs, {self.bases / 1e6:.1f}Mb at {self.depth:.0f}x depth over {self.genome_size / 1e6:.2f}Mb"
+
+
+def estimate_depth(reads: List[str], genome_size: int) -> DepthEstimate:
+    bases = 0
+    pairs = 0
+    for records in paired_records(reads):
+        pairs += 1
+        bases += sum(len(i[1].strip()) for i in records)
+    return DepthEstimate(genome_size=genome_size, bases=bases, pairs=pairs)
+
+
+def sampled_reads(reads: str, records: int) -> Tuple[int, int]:
+    """Records and bases in a read file, counted over at most records and scaled up by the share
+    of the file, compressed or not, that they were read from. The file is decompressed here in small
+    chunks, including each member of a bgzf file, so the bytes behind the counted records are known
+    """
+    size = os.path.getsize(reads)
+    counted = bases = consumed = 0
+    lines = []
+    remainder = b""
+    with open(reads, "rb") as raw:
+        gzipped = raw.read(2) == b"\x1f\x8b"
+        raw.seek(0)
+        decompressor = zlib.decompressobj(GZIP_WBITS)
+        while counted < records:
+            chunk = raw.read(SAMPLE_CHUNK)
+            if not chunk:
+                break
+            consumed += len(chunk)
+            chunk_bytes = len(chunk)
+            data = chunk if not gzipped else b""
+            while gzipped and chunk:
+                data += decompressor.decompress(chunk)
+                chunk = decompressor.unused_data if decompressor.eof else b""
+                if decompressor.eof:
+                    decompressor = zlib.decompressobj(GZIP_WBITS)
+            lines.extend((remainder + data).split(b"\n"))
+            remainder = lines.pop()
+            while len(lines) >= 4 and counted < records:
+                counted += 1
+                bases += len(lines[1].strip())
+                del lines[:4]
+        else:
+            # the lines decoded past the last counted record are not part of the sample
+            leftover = sum(len(i) + 1 for i in lines) + len(remainder)
+            consumed -= leftover * chunk_bytes / max(1, len(data))
+            return round(counted * size / max(1, consumed)), round(bases * size / max(1, consumed))
+    if remainder.strip():
+        lines.append(remainder)
+    counted += len(lines) // 4
+    bases += sum(len(lines[i].strip()) for i in range(1, len(lines), 4))
+    return counted, bases
+
+
+def sample_depth(reads: List[str], genome_size: int, records: int) -> DepthEstimate:
+    """Depth estimated from the first records of each read file
+    """
+    counts = [sampled_reads(i, records) for i in reads]
+    return DepthEstimate(genome_size=genome_size, bases=sum(i[1] for i in counts), pairs=counts[0][0],
+                         sampled=any(i[0] > records for i in counts))
+
+
+class ReadDownsampler:
+    """Write the reads downsampled to a target depth once, so every polishing iteration maps the
+    smaller set. Reads already at or below the target are used as they are
+
+    The subsampled files are compressed at the fastest gzip level as they are written once and read
+    by every iteration, unless compress is off because the reads come from a read cache that keeps
+    them uncompressed. The depth is estimated from the first sample_records of each file, so the
+    input is only read in full once. With a step cache a resumed run reuses them without reading
+    the input again.
+    """
+    read_ext = ".fastq.gz"
+    plain_ext = ".fastq"
+    compress_level = 1
+    sample_records = 100_000
+
+    def __init__(self, reads: List[str], genome_size: int, out_dir: str, prefix: str, target_depth: float,
+                 seed: int = 0, cache: StepCache = None, compress: bool = True):
+        self.reads = [os.path.abspath(i) for i in reads]
+        self.genome_size = genome_size
+        self.out_dir = os.path.abspath(out_dir)
+        self.prefix = prefix
+        self.target_depth = target_depth
+        self.seed = seed
+        self.cache = cache
+        self.compress = compress
+        self.estimate: DepthEstimate = None
+
+    def outputs(self) -> List[str]:
+        ext = self.read_ext if self.compress else self.plain_ext
+        return [os.path.join(self.out_dir, f"{self.prefix}_downsampled_R{idx + 1}{ext}") for idx in range(len(self.reads))]
+
+    def cache_key(self) -> str:
+        return StepCache.key([["downsample", str(self.target_depth), str(self.seed), str(self.genome_size)]], [], self.reads)
+
+    def downsample(self) -> List[str]:
+        """Reads to polish with, downsampled when their depth exceeds the target
+        """
+        key = self.cache_key() if self.cache is not None else None
+        if self.cache is not None and self.cache.is_current(key, self.outputs()):
+            print(f"Reusing reads downsampled to {self.target_depth}x: {', '.join(self.outputs())}", flush=True)
+            return self.outputs()
+        self.estimate = sample_depth(self.reads, self.genome_size, self.sample_records)
+        print(self.estimate.describe(), flush=True)
+        fraction = self.estimate.fraction(self.target_depth)
+        if fraction >= 1.0:
+            return self.reads
+        tmp_outputs = [f"{i}.tmp" for i in self.outputs()]
+        if self.compress:
+            handles = [gzip.open(i, "wt", compresslevel=self.compress_level) for i in tmp_outputs]
+        else:
+            handles = [open(i, "w") for i in tmp_outputs]
+        kept = pairs = 0
+        try:
+            for records in paired_records(self.reads):
+                pairs += 1
+                if keep_pair(read_name(records[0][0]), fraction, self.seed):
+                    kept += 1
+                    for handle, record in zip(handles, records):
+                        handle.writelines(record)
+        finally:
+            for handle in handles:
+                handle.close()
+        for tmp_output, output in zip(tmp_outputs, self.outputs()):
+            os.replace(tmp_output, output)
+        if self.cache is not None:
+            self.cache.record(key, self.outputs())
+        print(f"Downsampled to {kept} of {pairs} read pairs for {self.target_depth}x depth", flush=True)
+        return self.outputs()
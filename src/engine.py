@@ -0,0 +1,204 @@
+"""Run the steps of a workflow as a graph so independent steps overlap
+
+Each node is one executor, or several piped together, and declares the files it reads and writes.
+A node depends on every earlier node that writes a file it reads, or that reads or writes a file it
+writes, so nodes are always added in an order that is already a valid schedule. Ready nodes are
+started from an asyncio event loop up to a concurrency limit. The stages of a node share a process
+group, when a node fails or times out every running process group is killed and the run exits.
+
+Processes are reaped with os.wait4 on a worker thread rather than through asyncio's child watcher,
+which would reap them first, so the run report keeps the cpu time and peak memory of every step.
+
+When the context holds a SLURM cluster each node is submitted as a job instead, sized from the
+threads and memory its stages declare, and the cluster rather than the local scheduler admits it.
+"""
+import os
+import sys
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+from tools import Executor, ExecutionContext, Pipeline, StageProcesses, StepFailure, classify_failure, stop_on_failure, wait_with_rusage
+from slurm import SlurmJob, shell_command, OUT_OF_MEMORY
+
+
+class GraphNode:
+    """One or more executors piped together, run as a single step of the graph
+    """
+
+    def __init__(self, *stages: Executor, timeout: float = None):
+        self.stages = stages
+        self.pipeline = Pipeline(*stages)
+        self.timeout = timeout
+        self.depends_on: List["GraphNode"] = []
+
+    def __repr__(self) -> str:
+        return " | ".join(i.program.__name__ for i in self.stages)
+
+    def inputs(self) -> List[str]:
+        return [os.path.abspath(j) for i in self.stages for j in i.initialized.inputs()]
+
+    def outputs(self) -> List[str]:
+        return [os.path.abspath(i) for i in self.pipeline.outputs()]
+
+    def requirements(self):
+        return self.pipeline.requirements()
+
+    def job_name(self) -> str:
+        return "pilonpolisher_" + "_".join(i.program.__name__.lower() for i in self.stages)
+
+    def shell_command(self) -> str:
+        return shell_command([i.create_cmd() for i in self.stages], self.stages[-1].initialized.stdout)
+
+
+class WorkflowEngine:
+    """Collect nodes then run them concurrently as their dependencies complete
+    """
+
+    def __init__(self, context: ExecutionContext = None, jobs: int = 1, timeout: float = None):
+        self.context = context if context is not None else ExecutionContext()
+        self.jobs = max(1, jobs)
+        self.timeout = timeout
+        self.nodes: List[GraphNode] = []
+
+    def add(self, *stages: Executor, timeout: float = None) -> GraphNode:
+        """Queue executors piped together as one node, depending on earlier nodes that share its files
+        """
+        node = GraphNode(*stages, timeout=timeout if timeout is not None else self.timeout)
+        reads = set(node.inputs())
+        writes = set(node.outputs())
+        node.depends_on = [i for i in self.nodes if reads & set(i.outputs()) or writes & set(i.outputs() + i.inputs())]
+        self.nodes.append(node)
+        return node
+
+    def check_inputs(self):
+        """Every input must exist or be written by an earlier node
+        """
+        produced = set()
+        for node in self.nodes:
+            missing = [i for i in node.inputs() if i not in produced and not os.path.exists(i)]
+            if missing:
+                print(f"Inputs of {node} are missing and no earlier step creates them: {', '.join(missing)}", flush=True)
+                sys.exit(-1)
+            produced.update(node.outputs())
+
+    def run(self, recoverable: Tuple[type, ...] = ()):
+        """Run every queued node, a failure of the recoverable types is raised once the other nodes
+        are stopped and any other failure exits
+        """
+        if not self.nodes:
+            return
+        self.check_inputs()
+        nodes, self.nodes = self.nodes, []
+        # a thread per stage waiting on its process plus one per node waiting on the scheduler
+        with ThreadPoolExecutor(max_workers=self.jobs * (max(len(i.stages) for i in nodes) + 1)) as self.pool:
+            failure = asyncio.run(self.run_nodes(nodes))
+        if failure is not None:
+            stop_on_failure(failure, recoverable)
+
+    async def run_nodes(self, nodes: List[GraphNode]) -> StepFailure:
+        """Start a task per node that waits on its dependencies, the first failure cancels the rest
+        """
+        semaphore = asyncio.Semaphore(self.jobs)
+        tasks = {}
+        for node in nodes:
+            tasks[node] = asyncio.create_task(self.run_node(node, [tasks[i] for i in node.depends_on], semaphore))
+        try:
+            await asyncio.gather(*tasks.values())
+        except StepFailure as failure:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            return failure
+        return None
+
+    async def run_node(self, node: GraphNode, dependencies: List[asyncio.Task], semaphore: asyncio.Semaphore):
+        if dependencies:
+            await asyncio.gather(*dependencies)
+        async with semaphore:
+            cache = self.context.cache
+            key = node.pipeline.cache_key() if cache is not None else None
+            if cache is not None and cache.is_current(key, node.outputs()):
+                print(f"Skipping {node}, cached outputs are current", flush=True)
+                for executor in node.stages:
+                    self.context.record(executor.program.__name__, executor.initialized, time.time(), cached=True)
+                return
+            if self.context.cluster is not None:
+                await self.execute_on_cluster(node)
+            else:
+                threads, memory = node.requirements()
+                await self.acquire(threads, memory)
+                try:
+                    await self.execute(node)
+                finally:
+                    if self.context.scheduler is not None:
+                        self.context.scheduler.release(threads, memory)
+            if cache is not None:
+                cache.record(key, node.outputs())
+
+    async def acquire(self, threads: int, memory: int):
+        """Wait for the shared scheduler without blocking the event loop, a reservation granted after
+        the node was cancelled is handed straight back
+        """
+        scheduler = self.context.scheduler
+        if scheduler is None:
+            return
+        acquiring = asyncio.get_running_loop().run_in_executor(self.pool, scheduler.acquire, threads, memory)
+        try:
+            await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            await acquiring
+            scheduler.release(threads, memory)
+            raise
+
+    async def execute_on_cluster(self, node: GraphNode):
+        """Submit a node as a batch job and poll it until it leaves the cluster, cancelling it if
+        the run stops or the node times out
+        """
+        loop = asyncio.get_running_loop()
+        cluster = self.context.cluster
+        threads, memory = node.requirements()
+        started = time.time()
+        start = time.perf_counter()
+        submitting = loop.run_in_executor(self.pool, cluster.submit, node.job_name(), [node.shell_command()], threads, memory)
+        try:
+            job: SlurmJob = await asyncio.shield(submitting)
+        except asyncio.CancelledError:
+            cluster.cancel([await submitting])
+            raise
+        try:
+            await asyncio.wait_for(self.wait_for_job(job), node.timeout)
+        except BaseException as error:
+            await loop.run_in_executor(self.pool, cluster.cancel, [job])
+            if isinstance(error, asyncio.TimeoutError):
+                raise StepFailure(f"{node} did not finish within {node.timeout}s") from error
+            raise
+        wall_time = time.perf_counter() - start
+        for executor in node.stages:
+            self.context.record(executor.program.__name__, executor.initialized, started, wall_time, None, job.exit_code())
+        if job.failed():
+            state = job.results.get(job.job_id, (None, None))[0]
+            raise classify_failure(f"{node}", [node.shell_command()], job.exit_code(), job.log_tail(), out_of_memory=state == OUT_OF_MEMORY)
+
+    async def wait_for_job(self, job: SlurmJob):
+        loop = asyncio.get_running_loop()
+        while not await loop.run_in_executor(self.pool, self.context.cluster.poll, [job]):
+            await asyncio.sleep(self.context.cluster.poll_interval)
+
+    async def execute(self, node: GraphNode):
+        """Start each stage in one process group with its stdin connected to the previous stages stdout
+        """
+        loop = asyncio.get_running_loop()
+        stages = StageProcesses(node.stages, own_group=True)
+        waiting = asyncio.gather(*[loop.run_in_executor(self.pool, wait_with_rusage, i) for i in stages.procs])
+        try:
+            usage = await asyncio.wait_for(asyncio.shield(waiting), node.timeout)
+        except BaseException as error:
+            stages.terminate()
+            await waiting
+            if isinstance(error, asyncio.TimeoutError):
+                raise StepFailure(f"{node} did not finish within {node.timeout}s") from error
+            raise
+        failure = await loop.run_in_executor(self.pool, stages.finish, usage)
+        if failure is not None:
+            raise failure
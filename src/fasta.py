@@ -0,0 +1,61 @@
+"""Minimal streaming FASTA helpers so contigs can be inspected and rebuilt without extra dependencies
+"""
+import os
+from typing import Dict, Iterator, Iterable, List, Tuple
+
+
+FAI_EXT = ".fai"
+LINE_WIDTH = 80
+
+
+def read_fasta(fasta: str) -> Iterator[Tuple[str, str]]:
+    """Yield (name, sequence) for each record, the name is the header up to the first whitespace
+    """
+    name = None
+    seq = []
+    with open(fasta, "r") as records:
+        for line in records:
+            line = line.strip()
+            if line.startswith(">"):
+                if name is not None:
+                    yield name, "".join(seq)
+                name = line[1:].split()[0]
+                seq = []
+            elif line:
+                seq.append(line)
+    if name is not None:
+        yield name, "".join(seq)
+
+
+def write_fasta(records: Iterable[Tuple[str, str]], output: str):
+    """Write (name, sequence) records wrapped to a fixed line width
+    """
+    with open(output, "w") as out:
+        for name, seq in records:
+            out.write(f">{name}\n")
+            for start in range(0, len(seq), LINE_WIDTH):
+                out.write(f"{seq[start:start + LINE_WIDTH]}\n")
+
+
+def contig_lengths(fasta: str) -> Dict[str, int]:
+    """Contig lengths in file order, read from the samtools faidx index when one is present
+    """
+    fai = f"{fasta}{FAI_EXT}"
+    if os.path.isfile(fai) and os.path.getmtime(fai) >= os.path.getmtime(fasta):
+        with open(fai, "r") as index:
+            return {fields[0]: int(fields[1]) for fields in (line.split("\t") for line in index) if len(fields) > 1}
+    return {name: len(seq) for name, seq in read_fasta(fasta)}
+
+
+def partition_contigs(lengths: Dict[str, int], groups: int) -> List[List[str]]:
+    """Split contigs into groups of similar total length, longest contigs are placed first into the
+    lightest group. Contigs keep their original order within each group and empty groups are dropped
+    """
+    order = {name: idx for idx, name in enumerate(lengths)}
+    bins = [[] for _ in range(max(1, groups))]
+    totals = [0] * len(bins)
+    for name in sorted(lengths, key=lambda i: (-lengths[i], order[i])):
+        lightest = totals.index(min(totals))
+        bins[lightest].append(name)
+        totals[lightest] += lengths[name]
+    return [sorted(i, key=order.get) for i in bins if i]
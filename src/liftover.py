@@ -0,0 +1,233 @@
+"""Lift the alignments of the previous iteration onto the assembly Pilon has just polished
+
+Pilon's changes give the original coordinates of every edit, so an alignment that ends before an
+edit keeps its position and one starting after it moves by the bases inserted or deleted by every
+edit before it. Reads aligned within flank bases of an edit, and their mates, are pulled out as
+fastq to be realigned, every other alignment is moved onto the polished contigs. As alignments never
+start inside an edited window the lifted alignments stay in coordinate order.
+
+Run as a script it filters SAM on stdin, writing the lifted alignments to stdout:
+    samtools view -h previous.bam | python liftover.py --changes ... | samtools view -b -o lifted.bam -
+"""
+import sys
+import argparse
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Set, TextIO, Tuple
+from convergence import PilonChanges
+from fasta import contig_lengths
+
+
+PAIRED = 0x1
+REVERSE = 0x10
+FIRST_MATE = 0x40
+SECONDARY_OR_SUPPLEMENTARY = 0x900
+# tags holding positions of other alignments, left stale by lifting
+STALE_TAGS = ("SA:Z:", "XA:Z:")
+COMPLEMENT = str.maketrans("ACGTNacgtn", "TGCANtgcan")
+
+
+@dataclass
+class ContigEdits:
+    """Edits made to one contig, the cumulative length change after each and the padded windows around them
+    """
+    stops: List[int] = field(default_factory=list)
+    shifts: List[int] = field(default_factory=list)
+    window_starts: List[int] = field(default_factory=list)
+    window_stops: List[int] = field(default_factory=list)
+
+    def shift(self, position: int) -> int:
+        """Bases inserted less bases deleted by the edits ending before a position
+        """
+        idx = bisect_left(self.stops, position)
+        return self.shifts[idx - 1] if idx else 0
+
+
+class EditMap:
+    """Original coordinates of every edit in a Pilon changes file, by contig name without Pilon suffixes
+    """
+
+    def __init__(self, changes_file: str, flank: int):
+        self.flank = flank
+        self.contigs: Dict[str, ContigEdits] = {}
+        edits: Dict[str, List[Tuple[int, int, int]]] = {}
+        for change in PilonChanges.records(changes_file):
+            delta = len(change.polished.strip(".")) - len(change.original.strip("."))
+            edits.setdefault(change.contig, []).append((change.start, change.stop, delta))
+        for contig, contig_edits in edits.items():
+            contig_edits.sort()
+            merged = self.contigs[contig] = ContigEdits()
+            total = 0
+            for start, stop, delta in contig_edits:
+                total += delta
+                merged.stops.append(stop)
+                merged.shifts.append(total)
+                if merged.window_stops and start - flank <= merged.window_stops[-1]:
+                    merged.window_stops[-1] = max(merged.window_stops[-1], stop + flank)
+                else:
+                    merged.window_starts.append(max(1, start - flank))
+                    merged.window_stops.append(stop + flank)
+
+    def contig(self, name: str) -> ContigEdits:
+        return self.contigs.get(PilonChanges.base_contig(name))
+
+    def windows(self, names: Iterable[str]) -> List[Tuple[str, int, int]]:
+        """Edited windows as zero based half open intervals on the named contigs
+        """
+        windows = []
+        for name in names:
+            edits = self.contig(name)
+            if edits is not None:
+                windows.extend((name, i - 1, j) for i, j in zip(edits.window_starts, edits.window_stops))
+        return windows
+
+    def window_bases(self) -> int:
+        return sum(j - i + 1 for edits in self.contigs.values() for i, j in zip(edits.window_starts, edits.window_stops))
+
+    def write_bed(self, names: Iterable[str], bed: str):
+        with open(bed, "w") as out:
+            out.writelines(f"{name}\t{start}\t{stop}\n" for name, start, stop in self.windows(names))
+
+
+def sam_names(sam: str) -> Set[str]:
+    """Read names of the alignments in a SAM file
+    """
+    names = set()
+    with open(sam, "r") as alignments:
+        for line in alignments:
+            if not line.startswith("@"):
+                names.add(line.split("\t", 1)[0])
+    return names
+
+
+def fastq_record(fields: List[str]) -> str:
+    seq, qual = fields[9], fields[10]
+    if qual == "*":
+        qual = "I" * len(seq)
+    if int(fields[1]) & REVERSE:
+        seq, qual = seq.translate(COMPLEMENT)[::-1], qual[::-1]
+    return f"@{fields[0]}\n{seq}\n+\n{qual}\n"
+
+
+class AlignmentLifter:
+    """Stream SAM through, lifting alignments onto the polished contigs and writing read pairs near
+    edits as fastq for realignment
+    """
+
+    def __init__(self, edits: EditMap, lengths: Dict[str, int], affected: Set[str], active: Set[str] = None):
+        self.edits = edits
+        self.lengths = lengths
+        self.renamed = {PilonChanges.base_contig(i): i for i in lengths}
+        self.affected = affected
+        self.active = active
+        self.pending: Dict[str, List[str]] = {}
+        self.lifted = 0
+        self.realigned = 0
+        self.orphans = 0
+
+    def rename(self, contig: str) -> str:
+        if contig in ("*", "="):
+            return contig
+        return self.renamed[PilonChanges.base_contig(contig)]
+
+    def shift(self, contig: str, position: int) -> int:
+        edits = self.edits.contig(contig)
+        return edits.shift(position) if edits is not None and position > 0 else 0
+
+    def header(self, lines: List[str]) -> List[str]:
+        """Header describing the polished contigs, other header lines are kept
+        """
+        header = []
+        for line in lines:
+            if line.startswith("@HD"):
+                header.append("@HD\tVN:1.6\tSO:coordinate\n")
+            elif not line.startswith("@SQ"):
+                header.append(line)
+        if not any(i.startswith("@HD") for i in header):
+            header.insert(0, "@HD\tVN:1.6\tSO:coordinate\n")
+        sequences = [f"@SQ\tSN:{name}\tLN:{length}\n" for name, length in self.lengths.items()]
+        return header[:1] + sequences + header[1:]
+
+    def lift(self, fields: List[str]) -> str:
+        contig, mate_contig = fields[2], fields[6]
+        mate_contig = contig if mate_contig == "=" else mate_contig
+        position, mate_position, template = int(fields[3]), int(fields[7]), int(fields[8])
+        if template and contig == mate_contig:
+            # the fragment grows or shrinks by the edits between its ends
+            start = min(position, mate_position)
+            moved = abs(template) + self.shift(contig, start + abs(template) - 1) - self.shift(contig, start)
+            fields[8] = str(moved if template > 0 else -moved)
+        fields[3] = str(position + self.shift(contig, position))
+        fields[7] = str(mate_position + self.shift(mate_contig, mate_position))
+        fields[2] = self.rename(fields[2])
+        fields[6] = self.rename(fields[6])
+        self.lifted += 1
+        return "\t".join(i for i in fields if not i.startswith(STALE_TAGS))
+
+    def extract(self, fields: List[str], mates: Tuple[TextIO, TextIO]):
+        """Hold a primary alignment until its mate arrives, then write the pair for realignment
+        """
+        flag = int(fields[1])
+        if flag & SECONDARY_OR_SUPPLEMENTARY:
+            return
+        if not flag & PAIRED:
+            self.orphans += 1
+            return
+        name = fields[0]
+        mate = 0 if flag & FIRST_MATE else 1
+        if name not in self.pending:
+            self.pending[name] = [None, None]
+        self.pending[name][mate] = fastq_record(fields)
+        if None not in self.pending[name]:
+            first, second = self.pending.pop(name)
+            mates[0].write(first)
+            mates[1].write(second)
+            self.realigned += 1
+
+    def run(self, sam: TextIO, out: TextIO, mates: Tuple[TextIO, TextIO]):
+        header = []
+        for line in sam:
+            if line.startswith("@"):
+                header.append(line)
+                continue
+            if header is not None:
+                out.writelines(self.header(header))
+                header = None
+            fields = line.rstrip("\n").split("\t")
+            if fields[0] in self.affected:
+                self.extract(fields, mates)
+                continue
+            if self.active is not None and fields[2] != "*" and self.rename(fields[2]) not in self.active:
+                continue
+            out.write(f"{self.lift(fields)}\n")
+        if header is not None:
+            out.writelines(self.header(header))
+        self.orphans += len(self.pending)
+
+    def describe(self) -> str:
+        return (f"Lifted {self.lifted} alignments onto the polished assembly, {self.realigned} read pairs near edits "
+                f"to realign, {self.orphans} reads without a mate dropped")
+
+
+def main(args: List[str] = None):
+    parser = argparse.ArgumentParser(description="Lift SAM on stdin onto a Pilon polished assembly, writing reads near edits as fastq")
+    parser.add_argument("--changes", required=True, help="Pilon changes file of the polishing")
+    parser.add_argument("--assembly", required=True, help="Polished assembly")
+    parser.add_argument("--affected", required=True, help="SAM of the alignments overlapping edited windows")
+    parser.add_argument("--flank", type=int, required=True, help="Bases either side of an edit an alignment must keep clear of")
+    parser.add_argument("--reads-out", nargs=2, required=True, help="Fastq files to write the read pairs to realign to")
+    parser.add_argument("--active", help="Bed file of the polished contigs still being polished, alignments to others are dropped")
+    params = parser.parse_args(args)
+    active = None
+    if params.active is not None:
+        with open(params.active, "r") as bed:
+            active = {i.split("\t")[0] for i in bed if i.strip()}
+    lifter = AlignmentLifter(EditMap(params.changes, params.flank), contig_lengths(params.assembly), sam_names(params.affected), active)
+    with open(params.reads_out[0], "w") as first, open(params.reads_out[1], "w") as second:
+        lifter.run(sys.stdin, sys.stdout, (first, second))
+    sys.stdout.flush()
+    print(lifter.describe(), file=sys.stderr, flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Choose the fastest read mapper for a host from a recorded micro-benchmark
+
+Each installed mapper indexes and maps a small synthetic genome once, the timings are recorded
+against the host, its SIMD flags and the mapper versions so the benchmark is only run again when
+one of them changes.
+"""
+import os
+import sys
+import json
+import random
+import shutil
+import platform
+import tempfile
+from typing import Dict, List
+from cache import tool_version
+from report import RunReport
+from resources import ResourceBudget
+from engine import WorkflowEngine
+from tools import ExecutionContext, Minimap2Settings, StepFailure
+
+
+SIMD_FLAGS = ["sse4_1", "sse4_2", "avx", "avx2", "avx512f", "avx512bw"]
+AUTO = "auto"
+
+
+def cpu_flags() -> List[str]:
+    """SIMD instruction sets the cpu reports that the mappers have builds for
+    """
+    try:
+        with open("/proc/cpuinfo", "r") as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith("flags"):
+                    flags = set(line.split(":", 1)[1].split())
+                    return [i for i in SIMD_FLAGS if i in flags]
+    except OSError:
+        pass
+    return []
+
+
+def write_benchmark_data(out_dir: str, genome_size: int = 200_000, pairs: int = 20_000, read_length: int = 150, seed: int = 1):
+    """A random genome and error free read pairs sampled from it
+    """
+    rng = random.Random(seed)
+    genome = "".join(rng.choices("ACGT", k=genome_size))
+    contigs = os.path.join(out_dir, "genome.fasta")
+    with open(contigs, "w") as fasta:
+        fasta.write(">genome\n")
+        fasta.writelines(f"{genome[i:i + 80]}\n" for i in range(0, genome_size, 80))
+    reads = [os.path.join(out_dir, "reads_R1.fastq"), os.path.join(out_dir, "reads_R2.fastq")]
+    complement = str.maketrans("ACGT", "TGCA")
+    quality = "I" * read_length
+    with open(reads[0], "w") as r1, open(reads[1], "w") as r2:
+        for idx in range(pairs):
+            start = rng.randint(0, genome_size - 400)
+            r1.write(f"@pair{idx}/1\n{genome[start:start + read_length]}\n+\n{quality}\n")
+            r2.write(f"@pair{idx}/2\n{genome[start + 400 - read_length:start + 400].translate(complement)[::-1]}\n+\n{quality}\n")
+    return contigs, reads
+
+
+class MapperBenchmark:
+    """Time each installed mapper and pick the fastest, reusing the recorded result for the same host
+    """
+    record_name = "mapper_benchmark.json"
+
+    def __init__(self, mappers: Dict[str, type], threads: int = 1, record: str = None):
+        self.mappers = mappers
+        self.threads = threads
+        cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+        self.record = record if record is not None else os.path.join(cache_home, "pilonpolisher", self.record_name)
+
+    def available(self) -> List[str]:
+        return [name for name, mapper in self.mappers.items() if shutil.which(mapper.program.binary) is not None]
+
+    def host_key(self, names: List[str]) -> Dict:
+        return {"host": platform.node(), "machine": platform.machine(), "simd": cpu_flags(), "threads": self.threads,
+                "versions": {i: tool_version((self.mappers[i].program.binary, *self.mappers[i].program.version_args)) for i in names}}
+
+    def load(self) -> List[Dict]:
+        if not os.path.isfile(self.record):
+            return []
+        with open(self.record, "r") as record:
+            return json.load(record)
+
+    def save(self, results: List[Dict]):
+        os.makedirs(os.path.dirname(self.record), exist_ok=True)
+        tmp_record = f"{self.record}.tmp"
+        with open(tmp_record, "w") as record:
+            json.dump(results, record, indent=1)
+        os.replace(tmp_record, self.record)
+
+    def run(self, names: List[str]) -> Dict[str, float]:
+        """Seconds each mapper takes to index and map the benchmark reads, failing mappers are left out
+        """
+        timings = {}
+        with tempfile.TemporaryDirectory(prefix="pilonpolisher_mapper_") as work_dir:
+            contigs, reads = write_benchmark_data(work_dir)
+            for name in names:
+                report = RunReport(os.path.join(work_dir, f"{name}_report.jsonl"))
+                context = ExecutionContext(report=report)
+                context.engine = WorkflowEngine(context)
+                mapper = self.mappers[name](contigs=contigs, reads=reads, output_name=os.path.join(work_dir, f"{name}.sam"),
+                                            mapping_setting=Minimap2Settings.map_illumina,
+                                            resources=ResourceBudget(threads=self.threads), context=context)
+                mapper.map_reads()
+                try:
+                    context.flush(recoverable=(StepFailure,))
+                except StepFailure as failure:
+                    print(f"Mapper benchmark: {name} failed and will not be chosen: {failure}", flush=True)
+                    continue
+                timings[name] = sum(i.wall_time for i in report.records)
+                print(f"Mapper benchmark: {name} took {timings[name]:.2f}s", flush=True)
+        return timings
+
+    def choose(self) -> str:
+        """Fastest installed mapper, benchmarking only when this host has no matching record
+        """
+        names = self.available()
+        if not names:
+            print(f"None of the mappers {', '.join(self.mappers)} are in the path", flush=True)
+            sys.exit(-1)
+        if len(names) == 1:
+            return names[0]
+        key = self.host_key(names)
+        results = self.load()
+        timings = next((i["timings"] for i in results if i["key"] == key), None)
+        if timings is None:
+            timings = self.run(names)
+            if not timings:
+                print("No mapper completed the benchmark", flush=True)
+                sys.exit(-1)
+            self.save([i for i in results if i["key"] != key] + [{"key": key, "timings": timings}])
+        chosen = min(timings, key=timings.get)
+        print(f"Using {chosen} for mapping, fastest on this host ({', '.join(key['simd']) or 'no SIMD flags'}): "
+              f"{', '.join(f'{i} {j:.2f}s' for i, j in timings.items())}", flush=True)
+        return chosen
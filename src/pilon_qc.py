@@ -0,0 +1,134 @@
+"""Per contig QC metrics for a Pilon iteration, streamed from its VCF and changes output
+
+Pilon's VCF holds a record for every base of the assembly, with extra records for indels at the
+same position. The coverage and base calls are taken from the first record at each position:
+    DP in the INFO column is the depth of the base
+    a FILTER of LowCov marks too little coverage to call the base, Amb an ambiguous call
+    a PASS record with no ALT allele is a base the reads confirm
+Both files are read in fixed size chunks, plain or bgzipped, so memory use only grows with the
+number of contigs.
+"""
+import os
+from typing import Dict, List
+from dataclasses import dataclass
+from convergence import PilonChanges
+from resources import read_lines
+
+
+@dataclass
+class ContigQC:
+    """Metrics of one contig, or of every contig in an iteration
+    """
+    contig: str
+    bases: int = 0
+    depth_total: int = 0
+    low_coverage: int = 0
+    ambiguous: int = 0
+    confirmed: int = 0
+    snps: int = 0
+    indels: int = 0
+
+    @property
+    def mean_depth(self) -> float:
+        return self.depth_total / self.bases if self.bases else 0.0
+
+    @property
+    def low_coverage_fraction(self) -> float:
+        return self.low_coverage / self.bases if self.bases else 0.0
+
+    def add(self, other: "ContigQC"):
+        for name in ["bases", "depth_total", "low_coverage", "ambiguous", "confirmed", "snps", "indels"]:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+
+def info_depth(info: str) -> int:
+    for item in info.split(";"):
+        if item.startswith("DP="):
+            return int(item[3:])
+    return 0
+
+
+class PilonQC:
+    """Aggregate the QC metrics of an iteration contig by contig
+    """
+    columns = ["iteration", "contig", "bases", "mean_depth", "low_coverage_fraction", "ambiguous", "confirmed", "snps", "indels"]
+    missing = "NA" # VCF derived columns of an iteration run without a VCF
+
+    def __init__(self, iteration: int):
+        self.iteration = iteration
+        self.contigs: Dict[str, ContigQC] = {}
+        self.has_vcf = False
+
+    def contig(self, name: str) -> ContigQC:
+        name = PilonChanges.base_contig(name)
+        if name not in self.contigs:
+            self.contigs[name] = ContigQC(contig=name)
+        return self.contigs[name]
+
+    def add_vcf(self, vcf: str):
+        """Count the depth and calls of the first record at each position
+        """
+        self.has_vcf = True
+        last = None
+        for line in read_lines(vcf):
+            if not line or line.startswith("#"):
+                continue
+            fields = line.split("\t", 8)
+            if len(fields) < 8:
+                raise ValueError(f"Malformed line in {vcf}: {line}")
+            chrom, pos, _, _, alt, _, filters, info = fields[:8]
+            if (chrom, pos) == last:
+                continue
+            last = (chrom, pos)
+            qc = self.contig(chrom)
+            qc.bases += 1
+            qc.depth_total += info_depth(info)
+            if "LowCov" in filters:
+                qc.low_coverage += 1
+            if "Amb" in filters:
+                qc.ambiguous += 1
+            if filters == "PASS" and alt == ".":
+                qc.confirmed += 1
+
+    def add_changes(self, changes: str):
+        for change in PilonChanges.records(changes):
+            qc = self.contig(change.contig)
+            if change.is_snp:
+                qc.snps += 1
+            else:
+                qc.indels += 1
+
+    def total(self) -> ContigQC:
+        total = ContigQC(contig="all")
+        for qc in self.contigs.values():
+            total.add(qc)
+        return total
+
+    def rows(self) -> List[List[str]]:
+        """Table rows per contig, the VCF derived columns are NA without a VCF so they cannot be
+        mistaken for a contig without coverage
+        """
+        rows = []
+        for i in self.contigs.values():
+            vcf_columns = [str(i.bases), f"{i.mean_depth:.1f}", f"{i.low_coverage_fraction:.4f}", str(i.ambiguous), str(i.confirmed)]
+            if not self.has_vcf:
+                vcf_columns = [self.missing] * len(vcf_columns)
+            rows.append([str(self.iteration), i.contig, *vcf_columns, str(i.snps), str(i.indels)])
+        return rows
+
+    def write(self, table: str):
+        """Append this iterations rows to a tab separated table, writing the header for a new table
+        """
+        new_table = not os.path.isfile(table)
+        with open(table, "a") as out:
+            if new_table:
+                out.write("\t".join(self.columns) + "\n")
+            out.writelines("\t".join(i) + "\n" for i in self.rows())
+
+    def describe(self) -> str:
+        total = self.total()
+        line = f"Iteration {self.iteration} QC: {len(self.contigs)} contigs, {total.snps} SNPs and {total.indels} indels fixed"
+        if self.has_vcf:
+            line += (f", {total.mean_depth:.1f}x mean depth, {total.low_coverage_fraction:.2%} low coverage, "
+                     f"{total.ambiguous} ambiguous and {total.confirmed} confirmed of {total.bases} bases")
+        return line
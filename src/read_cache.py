@@ -0,0 +1,184 @@
+"""Decode, validate and pair reads once into a cache shared by every iteration, sample and run using them
+
+Each iteration otherwise hands the mapper the reads as given, often gzipped, so decompression is
+paid once per iteration and again whenever the same reads polish another assembly. An entry holds
+the reads with mates checked to be in sync, written uncompressed or as bgzf by a multithreaded
+bgzip. Entries are keyed by the size and sampled content of the read files, not their paths, so
+copies of the same reads share an entry.
+
+Entries are locked with flock, a write lock is held exclusively while an entry is checked for and
+written and the entry lock is held shared while a workflow maps from it, so concurrent samples and
+SLURM tasks can share a cache directory and map the same entry at once. Once the entries grow
+past the size limit the least recently used ones not in use are removed.
+"""
+import os
+import sys
+import json
+import fcntl
+import shutil
+import hashlib
+import subprocess
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple
+from cache import sampled_hash
+from downsample import paired_records
+
+
+ENTRY_VERSION = 1
+
+
+def check_record(record: Tuple[str, ...], reads: str):
+    """Exit on a record whose separator line or quality length does not match its sequence
+    """
+    if not record[2].startswith("+") or len(record[1].rstrip("\r\n")) != len(record[3].rstrip("\r\n")):
+        print(f"Malformed fastq record in {reads}: {record[0].strip()}", flush=True)
+        sys.exit(-1)
+
+
+def content_fingerprint(path: str) -> dict:
+    """Size and sampled hash of a read file, independent of where it is and when it was written
+    """
+    if not os.path.isfile(path):
+        print(f"Reads {path} do not exist", flush=True)
+        sys.exit(-1)
+    size = os.path.getsize(path)
+    return {"size": size, "sample": sampled_hash(path, size)}
+
+
+def directory_bytes(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, i)) for root, _, files in os.walk(path) for i in files)
+
+
+class BgzfWriter:
+    """Text written through bgzip, compressing blocks on several threads
+    """
+
+    def __init__(self, path: str, threads: int):
+        self.path = path
+        self.out = open(path, "wb")
+        self.proc = subprocess.Popen(["bgzip", "-@", str(threads), "-c"], stdin=subprocess.PIPE, stdout=self.out, text=True)
+
+    def writelines(self, lines):
+        self.proc.stdin.writelines(lines)
+
+    def close(self):
+        self.proc.stdin.close()
+        code = self.proc.wait()
+        self.out.close()
+        if code != 0:
+            print(f"bgzip exited with {code} writing {self.path}", flush=True)
+            sys.exit(-1)
+
+
+class ReadCache:
+    """Directory of preprocessed reads, evicted least recently used first once over max_bytes
+    """
+    entry_record = "entry.json"
+    lock_ext = ".lock"
+    write_lock_ext = ".write.lock"
+    plain_ext = ".fastq"
+    bgzf_ext = ".fastq.gz"
+
+    def __init__(self, cache_dir: str, max_bytes: int, bgzf: bool = False, threads: int = 1):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.bgzf = bgzf
+        self.threads = threads
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if bgzf and shutil.which("bgzip") is None:
+            print("bgzip is not on the PATH, it is needed to write the read cache as bgzf", flush=True)
+            sys.exit(-1)
+
+    def key(self, reads: List[str]) -> str:
+        entry = {"version": ENTRY_VERSION, "bgzf": self.bgzf, "reads": [content_fingerprint(i) for i in reads]}
+        return hashlib.sha256(json.dumps(entry, sort_keys=True).encode()).hexdigest()
+
+    def entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def read_paths(self, entry_dir: str, count: int) -> List[str]:
+        ext = self.bgzf_ext if self.bgzf else self.plain_ext
+        return [os.path.join(entry_dir, f"R{idx + 1}{ext}") for idx in range(count)]
+
+    def contains(self, path: str) -> bool:
+        return os.path.abspath(path).startswith(self.cache_dir + os.sep)
+
+    def entries(self) -> List[str]:
+        """Keys of the complete entries, least recently used first
+        """
+        keys = [i for i in os.listdir(self.cache_dir) if os.path.isfile(os.path.join(self.entry_dir(i), self.entry_record))]
+        return sorted(keys, key=lambda i: os.path.getmtime(os.path.join(self.entry_dir(i), self.entry_record)))
+
+    def write_entry(self, reads: List[str], entry_dir: str):
+        """Decode the reads, check each record and that the mates are in sync, writing them into a
+        temporary directory renamed into place once complete
+        """
+        tmp_dir = f"{entry_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        outputs = self.read_paths(tmp_dir, len(reads))
+        writers = [BgzfWriter(i, self.threads) if self.bgzf else open(i, "w") for i in outputs]
+        pairs = 0
+        try:
+            for records in paired_records(reads):
+                for writer, record, source in zip(writers, records, reads):
+                    check_record(record, source)
+                    writer.writelines(record)
+                pairs += 1
+        finally:
+            for writer in writers:
+                writer.close()
+        with open(os.path.join(tmp_dir, self.entry_record), "w") as record:
+            json.dump({"reads": reads, "pairs": pairs, "bgzf": self.bgzf}, record)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.rename(tmp_dir, entry_dir)
+        print(f"Cached {pairs} read pairs from {', '.join(reads)} in {entry_dir}", flush=True)
+
+    @contextmanager
+    def use(self, reads: List[str]) -> Iterator[List[str]]:
+        """Preprocessed reads for the duration of the block, written on first use. The entry is
+        locked shared while in use so it is never evicted from under a running workflow, the write
+        lock is only held while the entry is checked for and written
+        """
+        reads = [os.path.abspath(i) for i in reads]
+        key = self.key(reads)
+        entry_dir = self.entry_dir(key)
+        with open(os.path.join(self.cache_dir, f"{key}{self.lock_ext}"), "a") as lock:
+            try:
+                with open(os.path.join(self.cache_dir, f"{key}{self.write_lock_ext}"), "a") as write_lock:
+                    fcntl.flock(write_lock, fcntl.LOCK_EX)
+                    # taken before checking so eviction cannot remove the entry once it is found
+                    fcntl.flock(lock, fcntl.LOCK_SH)
+                    if not os.path.isfile(os.path.join(entry_dir, self.entry_record)):
+                        self.write_entry(reads, entry_dir)
+                    else:
+                        print(f"Reusing cached reads {entry_dir} for {', '.join(reads)}", flush=True)
+                    os.utime(os.path.join(entry_dir, self.entry_record))
+                self.evict(keep=key)
+                yield self.read_paths(entry_dir, len(reads))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def evict(self, keep: str):
+        """Remove the least recently used entries not in use until the cache fits in max_bytes
+        """
+        with open(os.path.join(self.cache_dir, self.lock_ext), "a") as cache_lock:
+            fcntl.flock(cache_lock, fcntl.LOCK_EX)
+            keys = self.entries()
+            sizes = {i: directory_bytes(self.entry_dir(i)) for i in keys}
+            total = sum(sizes.values())
+            for key in keys:
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                with open(os.path.join(self.cache_dir, f"{key}{self.lock_ext}"), "a") as lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+                total -= sizes[key]
+                print(f"Evicted cached reads {key}, {sizes[key] / 1e6:.1f}MB freed", flush=True)
+            if total > self.max_bytes:
+                print(f"Read cache {self.cache_dir} holds {total / 1e9:.2f}GB in use, over its {self.max_bytes / 1e9:.2f}GB limit", flush=True)
@@ -0,0 +1,89 @@
+"""Record the resources used by every step of a run
+
+Each step is written as a line of JSON as soon as it finishes, a summary table can be printed per
+iteration and the totals can be exported as a Prometheus textfile for the node exporter.
+"""
+import os
+import json
+import time
+import threading
+from typing import List
+from dataclasses import dataclass, asdict, field
+
+
+def file_bytes(paths: List[str]) -> int:
+    return sum(os.path.getsize(i) for i in paths if os.path.isfile(i))
+
+
+@dataclass
+class StepRecord:
+    """Resource usage of a single executed step, times are in seconds and peak RSS in KB
+    """
+    step: str
+    command: str
+    iteration: int = None
+    started: float = field(default_factory=time.time)
+    wall_time: float = 0.0
+    user_time: float = 0.0
+    system_time: float = 0.0
+    max_rss_kb: int = 0
+    exit_code: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    cached: bool = False
+
+
+class RunReport:
+    """Collect step records for a run into a JSON lines file, a resumed run adds its records to
+    those of the runs before it
+    """
+    summary_columns = ["step", "wall_time", "user_time", "system_time", "max_rss_kb", "bytes_read", "bytes_written", "exit_code"]
+    metric_prefix = "pilonpolisher_step"
+    metrics = {"wall_time": "wall_seconds", "user_time": "user_seconds", "system_time": "system_seconds",
+               "max_rss_kb": "max_rss_kilobytes", "bytes_read": "read_bytes", "bytes_written": "written_bytes",
+               "exit_code": "exit_code"}
+
+    def __init__(self, report: str, sample: str = None, prometheus: str = None, resume: bool = False):
+        self.report = report
+        self.sample = sample
+        self.prometheus = prometheus
+        self.records: List[StepRecord] = []
+        self.__lock = threading.Lock()
+        open(self.report, "a" if resume else "w").close()
+
+    def add(self, record: StepRecord):
+        with self.__lock:
+            self.records.append(record)
+            with open(self.report, "a") as report:
+                report.write(json.dumps(asdict(record)) + "\n")
+            if self.prometheus is not None:
+                self.write_prometheus()
+
+    def summary(self, iteration: int = None) -> str:
+        """Table of the steps run in an iteration, or every step when no iteration is given
+        """
+        records = [i for i in self.records if iteration is None or i.iteration == iteration]
+        rows = [[i.step, f"{i.wall_time:.1f}", f"{i.user_time:.1f}", f"{i.system_time:.1f}", str(i.max_rss_kb),
+                 str(i.bytes_read), str(i.bytes_written), "cached" if i.cached else str(i.exit_code)] for i in records]
+        widths = [max(len(j) for j in column) for column in zip(self.summary_columns, *rows)]
+        lines = ["  ".join(j.ljust(k) for j, k in zip(row, widths)) for row in [self.summary_columns, *rows]]
+        return "\n".join(lines)
+
+    def write_prometheus(self):
+        """Write the latest record of each step as gauges, renamed into place so the exporter never
+        reads a partial file
+        """
+        latest = {}
+        for record in self.records:
+            latest[(record.step, record.iteration)] = record
+        lines = []
+        for attribute, metric in self.metrics.items():
+            name = f"{self.metric_prefix}_{metric}"
+            lines.append(f"# TYPE {name} gauge")
+            for (step, iteration), record in latest.items():
+                labels = f'sample="{self.sample or ""}",step="{step}",iteration="{"" if iteration is None else iteration}"'
+                lines.append(f"{name}{{{labels}}} {float(getattr(record, attribute))}")
+        tmp_prometheus = f"{self.prometheus}.tmp"
+        with open(tmp_prometheus, "w") as textfile:
+            textfile.write("\n".join(lines) + "\n")
+        os.replace(tmp_prometheus, self.prometheus)
@@ -0,0 +1,162 @@
+"""Divide a thread and memory budget between the tools run in a polishing workflow, and estimate
+the heap Pilon needs from the size of the assembly and the depth of the reads mapped to it
+"""
+import os
+import gzip
+import math
+from typing import Dict, Iterator, List
+from dataclasses import dataclass
+
+
+def available_threads() -> int:
+    """Number of cores this process may be scheduled on
+    """
+    return len(os.sched_getaffinity(0))
+
+
+def open_reads(reads: str):
+    """Open a fastq file as text whether or not it is gzipped
+    """
+    with open(reads, "rb") as magic:
+        gzipped = magic.read(2) == b"\x1f\x8b"
+    return gzip.open(reads, "rt") if gzipped else open(reads, "r")
+
+
+def read_lines(path: str, chunk_size: int = 1 << 20) -> Iterator[str]:
+    """Lines of a plain, gzipped or bgzipped text file read in fixed size chunks so memory use does
+    not grow with the file
+    """
+    with open(path, "rb") as magic:
+        gzipped = magic.read(2) == b"\x1f\x8b"
+    with (gzip.open(path, "rb") if gzipped else open(path, "rb")) as data:
+        remainder = b""
+        while True:
+            chunk = data.read(chunk_size)
+            if not chunk:
+                break
+            lines = (remainder + chunk).split(b"\n")
+            remainder = lines.pop()
+            for line in lines:
+                yield line.decode()
+        if remainder:
+            yield remainder.decode()
+
+
+def sample_read_length(reads: List[str], records: int = 1000) -> int:
+    """Mean read length of the first records of each fastq file
+    """
+    lengths = []
+    for read_file in reads:
+        with open_reads(read_file) as fastq:
+            for idx, line in enumerate(fastq):
+                if idx // 4 >= records:
+                    break
+                if idx % 4 == 1:
+                    lengths.append(len(line.strip()))
+    return int(sum(lengths) / len(lengths)) if lengths else 0
+
+
+def parse_idxstats(idxstats: str) -> Dict[str, int]:
+    """Mapped read counts per contig from samtools idxstats output
+    """
+    mapped = {}
+    with open(idxstats, "r") as stats:
+        for line in stats:
+            fields = line.split("\t")
+            if len(fields) >= 3 and fields[0] != "*":
+                mapped[fields[0]] = int(fields[2])
+    return mapped
+
+
+@dataclass(frozen=True)
+class HeapEstimate:
+    """Pilon heap (GB) predicted for an assembly from its size and the depth of reads mapped to it
+
+    The JVM needs a fixed overhead, Pilon then holds per base pileup state for the whole genome
+    which grows with depth: overhead + Mb * (per_mb + per_mb_depth * depth)
+    """
+    genome_size: int
+    mapped_reads: int
+    read_length: int
+    overhead: float = 1.0
+    per_mb: float = 0.3
+    per_mb_depth: float = 0.007
+    min_heap: int = 2
+
+    @property
+    def depth(self) -> float:
+        return self.mapped_reads * self.read_length / self.genome_size if self.genome_size else 0.0
+
+    @property
+    def heap(self) -> int:
+        genome_mb = self.genome_size / 1e6
+        return max(self.min_heap, math.ceil(self.overhead + genome_mb * (self.per_mb + self.per_mb_depth * self.depth)))
+
+    def describe(self) -> str:
+        return f"Estimated Pilon heap {self.heap}G for {self.genome_size / 1e6:.2f}Mb at {self.depth:.0f}x depth"
+
+
+@dataclass(frozen=True)
+class ResourceBudget:
+    """Threads and memory (GB) available to a workflow, and how they are split between tools
+
+    The mapper (minimap2 or bwa-mem2) and samtools sort run at the same time when mapping is piped,
+    so the sort is given a quarter of the threads and half of the memory while the mapper keeps the
+    remaining threads.
+    Pilon runs alone and is handed every thread, its JVM heap is the pilon_ram override if set
+    otherwise an estimate of its needs capped at the full memory budget.
+    """
+    threads: int = 1
+    memory: int = 4
+    pilon_ram: int = None
+    sort_fraction: float = 0.25
+    sort_memory_fraction: float = 0.5
+    min_sort_memory_mb: int = 256
+
+    @property
+    def sort_threads(self) -> int:
+        return max(1, int(self.threads * self.sort_fraction))
+
+    @property
+    def mapper_threads(self) -> int:
+        return max(1, self.threads - self.sort_threads)
+
+    @property
+    def sort_memory_mb(self) -> int:
+        """Memory per samtools sort thread, passed to samtools sort -m
+        """
+        sort_memory = int(self.memory * 1024 * self.sort_memory_fraction)
+        return max(self.min_sort_memory_mb, sort_memory // self.sort_threads)
+
+    @property
+    def sort_memory(self) -> int:
+        """GB held by samtools sort across all its threads, rounded up, for the scheduler to book
+        """
+        return -(-self.sort_threads * self.sort_memory_mb // 1024)
+
+    @property
+    def pilon_threads(self) -> int:
+        return self.threads
+
+    @property
+    def pilon_heap(self) -> int:
+        return self.pilon_ram if self.pilon_ram is not None else self.memory
+
+    def fit_heap(self, estimate: HeapEstimate) -> int:
+        """Heap to give Pilon for an estimate, a fixed pilon_ram always wins
+        """
+        if self.pilon_ram is not None:
+            return self.pilon_ram
+        return min(estimate.heap, self.memory)
+
+    def sort_args(self):
+        return ["-@", str(self.sort_threads), "-m", f"{self.sort_memory_mb}M"]
+
+    def describe(self) -> str:
+        """Human readable summary of the split for the run log
+        """
+        return (f"Resource budget: {self.threads} threads, {self.memory}GB memory. "
+                f"mapper -t {self.mapper_threads}; "
+                f"samtools {' '.join(self.sort_args())}; "
+                f"pilon --threads {self.pilon_threads} " +
+                (f"-Xmx{self.pilon_ram}G" if self.pilon_ram is not None else f"heap estimated per iteration up to {self.memory}G"))
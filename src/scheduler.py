@@ -0,0 +1,46 @@
+"""Admit steps from concurrently running workflows against a shared core and memory budget
+"""
+import threading
+from contextlib import contextmanager
+
+
+class ResourceScheduler:
+    """Block each step until the threads and memory (GB) it declares are free
+
+    A request larger than the whole budget is clamped to the budget, so it waits for every other
+    step to finish and then runs alone rather than never being admitted.
+    """
+
+    def __init__(self, threads: int, memory: int):
+        self.threads = threads
+        self.memory = memory
+        self.free_threads = threads
+        self.free_memory = memory
+        self.__condition = threading.Condition()
+
+    def clamp(self, threads: int, memory: int):
+        return min(max(1, threads), self.threads), min(max(0, memory), self.memory)
+
+    def acquire(self, threads: int, memory: int):
+        threads, memory = self.clamp(threads, memory)
+        with self.__condition:
+            self.__condition.wait_for(lambda: threads <= self.free_threads and memory <= self.free_memory)
+            self.free_threads -= threads
+            self.free_memory -= memory
+
+    def release(self, threads: int, memory: int):
+        threads, memory = self.clamp(threads, memory)
+        with self.__condition:
+            self.free_threads += threads
+            self.free_memory += memory
+            self.__condition.notify_all()
+
+    @contextmanager
+    def reserve(self, threads: int, memory: int):
+        """Hold threads and memory for the duration of a step
+        """
+        self.acquire(threads, memory)
+        try:
+            yield
+        finally:
+            self.release(threads, memory)
@@ -0,0 +1,130 @@
+"""Run a workflow on node local scratch rather than a shared filesystem
+
+Inputs are copied to the scratch directory once, every step then reads and writes there and only
+the outputs left at the end are copied back, each renamed into place so a partially copied file is
+never seen. The scratch directory is removed on exit, on error and on SIGTERM or SIGHUP.
+"""
+import os
+import sys
+import atexit
+import signal
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import List
+
+
+_active = set()
+
+
+def cleanup_all():
+    for space in list(_active):
+        space.cleanup()
+
+
+atexit.register(cleanup_all)
+
+
+def exit_on_signal(signum, frame):
+    """Turn a termination signal into SystemExit so context managers clean up on the way out, scratch
+    held by other threads is removed first as those threads may not get the chance
+    """
+    cleanup_all()
+    raise SystemExit(128 + signum)
+
+
+@contextmanager
+def exit_on_termination():
+    """Handle SIGTERM and SIGHUP with exit_on_signal for the duration of the block. Only the main
+    thread may install handlers, so scratch entered on worker threads relies on this being held
+    around them
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    previous_handlers = {i: signal.signal(i, exit_on_signal) for i in ScratchSpace.signals}
+    try:
+        yield
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+
+
+class ScratchSpace:
+    """A private directory under a scratch root holding staged inputs and the working outputs
+    """
+    input_dir = "inputs"
+    signals = (signal.SIGTERM, signal.SIGHUP)
+
+    def __init__(self, root: str, prefix: str, exclude: List[str] = None):
+        self.root = os.path.abspath(root)
+        self.prefix = prefix
+        self.exclude = set(exclude or [])
+        self.path = None
+        self.work_dir = None
+        self.staged = []
+        self.handlers = None
+
+    def __enter__(self):
+        if not os.path.isdir(self.root):
+            print(f"Scratch directory {self.root} does not exist", flush=True)
+            sys.exit(-1)
+        self.path = tempfile.mkdtemp(prefix=f"pilonpolisher_{self.prefix}_", dir=self.root)
+        self.work_dir = os.path.join(self.path, "work")
+        os.mkdir(self.work_dir)
+        os.mkdir(os.path.join(self.path, self.input_dir))
+        _active.add(self)
+        self.handlers = exit_on_termination()
+        self.handlers.__enter__()
+        print(f"Working in scratch directory {self.path}", flush=True)
+        return self
+
+    def __exit__(self, *exc):
+        self.handlers.__exit__(None, None, None)
+        self.cleanup()
+        return False
+
+    def cleanup(self):
+        if self.path is not None and os.path.isdir(self.path):
+            shutil.rmtree(self.path, ignore_errors=True)
+        _active.discard(self)
+
+    def contains(self, path: str) -> bool:
+        return os.path.abspath(path).startswith(self.path + os.sep)
+
+    def stage(self, path: str) -> str:
+        """Copy an input into scratch, files already in scratch are left where they are
+        """
+        if self.contains(path):
+            return path
+        # numbered so inputs with the same file name in different directories do not collide
+        staged = os.path.join(self.path, self.input_dir, f"{len(self.staged)}_{os.path.basename(path)}")
+        shutil.copyfile(path, staged)
+        self.staged.append(staged)
+        return staged
+
+    def sync(self, destination: str) -> List[str]:
+        """Copy every file left in the work directory to the destination, each copied beside its
+        final name then renamed into place
+        """
+        synced = []
+        for root, dirs, files in os.walk(self.work_dir):
+            dirs[:] = [i for i in dirs if i not in self.exclude]
+            target_dir = os.path.join(destination, os.path.relpath(root, self.work_dir))
+            os.makedirs(target_dir, exist_ok=True)
+            for name in files:
+                target = os.path.join(target_dir, name)
+                tmp_target = os.path.join(target_dir, f".{name}.{os.getpid()}.tmp")
+                shutil.copyfile(os.path.join(root, name), tmp_target)
+                os.replace(tmp_target, target)
+                synced.append(target)
+        print(f"Copied {len(synced)} outputs from scratch to {destination}", flush=True)
+        return synced
+
+    def final_path(self, path: str, destination: str) -> str:
+        """Where a file in the work directory ends up once synced
+        """
+        if not self.contains(path):
+            return path
+        return os.path.join(destination, os.path.relpath(path, self.work_dir))
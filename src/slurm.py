@@ -0,0 +1,196 @@
+"""Submit workflow steps, or whole samples, to a SLURM cluster
+
+Each job is a bash script submitted with sbatch and sized from the threads and memory its steps
+declare. Jobs are polled with squeue while they are queued or running, once they leave the queue
+their final state and exit code are read from sacct. A batch of samples is submitted as one job
+array, its tasks select their sample from SLURM_ARRAY_TASK_ID.
+
+The work directories must be on a filesystem shared by the submitting host and the compute nodes.
+"""
+import os
+import sys
+import time
+import shlex
+import shutil
+import tempfile
+from subprocess import run, PIPE
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+
+COMPLETED = "COMPLETED"
+OUT_OF_MEMORY = "OUT_OF_MEMORY"
+UNKNOWN = "UNKNOWN"
+
+
+def exit_code(sacct_exit: str) -> int:
+    """Exit code from the code:signal pair sacct reports, a signal is reported as 128 + signal
+    """
+    code, _, signum = sacct_exit.partition(":")
+    if signum and int(signum):
+        return 128 + int(signum)
+    return int(code or 0)
+
+
+@dataclass
+class SlurmJob:
+    """A submitted job, or job array of tasks, and the final state of each task once known
+    """
+    job_id: str
+    name: str
+    tasks: int = None
+    log: str = None
+    results: Dict[str, Tuple[str, int]] = field(default_factory=dict)
+    unaccounted_polls: int = 0
+
+    def task_ids(self) -> List[str]:
+        if self.tasks is None:
+            return [self.job_id]
+        return [f"{self.job_id}_{i}" for i in range(self.tasks)]
+
+    def finished(self) -> bool:
+        return all(i in self.results for i in self.task_ids())
+
+    def failed(self) -> List[str]:
+        return [i for i in self.task_ids() if self.results.get(i, (UNKNOWN, -1)) != (COMPLETED, 0)]
+
+    def exit_code(self) -> int:
+        codes = [self.results.get(i, (UNKNOWN, -1))[1] for i in self.failed()]
+        return next((i for i in codes if i != 0), -1) if codes else 0
+
+    def log_tail(self, lines: int = 20) -> List[str]:
+        """Last lines of the output of a single job, which holds its stderr
+        """
+        if self.log is None or not os.path.isfile(self.log):
+            return []
+        with open(self.log, "rb") as log:
+            log.seek(max(0, os.path.getsize(self.log) - 64 * 1024))
+            return [i.decode(errors="replace").rstrip() for i in log.readlines()[-lines:]]
+
+    def describe(self, task_id: str = None) -> str:
+        state, code = self.results.get(task_id or self.job_id, (UNKNOWN, -1))
+        return f"job {task_id or self.job_id} ({self.name}) {state} with exit code {code}"
+
+
+class SlurmCluster:
+    """Submit jobs with sbatch and follow them with squeue and sacct
+
+    Tools use more resident memory than the heap or buffers they declare, so every job requests
+    memory_headroom GB above its declared memory. A job that has left the queue but is still missing
+    from sacct after accounting_polls polls is treated as failed, as accounting is written shortly
+    after a job ends.
+    """
+    commands = ["sbatch", "squeue", "sacct", "scancel"]
+    memory_headroom = 1
+    accounting_polls = 12
+
+    def __init__(self, log_dir: str, partition: str = None, account: str = None, time_limit: str = None,
+                 poll_interval: float = 10.0, extra_args: List[str] = None):
+        self.log_dir = os.path.abspath(log_dir)
+        self.partition = partition
+        self.account = account
+        self.time_limit = time_limit
+        self.poll_interval = poll_interval
+        self.extra_args = list(extra_args or [])
+
+    def check(self):
+        missing = [i for i in self.commands if shutil.which(i) is None]
+        if missing:
+            print(f"SLURM commands {', '.join(missing)} are not in the path", flush=True)
+            sys.exit(-1)
+
+    def write_script(self, name: str, commands: List[str]) -> str:
+        os.makedirs(self.log_dir, exist_ok=True)
+        handle, script = tempfile.mkstemp(prefix=f"{name}_", suffix=".sh", dir=self.log_dir)
+        with os.fdopen(handle, "w") as out:
+            out.write("#!/bin/bash\nset -eo pipefail\n")
+            out.writelines(f"{i}\n" for i in commands)
+        return script
+
+    def log_path(self, name: str, tasks: int = None) -> str:
+        return os.path.join(self.log_dir, f"{name}_%A_%a.log" if tasks is not None else f"{name}_%j.log")
+
+    def sbatch_command(self, name: str, script: str, threads: int, memory: int, tasks: int = None, max_running: int = None) -> List[str]:
+        log = self.log_path(name, tasks)
+        command = ["sbatch", "--parsable", f"--job-name={name}", f"--cpus-per-task={max(1, threads)}",
+                   f"--mem={max(1, memory) + self.memory_headroom}G", f"--output={log}", f"--chdir={os.getcwd()}"]
+        if self.partition is not None:
+            command.append(f"--partition={self.partition}")
+        if self.account is not None:
+            command.append(f"--account={self.account}")
+        if self.time_limit is not None:
+            command.append(f"--time={self.time_limit}")
+        if tasks is not None:
+            command.append(f"--array=0-{tasks - 1}" + (f"%{max_running}" if max_running else ""))
+        return [*command, *self.extra_args, script]
+
+    def submit(self, name: str, commands: List[str], threads: int, memory: int, tasks: int = None, max_running: int = None) -> SlurmJob:
+        """Submit shell commands as a job, or as a job array of tasks running the same commands
+        """
+        script = self.write_script(name, commands)
+        proc = run(self.sbatch_command(name, script, threads, memory, tasks, max_running), stdout=PIPE, stderr=PIPE, text=True)
+        if proc.returncode != 0:
+            print(f"sbatch could not submit {name}: {proc.stderr.strip()}", flush=True)
+            sys.exit(-1)
+        # --parsable prints the job id, followed by the cluster name on federated clusters
+        job = SlurmJob(job_id=proc.stdout.strip().split(";")[0], name=name, tasks=tasks)
+        if tasks is None:
+            job.log = self.log_path(name).replace("%j", job.job_id)
+        print(f"Submitted {name} as SLURM job {job.job_id}", flush=True)
+        return job
+
+    def queued(self, jobs: List[SlurmJob]) -> set:
+        """Ids of the jobs still pending or running, a failed query counts every job as queued
+        """
+        proc = run(["squeue", "--noheader", f"--jobs={','.join(i.job_id for i in jobs)}", "--format=%i"],
+                   stdout=PIPE, stderr=PIPE, text=True)
+        if proc.returncode != 0:
+            if "Invalid job id" in proc.stderr:
+                return set()  # every job has finished and been purged from the controller
+            return {i.job_id for i in jobs}
+        return {i.split("_")[0] for i in proc.stdout.split()}
+
+    def accounting(self, jobs: List[SlurmJob]) -> Dict[str, Tuple[str, int]]:
+        proc = run(["sacct", "--noheader", "--parsable2", "--allocations", f"--jobs={','.join(i.job_id for i in jobs)}",
+                    "--format=JobID,State,ExitCode"], stdout=PIPE, stderr=PIPE, text=True)
+        results = {}
+        for line in proc.stdout.splitlines():
+            fields = line.split("|")
+            if len(fields) == 3:
+                # states such as "CANCELLED by 1000" carry the user that cancelled the job
+                results[fields[0]] = (fields[1].split()[0], exit_code(fields[2]))
+        return results
+
+    def poll(self, jobs: List[SlurmJob]) -> bool:
+        """Update the jobs that have left the queue with their final state, true once every job has finished
+        """
+        pending = [i for i in jobs if not i.finished()]
+        if not pending:
+            return True
+        queued = self.queued(pending)
+        done = [i for i in pending if i.job_id not in queued]
+        if not done:
+            return False
+        results = self.accounting(done)
+        for job in done:
+            job.results.update({i: results[i] for i in job.task_ids() if i in results})
+            if not job.finished():
+                job.unaccounted_polls += 1
+                if job.unaccounted_polls >= self.accounting_polls:
+                    job.results.update({i: (UNKNOWN, -1) for i in job.task_ids() if i not in job.results})
+        return all(i.finished() for i in jobs)
+
+    def wait(self, jobs: List[SlurmJob]):
+        while not self.poll(jobs):
+            time.sleep(self.poll_interval)
+
+    def cancel(self, jobs: List[SlurmJob]):
+        if jobs:
+            run(["scancel", *[i.job_id for i in jobs]], stdout=PIPE, stderr=PIPE)
+
+
+def shell_command(commands: List[List[str]], stdout: str = None) -> str:
+    """Commands piped together as one line of shell, with the last stdout redirected to a file
+    """
+    line = " | ".join(shlex.join(i) for i in commands)
+    return f"{line} > {shlex.quote(stdout)}" if stdout is not None else line
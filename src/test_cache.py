@@ -0,0 +1,37 @@
+"""Verify that completed steps are recorded and skipped when resuming
+"""
+
+from cache import StepCache, fingerprint
+from tools import Executor, ExecutionContext
+
+
+def touch_step(output, context):
+    step = Executor("Samtools", None, output, context=context, outputs=[output])
+    step.initialized.binary = "touch"
+    return step
+
+
+def test_key_follows_inputs(tmp_path):
+    reads = tmp_path / "reads.fq"
+    reads.write_text("@r1\nACGT\n+\nIIII\n")
+    key = StepCache.key([["minimap2", str(reads)]], ["2.26"], [str(reads)])
+    assert key == StepCache.key([["minimap2", str(reads)]], ["2.26"], [str(reads)])
+    assert key != StepCache.key([["minimap2", str(reads)]], ["2.24"], [str(reads)])
+    reads.write_text("@r1\nACGA\n+\nIIII\n")
+    assert key != StepCache.key([["minimap2", str(reads)]], ["2.26"], [str(reads)])
+    assert fingerprint(str(tmp_path / "missing")) == {"missing": True}
+
+
+def test_resume_skips_current_steps(tmp_path, capsys):
+    output = str(tmp_path / "out.txt")
+    touch_step(output, ExecutionContext(cache=StepCache(str(tmp_path)))).execute()
+    assert "Executing" in capsys.readouterr().out
+
+    resumed = ExecutionContext(cache=StepCache(str(tmp_path), resume=True))
+    touch_step(output, resumed).execute()
+    assert "Skipping" in capsys.readouterr().out
+
+    with open(output, "a") as changed:
+        changed.write("changed")
+    touch_step(output, resumed).execute()
+    assert "Executing" in capsys.readouterr().out
@@ -0,0 +1,38 @@
+"""Verify steps are dispatched through a single persistent container instance
+"""
+
+import os
+import stat
+from tools import ContainerInstance, Executor, ExecutionContext, ExecutorOptions
+
+
+FAKE_APPTAINER = """#!/bin/sh
+echo "$@" >> "{log}"
+if [ "$1" = "exec" ]; then
+    shift 2
+    exec "$@"
+fi
+"""
+
+
+def test_instance_dispatches_with_exec(tmp_path, monkeypatch):
+    log = tmp_path / "apptainer.log"
+    fake = tmp_path / "apptainer"
+    fake.write_text(FAKE_APPTAINER.format(log=log))
+    fake.chmod(fake.stat().st_mode | stat.S_IEXEC)
+    image = tmp_path / "HybridPolisher.sif"
+    image.touch()
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+    output = tmp_path / "out.txt"
+    with ContainerInstance([str(tmp_path)], image=str(image), runtime=ExecutorOptions.apptainer) as instance:
+        step = Executor("Samtools", None, str(output), context=ExecutionContext(instance=instance))
+        step.initialized.binary = "touch"
+        assert step.create_cmd()[:3] == ["apptainer", "exec", f"instance://{instance.name}"]
+        step.execute()
+        # building commands for logging or cache keys is not a dispatch
+        assert instance.dispatched == 1
+    calls = log.read_text().splitlines()
+    assert calls[0].startswith("instance start --bind")
+    assert calls[-1] == f"instance stop {instance.name}"
+    assert output.exists()
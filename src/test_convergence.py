@@ -0,0 +1,35 @@
+"""Verify parsing of Pilon changes files and the convergence decisions made from them
+"""
+
+from convergence import PilonChanges, ConvergenceTracker
+
+
+def write_changes(path, lines):
+    path.write_text("".join(f"{i}\n" for i in lines))
+    return str(path)
+
+
+def test_parse_changes(tmp_path):
+    changes = write_changes(tmp_path / "test_0.changes", [
+        "contig_1:100 contig_1_pilon:100 A G",
+        "contig_1:200-202 contig_1_pilon:199 ACG .",
+        "contig_2_pilon:50 contig_2_pilon_pilon:50-51 . TT",
+    ])
+    parsed = PilonChanges.parse(changes)
+    assert parsed.total == 3
+    assert parsed.per_contig() == {"contig_1": 2, "contig_2": 1}
+    assert parsed.changes[0].is_snp and not parsed.changes[1].is_snp
+    assert parsed.changes[1].stop == 202
+
+
+def test_converges_under_threshold(tmp_path):
+    tracker = ConvergenceTracker(min_changes=1)
+    assert not tracker.update(write_changes(tmp_path / "a.changes", ["c:1 c_pilon:1 A G", "c:9 c_pilon:9 A G"]), 0)
+    assert tracker.update(write_changes(tmp_path / "b.changes", ["c_pilon:5 c_pilon_pilon:5 T C"]), 1)
+
+
+def test_detects_oscillation(tmp_path):
+    tracker = ConvergenceTracker()
+    assert not tracker.update(write_changes(tmp_path / "a.changes", ["c:10 c_pilon:11 A G"]), 0)
+    assert tracker.update(write_changes(tmp_path / "b.changes", ["c_pilon:11 c_pilon_pilon:11 G A"]), 1)
+    assert "undo" in tracker.reason
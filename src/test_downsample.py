@@ -0,0 +1,56 @@
+"""Verify depth estimation and mate synced downsampling of read pairs
+"""
+
+import gzip
+import random
+import pytest
+from downsample import ReadDownsampler, estimate_depth, sample_depth, paired_records, read_name
+
+
+def write_pairs(tmp_path, pairs, length=100, mismatch_at=None):
+    reads = [str(tmp_path / "reads_R1.fastq.gz"), str(tmp_path / "reads_R2.fastq")]
+    with gzip.open(reads[0], "wt") as r1, open(reads[1], "w") as r2:
+        for idx in range(pairs):
+            r1.write(f"@pair{idx}/1 comment\n{'A' * length}\n+\n{'I' * length}\n")
+            mate = "other" if idx == mismatch_at else "pair"
+            r2.write(f"@{mate}{idx}/2\n{'C' * length}\n+\n{'I' * length}\n")
+    return reads
+
+
+def test_estimate_depth(tmp_path):
+    estimate = estimate_depth(write_pairs(tmp_path, 50), genome_size=1000)
+    assert estimate.pairs == 50 and estimate.depth == 10
+    assert estimate.fraction(5) == 0.5 and estimate.fraction(20) == 1.0
+
+
+def test_sampled_depth_scales_a_prefix(tmp_path):
+    rng = random.Random(1)
+    reads = [str(tmp_path / "random_R1.fastq.gz"), str(tmp_path / "random_R2.fastq")]
+    with gzip.open(reads[0], "wt") as r1, open(reads[1], "w") as r2:
+        for idx in range(5000):
+            for mate, out in enumerate([r1, r2]):
+                seq = "".join(rng.choices("ACGT", k=100))
+                out.write(f"@pair{idx}/{mate + 1}\n{seq}\n+\n{'I' * 100}\n")
+    assert sample_depth(reads, 1000, records=10000) == estimate_depth(reads, 1000)
+    estimate = sample_depth(reads, 1000, records=500)
+    assert estimate.sampled and abs(estimate.depth - 1000) < 50 and abs(estimate.pairs - 5000) < 250
+
+
+def test_downsample_keeps_mates_together(tmp_path):
+    reads = write_pairs(tmp_path, 2000)
+    first = ReadDownsampler(reads, 1000, str(tmp_path), "a", target_depth=100).downsample()
+    second = ReadDownsampler(reads, 1000, str(tmp_path), "b", target_depth=100).downsample()
+    names = [[read_name(i[0]) for i in pair] for pair in paired_records(first)]
+    assert all(r1 == r2 for r1, r2 in names)
+    assert 400 < len(names) < 600
+    assert names == [[read_name(i[0]) for i in pair] for pair in paired_records(second)]
+
+
+def test_shallow_reads_are_used_as_is(tmp_path):
+    reads = write_pairs(tmp_path, 10)
+    assert ReadDownsampler(reads, 1000, str(tmp_path), "a", target_depth=100).downsample() == reads
+
+
+def test_out_of_sync_mates(tmp_path):
+    with pytest.raises(SystemExit):
+        estimate_depth(write_pairs(tmp_path, 10, mismatch_at=3), genome_size=1000)
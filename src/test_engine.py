@@ -0,0 +1,86 @@
+"""Verify the workflow graph overlaps independent steps, orders dependent ones and stops on failure
+"""
+
+import time
+import pytest
+from engine import WorkflowEngine
+from tools import Executor, ExecutionContext, StepFailure, OutOfMemoryFailure
+
+
+def shell_step(*args, **kwargs):
+    """Samtools executor with its binary swapped for a shell utility
+    """
+    step = Executor("Samtools", None, *args[1:], **kwargs)
+    step.initialized.binary = args[0]
+    return step
+
+
+def test_independent_steps_overlap():
+    engine = WorkflowEngine(jobs=2)
+    engine.add(shell_step("sleep", "0.5"))
+    engine.add(shell_step("sleep", "0.5"))
+    start = time.perf_counter()
+    engine.run()
+    assert time.perf_counter() - start < 0.9
+
+
+def test_dependencies_follow_files(tmp_path):
+    first, second = str(tmp_path / "first.txt"), str(tmp_path / "second.txt")
+    context = ExecutionContext()
+    context.engine = WorkflowEngine(context, jobs=4)
+    context.submit(shell_step("sh", "-c", f"sleep 0.2; echo polished > {first}", outputs=[first]))
+    context.submit(shell_step("cat", first, inputs=[first], stdout=second))
+    assert context.engine.nodes[1].depends_on == [context.engine.nodes[0]]
+    context.flush()
+    assert open(second).read() == "polished\n"
+
+
+def test_failure_cancels_running_steps():
+    engine = WorkflowEngine(jobs=2)
+    engine.add(shell_step("sleep", "10"))
+    engine.add(shell_step("sh", "-c", "sleep 0.2; exit 3"))
+    start = time.perf_counter()
+    with pytest.raises(SystemExit):
+        engine.run()
+    assert time.perf_counter() - start < 5
+
+
+def test_step_timeout():
+    engine = WorkflowEngine(timeout=0.2)
+    engine.add(shell_step("sleep", "10"))
+    with pytest.raises(SystemExit):
+        engine.run()
+
+
+def test_failures_are_typed_with_stderr_tail():
+    engine = WorkflowEngine()
+    engine.add(shell_step("sh", "-c", "echo starting >&2; echo 'java.lang.OutOfMemoryError: Java heap space' >&2; exit 1"))
+    with pytest.raises(OutOfMemoryFailure) as failure:
+        engine.run(recoverable=(OutOfMemoryFailure,))
+    assert failure.value.exit_code == 1 and failure.value.stderr_tail[-1].endswith("Java heap space")
+
+    engine.add(shell_step("sh", "-c", "echo bad input >&2; exit 2"))
+    with pytest.raises(StepFailure) as failure:
+        engine.run(recoverable=(StepFailure,))
+    assert not isinstance(failure.value, OutOfMemoryFailure) and "bad input" in failure.value.describe()
+
+
+def test_pipeline_blames_the_stage_a_broken_pipe_fed():
+    engine = WorkflowEngine()
+    engine.add(shell_step("yes"), shell_step("sh", "-c", "head -c 1 >/dev/null; echo 'Out of memory' >&2; exit 3"))
+    with pytest.raises(OutOfMemoryFailure) as failure:
+        engine.run(recoverable=(StepFailure,))
+    assert failure.value.exit_code == 3
+
+
+def test_executor_checks_exit_code():
+    with pytest.raises(SystemExit):
+        shell_step("false").execute()
+
+
+def test_unstartable_stage_is_a_step_failure():
+    engine = WorkflowEngine()
+    engine.add(shell_step("yes"), shell_step("pilonpolisher-missing-binary"))
+    with pytest.raises(StepFailure) as failure:
+        engine.run(recoverable=(StepFailure,))
+    assert "could not be started" in failure.value.describe()
@@ -0,0 +1,68 @@
+"""Verify alignments are lifted across Pilon's edits and reads near edits are pulled out for realignment
+"""
+
+import io
+import os
+import json
+
+from liftover import EditMap, AlignmentLifter
+from Workflows import PolishWorkflow, PolishAssembly, IdxMapReads
+
+CHANGES = """tig:100 tig_pilon:100 A C
+tig:200-202 tig_pilon:200 ACG .
+tig:300 tig_pilon:298-299 . GG
+"""
+
+SAM = """@HD\tVN:1.6\tSO:coordinate
+@SQ\tSN:tig\tLN:1000
+@PG\tID:minimap2\tPN:minimap2
+pairA\t99\ttig\t20\t60\t10M\t=\t400\t390\tAAAAACCCCC\tIIIIIIIIII\tNM:i:0
+pairB\t65\ttig\t195\t60\t10M\t=\t500\t315\tACGTACGTAA\tIIIIIIIIII
+pairA\t147\ttig\t400\t60\t10M\t=\t20\t-390\tGGGGGTTTTT\tIIIIIIIIII\tSA:Z:tig,10,+,5M5S,60,0;
+pairB\t145\ttig\t500\t60\t10M\t=\t195\t-315\tTTTTTCCCCC\t*
+pairB\t2193\ttig\t700\t0\t5H5M\t=\t195\t0\tTTTTT\tIIIII
+pairU\t77\t*\t0\t0\t*\t*\t0\t0\tAAAA\tIIII
+pairU\t141\t*\t0\t0\t*\t*\t0\t0\tCCCC\tIIII
+"""
+
+
+def test_edit_map_shifts_and_windows(tmp_path):
+    changes = tmp_path / "polished.changes"
+    changes.write_text(CHANGES)
+    edits = EditMap(str(changes), flank=10).contig("tig_pilon")
+    assert [edits.shift(i) for i in (50, 150, 250, 400)] == [0, 0, -3, -1]
+    assert list(zip(edits.window_starts, edits.window_stops)) == [(90, 110), (190, 212), (290, 310)]
+
+
+def test_lifter_moves_alignments_and_extracts_pairs(tmp_path):
+    changes = tmp_path / "polished.changes"
+    changes.write_text(CHANGES)
+    out, first, second = io.StringIO(), io.StringIO(), io.StringIO()
+    lifter = AlignmentLifter(EditMap(str(changes), flank=10), {"tig_pilon": 999}, affected={"pairB"})
+    lifter.run(io.StringIO(SAM), out, (first, second))
+
+    lines = out.getvalue().splitlines()
+    assert lines[:3] == ["@HD\tVN:1.6\tSO:coordinate", "@SQ\tSN:tig_pilon\tLN:999", "@PG\tID:minimap2\tPN:minimap2"]
+    records = [i.split("\t") for i in lines[3:]]
+    assert [i[:9] for i in records[:2]] == [["pairA", "99", "tig_pilon", "20", "60", "10M", "=", "399", "389"],
+                                            ["pairA", "147", "tig_pilon", "399", "60", "10M", "=", "20", "-389"]]
+    assert not any(i.startswith("SA:Z:") for i in records[1])
+    assert [i[0] for i in records[2:]] == ["pairU", "pairU"]
+    assert first.getvalue() == "@pairB\nACGTACGTAA\n+\nIIIIIIIIII\n"
+    assert second.getvalue() == "@pairB\nGGGGGAAAAA\n+\nIIIIIIIIII\n"
+    assert (lifter.lifted, lifter.realigned, lifter.orphans) == (4, 1, 0)
+
+
+def test_workflow_lifts_later_iterations(tmp_path, monkeypatch, dataset):
+    monkeypatch.setenv("STUB_PILON_ROUNDS", "3")
+    monkeypatch.setenv("STUB_PILON_CHANGES", "2")
+    out_dir = tmp_path / "out"
+    workflow = PolishWorkflow(contigs=dataset.draft, ram=1, reads=dataset.reads, out_dir=str(out_dir), Polisher_=PolishAssembly,
+                              Mapper_=IdxMapReads, prefix="synthetic", max_iter=5, liftover=True, liftover_flank=50)
+
+    assert workflow.Iteration == 3
+    records = [json.loads(i) for i in open(workflow.report.report)]
+    assert all(i["exit_code"] == 0 for i in records)
+    assert {i["iteration"] for i in records if i["step"] == "LiftOver"} == {1, 2}
+    assert not [i for i in os.listdir(out_dir) if "_lifted" in i or "_realign" in i or "_affected" in i]
+    assert (out_dir / "synthetic_2.bam.bai").exists()
@@ -0,0 +1,58 @@
+"""Verify the bwa-mem2 backend and the benchmark choosing between mappers, using the benchmark stub tools
+"""
+
+import os
+import json
+import pytest
+
+from mapper_benchmark import MapperBenchmark
+from tools import BwaMem2, BwaMem2Settings, ExecutionContext
+from resources import ResourceBudget
+from Workflows import PolishWorkflow, PolishAssembly, BwaMem2MapReads, IdxMapReads, MAPPERS
+from cli import Main
+
+
+def test_bwa_mem2_commands():
+    index = BwaMem2(BwaMem2Settings.create_index, index="out/draft.bwa", contigs="draft.fasta")
+    assert index.create_command() == ["bwa-mem2", "index", "-p", "out/draft.bwa", "draft.fasta"]
+    assert "out/draft.bwa.bwt.2bit.64" in index.outputs()
+    mem = BwaMem2(BwaMem2Settings.map_reads, reads=["r1.fq", "r2.fq"], index="out/draft.bwa", threads=4)
+    assert mem.create_command() == ["bwa-mem2", "mem", "-t", "4", "out/draft.bwa", "r1.fq", "r2.fq"]
+    assert mem.threads == 4 and mem.outputs() == []
+
+
+def test_minimap2_is_the_default_mapper():
+    main = Main.__new__(Main)
+    assert main.select_mapper(main.cmd_parser(["-c", "contigs.fasta"])) is IdxMapReads
+
+
+def test_piped_mapping_books_mapper_and_sort(tmp_path):
+    context = ExecutionContext()
+    submitted = []
+    context.submit = lambda *executors, **kwargs: submitted.extend(executors)
+    mapping = IdxMapReads("draft.fasta", ["r1.fq", "r2.fq"], None, resources=ResourceBudget(threads=32, memory=64), context=context)
+    mapping.prepare_index = lambda alignments: None
+    mapping.map_reads_sorted(str(tmp_path / "mapped.bam"))
+    assert [i.initialized.requirements() for i in submitted] == [(24, 1), (8, 32)]
+
+
+def test_workflow_with_bwa_mem2(tmp_path, monkeypatch, dataset):
+    monkeypatch.setenv("STUB_PILON_ROUNDS", "2")
+    workflow = PolishWorkflow(contigs=dataset.draft, ram=1, reads=dataset.reads, out_dir=str(tmp_path / "out"),
+                              Polisher_=PolishAssembly, Mapper_=BwaMem2MapReads, prefix="synthetic", max_iter=5)
+
+    assert workflow.Iteration == 2
+    assert os.path.isfile(tmp_path / "out" / "synthetic_1.bwa.0123")
+    steps = {json.loads(i)["step"] for i in open(workflow.report.report)}
+    assert "BwaMem2" in steps and "Minimap2" not in steps
+
+
+def test_benchmark_is_recorded(tmp_path, stub_tools):
+    record = str(tmp_path / "mapper_benchmark.json")
+    chosen = MapperBenchmark(MAPPERS, record=record).choose()
+    assert chosen in MAPPERS
+    assert set(json.load(open(record))[0]["timings"]) == {"minimap2", "bwa-mem2"}
+
+    benchmark = MapperBenchmark(MAPPERS, record=record)
+    benchmark.run = lambda names: pytest.fail("benchmark rerun despite a matching record")
+    assert benchmark.choose() == chosen
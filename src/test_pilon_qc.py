@@ -0,0 +1,51 @@
+"""Verify QC metrics streamed from Pilon VCF and changes output
+"""
+
+import gzip
+from pilon_qc import PilonQC
+
+VCF = """##fileformat=VCFv4.1
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO
+tig1\t1\t.\tA\t.\t40\tPASS\tDP=30;TD=30
+tig1\t2\t.\tC\tT\t40\tPASS\tDP=20;TD=20
+tig1\t2\t.\tCA\tC\t40\tPASS\tDP=20;TD=20
+tig1\t3\t.\tG\t.\t0\tLowCov\tDP=2;TD=2
+tig2\t1\t.\tT\tA\t10\tAmb\tDP=12;TD=12
+"""
+
+CHANGES = """tig1:2 tig1_pilon:2 C T
+tig1:5-6 tig1_pilon:5 AT .
+tig2:8 tig2_pilon:7-8 . GG
+"""
+
+
+def test_vcf_and_changes_metrics(tmp_path):
+    vcf = tmp_path / "polished.vcf.gz"
+    with gzip.open(vcf, "wt") as out:
+        out.write(VCF)
+    changes = tmp_path / "polished.changes"
+    changes.write_text(CHANGES)
+
+    qc = PilonQC(1)
+    qc.add_vcf(str(vcf))
+    qc.add_changes(str(changes))
+    tig1, tig2 = qc.contigs["tig1"], qc.contigs["tig2"]
+    assert (tig1.bases, tig1.confirmed, tig1.low_coverage, tig1.mean_depth) == (3, 1, 1, 52 / 3)
+    assert (tig2.ambiguous, tig2.snps, tig2.indels) == (1, 0, 1)
+    assert (tig1.snps, tig1.indels) == (1, 1)
+    assert qc.total().bases == 4
+
+    table = tmp_path / "qc.tsv"
+    qc.write(str(table))
+    PilonQC(2).write(str(table))
+    lines = table.read_text().splitlines()
+    assert lines[0].startswith("iteration\tcontig") and lines[1].startswith("1\ttig1\t3\t17.3\t0.3333")
+    assert len(lines) == 3
+
+
+def test_metrics_without_vcf_are_missing(tmp_path):
+    changes = tmp_path / "polished.changes"
+    changes.write_text(CHANGES)
+    qc = PilonQC(0)
+    qc.add_changes(str(changes))
+    assert qc.rows()[0] == ["0", "tig1", "NA", "NA", "NA", "NA", "NA", "1", "1"]
@@ -0,0 +1,37 @@
+"""Verify that piped executors stream between stages and report failing stages
+"""
+
+import pytest
+from tools import Executor, Pipeline, StepFailure, OutOfMemoryFailure, failed_stage
+
+
+def shell_stage(*args):
+    """Samtools executor with its binary swapped for a shell utility
+    """
+    stage = Executor("Samtools", None, *args[1:])
+    stage.initialized.binary = args[0]
+    return stage
+
+
+def test_pipeline_streams_stdout(capfd):
+    Pipeline(shell_stage("printf", "a\\nb\\n"), shell_stage("wc", "-l")).execute()
+    assert "2" in capfd.readouterr().out.split()
+
+
+def test_pipeline_checks_every_stage():
+    with pytest.raises(SystemExit):
+        Pipeline(shell_stage("false"), shell_stage("cat")).execute()
+
+
+def test_downstream_failure_is_blamed_over_broken_pipe():
+    assert failed_stage([-13, 137]) == 1 and failed_stage([1, 2]) == 0 and failed_stage([0, 0]) is None
+    with pytest.raises(OutOfMemoryFailure) as failure:
+        Pipeline(shell_stage("yes"), shell_stage("sh", "-c", "head -c 1 >/dev/null; echo 'Out of memory' >&2; exit 3")).execute(
+            recoverable=(StepFailure,))
+    assert failure.value.exit_code == 3 and failure.value.stderr_tail == ["Out of memory"]
+
+
+def test_missing_binary_is_a_step_failure():
+    with pytest.raises(StepFailure) as failure:
+        Pipeline(shell_stage("yes"), shell_stage("pilonpolisher-missing-binary")).execute(recoverable=(StepFailure,))
+    assert "could not be started" in failure.value.describe()
@@ -0,0 +1,41 @@
+"""Verify Racon polishes chunks of contigs in parallel with the benchmark stub tools, ahead of Pilon
+"""
+
+from synthetic import make_dataset
+from fasta import read_fasta
+from tools import Racon, ExecutionContext
+from resources import ResourceBudget
+from Workflows import ContigConsensus, PolishWorkflow, PolishAssembly, IdxMapReads, AssembleLongReads
+
+
+def test_racon_command_redirects_stdout():
+    racon = Racon("reads.fastq", "overlaps.paf", "contigs.fasta", "consensus.fasta", threads=2)
+    assert racon.create_command() == ["racon", "-u", "-t", "2", "reads.fastq", "overlaps.paf", "contigs.fasta"]
+    assert racon.stdout == "consensus.fasta" and racon.outputs() == ["consensus.fasta"]
+
+
+def test_flye_is_given_the_threads(tmp_path, monkeypatch):
+    context = ExecutionContext()
+    submitted = []
+    monkeypatch.setattr(context, "submit", lambda executor: submitted.append(executor))
+    monkeypatch.setattr(context, "flush", lambda: None)
+    AssembleLongReads([str(tmp_path / "reads.fastq")], str(tmp_path / "flye"), context=context, threads=8).run_flye()
+    assert submitted[0].initialized.create_command()[-2:] == ["--threads", "8"]
+    assert submitted[0].initialized.requirements()[0] == 8
+
+
+def test_chunked_consensus_feeds_pilon(tmp_path, monkeypatch, stub_tools):
+    monkeypatch.setenv("STUB_PILON_ROUNDS", "2")
+    dataset = make_dataset(str(tmp_path / "data"), genome_size=30_000, contigs=3, depth=5)
+    out_dir = tmp_path / "out"
+    consensus = ContigConsensus(dataset.draft, dataset.reads, out_dir=str(out_dir), prefix="synthetic", rounds=2, chunks=2,
+                                resources=ResourceBudget(threads=4, memory=4)).polish()
+
+    assert consensus == str(out_dir / "synthetic_racon_1.fasta")
+    assert list(read_fasta(consensus)) == list(read_fasta(dataset.draft))
+    assert sorted(i.name for i in out_dir.iterdir()) == ["synthetic_racon_0.fasta", "synthetic_racon_1.fasta"]
+
+    workflow = PolishWorkflow(contigs=consensus, ram=1, reads=dataset.reads, out_dir=str(out_dir), Polisher_=PolishAssembly,
+                              Mapper_=IdxMapReads, prefix="synthetic", max_iter=5)
+    assert workflow.Iteration == 2
+    assert [i for i, _ in read_fasta(workflow.final_assembly)] == ["contig_1_pilon_pilon", "contig_2_pilon_pilon", "contig_3_pilon_pilon"]
@@ -0,0 +1,95 @@
+"""Verify reads are preprocessed once into the read cache, shared by content and evicted least recently used first
+"""
+
+import os
+import gzip
+import json
+import shutil
+import threading
+import pytest
+
+from read_cache import ReadCache
+from downsample import paired_records, read_name
+from Workflows import PolishWorkflow, PolishAssembly, IdxMapReads
+
+
+def write_pairs(path, pairs, seed="A", malformed_at=None):
+    path.mkdir(parents=True, exist_ok=True)
+    reads = [str(path / "reads_R1.fastq.gz"), str(path / "reads_R2.fastq")]
+    with gzip.open(reads[0], "wt") as r1, open(reads[1], "w") as r2:
+        for idx in range(pairs):
+            quality = "I" * (9 if idx == malformed_at else 10)
+            r1.write(f"@pair{idx}/1\n{seed * 10}\n+\n{quality}\n")
+            r2.write(f"@pair{idx}/2\n{'C' * 10}\n+\n{'I' * 10}\n")
+    return reads
+
+
+def test_reads_are_cached_once_by_content(tmp_path, capsys):
+    reads = write_pairs(tmp_path / "a", 100)
+    cache = ReadCache(str(tmp_path / "cache"), max_bytes=1 << 30)
+    with cache.use(reads) as cached:
+        assert all(cache.contains(i) and i.endswith(".fastq") for i in cached)
+        names = [[read_name(i[0]) for i in pair] for pair in paired_records(cached)]
+        assert len(names) == 100 and all(r1 == r2 for r1, r2 in names)
+    assert "Cached 100 read pairs" in capsys.readouterr().out
+
+    copies = tmp_path / "copies"
+    shutil.copytree(tmp_path / "a", copies)
+    with cache.use([str(copies / os.path.basename(i)) for i in reads]) as reused:
+        assert reused == cached
+    assert "Reusing cached reads" in capsys.readouterr().out
+
+
+def test_entry_in_use_is_shared(tmp_path):
+    reads = write_pairs(tmp_path / "a", 10)
+    cache = ReadCache(str(tmp_path / "cache"), max_bytes=1 << 30)
+    shared = []
+
+    def second_sample():
+        with cache.use(reads) as cached:
+            shared.append(cached)
+
+    with cache.use(reads) as cached:
+        sample = threading.Thread(target=second_sample)
+        sample.start()
+        sample.join(timeout=10)
+        assert shared == [cached]
+
+
+def test_bgzf_entries(tmp_path, stub_tools):
+    reads = write_pairs(tmp_path / "a", 10)
+    with ReadCache(str(tmp_path / "cache"), max_bytes=1 << 30, bgzf=True, threads=2).use(reads) as cached:
+        with gzip.open(cached[1], "rt") as r2:
+            assert r2.read().count("@pair") == 10
+
+
+def test_malformed_reads_are_not_cached(tmp_path):
+    cache = ReadCache(str(tmp_path / "cache"), max_bytes=1 << 30)
+    with pytest.raises(SystemExit):
+        with cache.use(write_pairs(tmp_path / "a", 10, malformed_at=4)):
+            pass
+    assert cache.entries() == []
+
+
+def test_least_recently_used_entries_not_in_use_are_evicted(tmp_path):
+    cache = ReadCache(str(tmp_path / "cache"), max_bytes=15000)
+    first, second, third = [write_pairs(tmp_path / i, 100, seed=i) for i in "ACG"]
+    with cache.use(first):
+        with cache.use(second):
+            pass
+        with cache.use(third):
+            pass
+        # the first entry is the least recently used but is still in use
+        assert len(cache.entries()) == 2 and cache.key(first) in cache.entries()
+        assert cache.key(second) not in cache.entries()
+
+
+def test_workflow_maps_cached_reads(tmp_path, monkeypatch, dataset):
+    monkeypatch.setenv("STUB_PILON_ROUNDS", "2")
+    cache = ReadCache(str(tmp_path / "cache"), max_bytes=1 << 30)
+    for sample in ["first", "second"]:
+        workflow = PolishWorkflow(contigs=dataset.draft, ram=1, reads=dataset.reads, out_dir=str(tmp_path / sample), Polisher_=PolishAssembly,
+                                  Mapper_=IdxMapReads, prefix=sample, max_iter=5, read_cache=cache)
+        mappings = [json.loads(i)["command"] for i in open(workflow.report.report) if json.loads(i)["step"] == "Minimap2"]
+        assert len(mappings) == 2 and all(cache.cache_dir in i for i in mappings)
+    assert len(cache.entries()) == 1
@@ -0,0 +1,23 @@
+"""Verify steps are recorded with their resource usage
+"""
+
+import json
+from report import RunReport
+from tools import Executor, ExecutionContext
+
+
+def test_steps_are_reported(tmp_path):
+    output = tmp_path / "out.txt"
+    prometheus = tmp_path / "pilonpolisher_test.prom"
+    report = RunReport(str(tmp_path / "test_report.jsonl"), sample="test", prometheus=str(prometheus))
+    step = Executor("Samtools", None, "hello", context=ExecutionContext(report=report, iteration=0), stdout=str(output))
+    step.initialized.binary = "echo"
+    step.execute()
+
+    records = [json.loads(i) for i in (tmp_path / "test_report.jsonl").read_text().splitlines()]
+    assert len(records) == 1
+    assert records[0]["iteration"] == 0 and records[0]["exit_code"] == 0
+    assert records[0]["bytes_written"] == len("hello\n")
+    assert records[0]["max_rss_kb"] > 0
+    assert "Samtools" in report.summary(0)
+    assert 'pilonpolisher_step_exit_code{sample="test",step="Samtools",iteration="0"} 0.0' in prometheus.read_text()
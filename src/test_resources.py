@@ -0,0 +1,40 @@
+"""Verify the split of a resource budget between tools
+"""
+
+import gzip
+from resources import ResourceBudget, HeapEstimate, parse_idxstats, sample_read_length
+
+
+def test_budget_split():
+    budget = ResourceBudget(threads=32, memory=64)
+    assert budget.sort_threads == 8
+    assert budget.mapper_threads == 24
+    assert budget.sort_args() == ["-@", "8", "-m", "4096M"] and budget.sort_memory == 32
+    assert budget.pilon_threads == 32 and budget.pilon_heap == 64
+
+
+def test_single_thread_budget():
+    budget = ResourceBudget(threads=1, memory=1, pilon_ram=2)
+    assert budget.sort_threads == 1 and budget.mapper_threads == 1
+    assert budget.sort_memory_mb == 512 and budget.sort_memory == 1
+    assert budget.pilon_heap == 2
+
+
+def test_heap_estimate_scales_with_depth():
+    shallow = HeapEstimate(genome_size=5_000_000, mapped_reads=1_000_000, read_length=150)
+    deep = HeapEstimate(genome_size=5_000_000, mapped_reads=6_000_000, read_length=150)
+    assert shallow.depth == 30 and deep.depth == 180
+    assert shallow.heap < deep.heap
+    assert HeapEstimate(genome_size=10_000, mapped_reads=10, read_length=100).heap == 2
+    assert ResourceBudget(memory=4).fit_heap(deep) == 4
+    assert ResourceBudget(memory=4, pilon_ram=3).fit_heap(deep) == 3
+
+
+def test_read_counts(tmp_path):
+    stats = tmp_path / "test.bam.idxstats"
+    stats.write_text("a\t100\t20\t1\nb\t50\t5\t0\n*\t0\t0\t7\n")
+    assert parse_idxstats(str(stats)) == {"a": 20, "b": 5}
+    reads = tmp_path / "reads.fq.gz"
+    with gzip.open(reads, "wt") as fastq:
+        fastq.write("@r1\nACGT\n+\nIIII\n@r2\nACGTAC\n+\nIIIIII\n")
+    assert sample_read_length([str(reads)]) == 5
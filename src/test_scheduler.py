@@ -0,0 +1,37 @@
+"""Verify steps are only admitted while the shared budget allows
+"""
+
+import threading
+import time
+from scheduler import ResourceScheduler
+
+
+def test_scheduler_limits_concurrent_memory():
+    scheduler = ResourceScheduler(threads=8, memory=10)
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def step():
+        with scheduler.reserve(2, 4):
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.pop()
+
+    workers = [threading.Thread(target=step) for _ in range(5)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert max(peak) == 2
+    assert scheduler.free_threads == 8 and scheduler.free_memory == 10
+
+
+def test_oversized_request_runs_alone():
+    scheduler = ResourceScheduler(threads=2, memory=4)
+    with scheduler.reserve(16, 64):
+        assert scheduler.free_threads == 0 and scheduler.free_memory == 0
+    assert scheduler.free_memory == 4
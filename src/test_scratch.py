@@ -0,0 +1,54 @@
+"""Verify inputs are staged into scratch and scratch is removed on a termination signal
+"""
+
+import os
+import signal
+import threading
+import pytest
+from scratch import ScratchSpace, exit_on_termination
+
+
+def test_stage_and_sync(tmp_path):
+    reads = tmp_path / "reads.fastq"
+    reads.write_text("@r\nA\n+\nI\n")
+    with ScratchSpace(str(tmp_path), "test") as space:
+        staged = space.stage(str(reads))
+        assert space.contains(staged) and open(staged).read() == reads.read_text()
+        os.makedirs(os.path.join(space.work_dir, "sub"))
+        open(os.path.join(space.work_dir, "sub", "out.txt"), "w").write("done")
+        space.sync(str(tmp_path / "out"))
+    assert (tmp_path / "out" / "sub" / "out.txt").read_text() == "done"
+    assert not os.path.exists(space.path)
+
+
+def test_signal_cleans_scratch(tmp_path):
+    with pytest.raises(SystemExit):
+        with ScratchSpace(str(tmp_path), "test") as space:
+            os.kill(os.getpid(), signal.SIGTERM)
+    assert not os.path.exists(space.path)
+    assert signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
+
+
+def test_signal_cleans_scratch_of_worker_threads(tmp_path):
+    entered, release = threading.Event(), threading.Event()
+    spaces = []
+
+    def polish():
+        with ScratchSpace(str(tmp_path), "worker") as space:
+            spaces.append(space)
+            entered.set()
+            release.wait(10)
+
+    worker = threading.Thread(target=polish)
+    try:
+        with pytest.raises(SystemExit):
+            with exit_on_termination():
+                worker.start()
+                entered.wait(10)
+                os.kill(os.getpid(), signal.SIGTERM)
+                release.wait(10)
+        assert not os.path.exists(spaces[0].path)
+    finally:
+        release.set()
+        worker.join()
+    assert signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
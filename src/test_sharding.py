@@ -0,0 +1,66 @@
+"""Verify contig partitioning and the merge of sharded Pilon outputs
+"""
+
+from fasta import partition_contigs, read_fasta, write_fasta, contig_lengths
+from tools import ExecutionContext
+from engine import WorkflowEngine
+from Workflows import PolishAssembly
+
+
+def test_partition_balances_length():
+    lengths = {"a": 100, "b": 60, "c": 50, "d": 10}
+    groups = partition_contigs(lengths, 2)
+    assert groups == [["a", "d"], ["b", "c"]]
+    assert partition_contigs(lengths, 10) == [["a"], ["b"], ["c"], ["d"]]
+
+
+def test_shard_heap_split_by_running_steps(tmp_path, monkeypatch):
+    contigs = tmp_path / "contigs.fasta"
+    write_fasta([(i, "A" * 10) for i in "abcd"], str(contigs))
+    context = ExecutionContext()
+    context.engine = WorkflowEngine(context, jobs=2)
+    submitted = []
+    monkeypatch.setattr(context, "submit", lambda executor: submitted.append(executor))
+    monkeypatch.setattr(context, "flush", lambda recoverable: None)
+    polisher = PolishAssembly(str(contigs), "test.bam", "merged", str(tmp_path), ram=16, context=context, per_contig=True)
+    monkeypatch.setattr(polisher, "merge_shards", lambda *args: None)
+    polisher.polish_sharded()
+
+    assert len(submitted) == 4
+    assert all(i.initialized.memory == 8 for i in submitted)
+
+
+def test_merge_shards_restores_order(tmp_path):
+    contigs = tmp_path / "contigs.fasta"
+    write_fasta([("a", "A" * 10), ("b", "C" * 5), ("c", "G" * 8)], str(contigs))
+    groups = [["a", "c"], ["b"]]
+    prefixes = [str(tmp_path / "shard0"), str(tmp_path / "shard1")]
+    write_fasta([("a_pilon", "T" * 10), ("c_pilon", "G" * 8)], f"{prefixes[0]}.fasta")
+    write_fasta([("b_pilon", "C" * 4)], f"{prefixes[1]}.fasta")
+    (tmp_path / "shard0.changes").write_text("a:2 a_pilon:2 A T\nc:3 c_pilon:3 G G\n")
+    (tmp_path / "shard1.changes").write_text("b:5 b_pilon:4 C .\n")
+    (tmp_path / "shard0.vcf").write_text("##fileformat=VCFv4.1\n##contig=<ID=a>\n##contig=<ID=c>\n#CHROM\tPOS\na\t1\nc\t1\n")
+    (tmp_path / "shard1.vcf").write_text("##fileformat=VCFv4.1\n##contig=<ID=b>\n#CHROM\tPOS\nb\t1\n")
+
+    polisher = PolishAssembly(str(contigs), "test.bam", "merged", str(tmp_path), ram=4, shards=2)
+    polisher.merge_shards(prefixes, groups, list(contig_lengths(str(contigs))))
+
+    assert [i for i, _ in read_fasta(str(tmp_path / "merged.fasta"))] == ["a_pilon", "b_pilon", "c_pilon"]
+    assert (tmp_path / "merged.changes").read_text().splitlines()[1] == "b:5 b_pilon:4 C ."
+    vcf = (tmp_path / "merged.vcf").read_text().splitlines()
+    assert vcf[1:4] == ["##contig=<ID=a>", "##contig=<ID=b>", "##contig=<ID=c>"]
+    assert [i.split("\t")[0] for i in vcf[5:]] == ["a", "b", "c"]
+
+
+def test_merge_keeps_frozen_contigs(tmp_path):
+    contigs = tmp_path / "contigs.fasta"
+    write_fasta([("a_pilon", "A" * 10), ("b_pilon", "C" * 5)], str(contigs))
+    prefix = str(tmp_path / "shard0")
+    write_fasta([("b_pilon_pilon", "C" * 6)], f"{prefix}.fasta")
+    (tmp_path / "shard0.changes").write_text("b_pilon:5 b_pilon_pilon:5-6 . CC\n")
+
+    polisher = PolishAssembly(str(contigs), "test.bam", "merged", str(tmp_path), ram=4, targets=["b_pilon"])
+    polisher.merge_shards([prefix], [["b_pilon"]], list(contig_lengths(str(contigs))))
+
+    assert list(read_fasta(str(tmp_path / "merged.fasta"))) == [("a_pilon_pilon", "A" * 10), ("b_pilon_pilon", "C" * 6)]
+    assert (tmp_path / "merged.changes").read_text() == "b_pilon:5 b_pilon_pilon:5-6 . CC\n"
@@ -0,0 +1,75 @@
+"""Submit jobs and whole workflows to the stand in sbatch, squeue, sacct and scancel of the benchmarks
+"""
+
+import os
+import json
+import pytest
+
+from slurm import SlurmCluster, exit_code
+from Workflows import PolishWorkflow, PolishAssembly, PolishBatch, IdxMapReads
+from resources import ResourceBudget
+from cli import Main
+
+
+@pytest.fixture
+def cluster(tmp_path, monkeypatch, stub_tools):
+    monkeypatch.setenv("STUB_SLURM_DIR", str(tmp_path / "slurm_state"))
+    cluster = SlurmCluster(log_dir=str(tmp_path / "logs"), partition="short", poll_interval=0.05)
+    cluster.check()
+    return cluster
+
+
+def test_sbatch_command_sizes_job():
+    cluster = SlurmCluster(log_dir="logs", account="lab", time_limit="01:00:00")
+    command = cluster.sbatch_command("step", "step.sh", threads=4, memory=8, tasks=3, max_running=2)
+    assert {"--cpus-per-task=4", "--mem=9G", "--account=lab", "--time=01:00:00", "--array=0-2%2"} <= set(command)
+    assert command[-1] == "step.sh"
+    assert exit_code("2:0") == 2 and exit_code("0:9") == 137
+
+
+def test_job_exit_codes_and_arrays(cluster, tmp_path):
+    done = cluster.submit("done", [f"touch {tmp_path / 'done'}"], threads=1, memory=1)
+    failed = cluster.submit("failed", ["exit 3"], threads=1, memory=1)
+    array = cluster.submit("array", ['test "$SLURM_ARRAY_TASK_ID" != 1'], threads=1, memory=1, tasks=3)
+    cluster.wait([done, failed, array])
+    assert not done.failed() and (tmp_path / "done").exists()
+    assert failed.failed() == [failed.job_id] and failed.exit_code() == 3
+    assert array.failed() == [f"{array.job_id}_1"]
+
+
+def test_cancelled_job_is_failed(cluster):
+    job = cluster.submit("sleeper", ["sleep 30"], threads=1, memory=1)
+    assert not cluster.poll([job])
+    cluster.cancel([job])
+    cluster.wait([job])
+    assert job.results[job.job_id][0] == "CANCELLED" and job.failed()
+
+
+def test_workflow_steps_run_as_jobs(cluster, tmp_path, monkeypatch, dataset):
+    monkeypatch.setenv("STUB_PILON_ROUNDS", "2")
+    workflow = PolishWorkflow(contigs=dataset.draft, ram=1, reads=dataset.reads, out_dir=str(tmp_path / "out"), Polisher_=PolishAssembly,
+                              Mapper_=IdxMapReads, prefix="synthetic", max_iter=5, cluster=cluster)
+
+    assert workflow.Iteration == 2
+    records = [json.loads(i) for i in open(workflow.report.report)]
+    assert records and all(i["exit_code"] == 0 for i in records)
+    scripts = [i for i in os.listdir(cluster.log_dir) if i.endswith(".sh")]
+    assert any(i.startswith("pilonpolisher_pilon_") for i in scripts)
+
+
+def test_batch_samples_run_as_array_tasks(cluster, tmp_path):
+    samples = [{"contigs": "c.fasta", "r1": "r1.fq", "r2": "r2.fq", "prefix": f"sample{i}"} for i in range(3)]
+    batch = PolishBatch(samples=samples, out_dir=str(tmp_path), scheduler=None, jobs=2, resources=ResourceBudget(threads=2, memory=2))
+    with pytest.raises(SystemExit):
+        batch.submit_samples(cluster, ["sh", "-c", 'test "$2" != 1', "sh"])
+    assert batch.failed == ["sample1"]
+
+
+def test_sample_budget_does_not_shrink_with_jobs():
+    main = Main.__new__(Main)
+    args = ["-s", "samples.tsv", "--threads", "32", "--memory", "64", "--jobs", "48"]
+    for extra in ([], ["--slurm", "samples"], ["--sample-index", "3"]):
+        budget = main.sample_budget(main.batch_parser([*args, *extra]))
+        assert (budget.threads, budget.memory) == (32, 64)
+    budget = main.sample_budget(main.batch_parser([*args, "--sample-memory", "8"]))
+    assert (budget.threads, budget.memory) == (32, 8)
@@ -0,0 +1,105 @@
+"""Run the polishing workflow end to end on synthetic data with the benchmark stub tools
+"""
+
+import os
+import json
+import pytest
+
+from Workflows import PolishWorkflow, PolishAssembly, IdxMapReads, Retention
+from fasta import read_fasta
+from resources import ResourceBudget
+
+
+def test_workflow_converges_with_stub_tools(tmp_path, monkeypatch, dataset):
+    monkeypatch.setenv("STUB_PILON_ROUNDS", "2")
+    workflow = PolishWorkflow(contigs=dataset.draft, ram=1, reads=dataset.reads, out_dir=str(tmp_path / "out"),
+                              Polisher_=PolishAssembly, Mapper_=IdxMapReads, prefix="synthetic", max_iter=5)
+
+    assert workflow.Iteration == 2
+    assert [i for i, _ in read_fasta(workflow.final_assembly)] == ["contig_1_pilon_pilon", "contig_2_pilon_pilon"]
+    records = [json.loads(i) for i in open(workflow.report.report)]
+    assert {i["step"] for i in records} == {"Minimap2", "Samtools", "Pilon"}
+    assert all(i["exit_code"] == 0 for i in records)
+    qc = [i.split("\t") for i in open(workflow.qc_table).read().splitlines()]
+    assert qc[0][:2] == ["iteration", "contig"] and len(qc) == 5
+    assert workflow.qc[0].snps == 10 and workflow.qc[1].snps == 0
+
+
+def test_keep_final_removes_intermediate_iterations(tmp_path, monkeypatch, dataset):
+    monkeypatch.setenv("STUB_PILON_ROUNDS", "3")
+    out_dir = tmp_path / "out"
+    PolishWorkflow(contigs=dataset.draft, ram=1, reads=dataset.reads, out_dir=str(out_dir), Polisher_=PolishAssembly,
+                   Mapper_=IdxMapReads, prefix="synthetic", max_iter=5, retention=Retention.keep_final, cram=True)
+
+    kept = sorted(i.name for i in out_dir.iterdir() if i.is_file())
+    assert kept == ["synthetic_1.fasta", "synthetic_2.changes", "synthetic_2.cram", "synthetic_2.cram.crai", "synthetic_2.fasta",
+                    "synthetic_qc.tsv", "synthetic_report.jsonl"]
+
+
+def test_scratch_outputs_are_synced_back(tmp_path, monkeypatch, dataset):
+    monkeypatch.setenv("STUB_PILON_ROUNDS", "2")
+    scratch = tmp_path / "scratch"
+    scratch.mkdir()
+    out_dir = tmp_path / "out"
+    workflow = PolishWorkflow(contigs=dataset.draft, ram=1, reads=dataset.reads, out_dir=str(out_dir), Polisher_=PolishAssembly,
+                              Mapper_=IdxMapReads, prefix="synthetic", max_iter=5, retention=Retention.keep_final, scratch=str(scratch))
+
+    assert workflow.final_assembly == str(out_dir / "synthetic_1.fasta")
+    assert os.path.isfile(workflow.final_assembly) and os.path.isfile(workflow.report.report)
+    assert not any(i.name.endswith(".tmp") for i in out_dir.iterdir())
+    assert list(scratch.iterdir()) == []
+
+
+def test_pilon_out_of_memory_is_retried_without_remapping(tmp_path, monkeypatch, dataset):
+    monkeypatch.setenv("STUB_PILON_ROUNDS", "2")
+    monkeypatch.setenv("STUB_PILON_HEAP_PER_CONTIG", "3")
+    workflow = PolishWorkflow(contigs=dataset.draft, ram=None, reads=dataset.reads, out_dir=str(tmp_path / "out"), Polisher_=PolishAssembly,
+                              Mapper_=IdxMapReads, prefix="synthetic", max_iter=5, resources=ResourceBudget(threads=2, memory=4))
+
+    assert workflow.Iteration == 2
+    records = [json.loads(i) for i in open(workflow.report.report)]
+    first = [i for i in records if i["iteration"] == 0]
+    assert [i["step"] for i in first].count("Minimap2") == 1
+    pilon = [(i["command"].split()[1], i["exit_code"]) for i in first if i["step"] == "Pilon"]
+    assert pilon == [("-Xmx2G", 1), ("-Xmx4G", 1), ("-Xmx4G", 0), ("-Xmx4G", 0)]
+    assert [i["exit_code"] for i in records if i["iteration"] == 1 and i["step"] == "Pilon"] == [0, 0]
+
+
+def test_mapping_out_of_memory_is_not_retried_as_pilon(tmp_path, monkeypatch, capsys, dataset):
+    monkeypatch.setenv("STUB_SORT_OOM", "1")
+    with pytest.raises(SystemExit):
+        PolishWorkflow(contigs=dataset.draft, ram=2, reads=dataset.reads, out_dir=str(tmp_path / "out"), Polisher_=PolishAssembly,
+                       Mapper_=IdxMapReads, prefix="synthetic", max_iter=5, resources=ResourceBudget(threads=2, memory=4, pilon_ram=2))
+    output = capsys.readouterr().out
+    assert "Workflow stopped: Samtools ran out of memory" in output and "Retrying Pilon" not in output
+
+
+def test_resume_continues_from_retained_iteration(tmp_path, monkeypatch, dataset):
+    monkeypatch.setenv("STUB_PILON_ROUNDS", "4")
+    out_dir = tmp_path / "out"
+    kwargs = dict(contigs=dataset.draft, ram=1, reads=dataset.reads, out_dir=str(out_dir), Polisher_=PolishAssembly, Mapper_=IdxMapReads,
+                  prefix="synthetic", retention=Retention.keep_final_changes, resume=True)
+    PolishWorkflow(max_iter=2, **kwargs)
+    report = out_dir / "synthetic_report.jsonl"
+    first_run = report.read_text().splitlines()
+
+    workflow = PolishWorkflow(max_iter=6, **kwargs)
+    assert workflow.Iteration == 4
+    assert [i for i, _ in read_fasta(workflow.final_assembly)] == ["contig_1" + "_pilon" * 4, "contig_2" + "_pilon" * 4]
+    records = report.read_text().splitlines()
+    assert records[:len(first_run)] == first_run
+    assert {json.loads(i)["iteration"] for i in records[len(first_run):]} == {2, 3}
+    assert [i.split("\t")[0] for i in open(workflow.qc_table).read().splitlines()[1:]] == ["0", "0", "1", "1", "2", "2", "3", "3"]
+
+
+def test_resume_works_in_the_output_directory(tmp_path, monkeypatch, capsys, dataset):
+    monkeypatch.setenv("STUB_PILON_ROUNDS", "2")
+    scratch = tmp_path / "scratch"
+    scratch.mkdir()
+    out_dir = tmp_path / "out"
+    workflow = PolishWorkflow(contigs=dataset.draft, ram=1, reads=dataset.reads, out_dir=str(out_dir), Polisher_=PolishAssembly,
+                              Mapper_=IdxMapReads, prefix="synthetic", max_iter=5, scratch=str(scratch), resume=True)
+
+    assert "Not working in scratch directory" in capsys.readouterr().out
+    assert workflow.final_assembly == str(out_dir / "synthetic_1.fasta")
+    assert (out_dir / ".pilonpolisher_cache").is_dir()
@@ -9,47 +9,84 @@ import sys
 import os
 import shutil
 import time
-from subprocess import Popen
-from typing import List
+import uuid
+import signal
+import threading
+from collections import deque
+from functools import lru_cache
+from subprocess import Popen, DEVNULL
+from typing import List, Tuple
 #StrEnum is 3.11 specific, and it may be better to implement it myself
 from enum import StrEnum # python3.11 feature only?
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
+from contextlib import nullcontext
+from cache import StepCache, tool_version
+from scheduler import ResourceScheduler
+from report import RunReport, StepRecord, file_bytes
 
 
 class Program(ABC):
     """Abstract base class for implementation of each tool
+
+    Programs declare the files they read and write so completed steps can be cached, along with the
+    threads and memory (GB) they need so steps can be scheduled against a shared budget. Programs
+    that only write to stdout name the file it is redirected to in stdout
     """
+    version_args = ["--version"]
+    threads = 1
+    memory = 1
+    stdout = None
 
     @abstractmethod
     def create_command(self) -> List[str]:
         pass
 
+    def version_command(self) -> List[str]:
+        return [self.binary, *self.version_args]
+
+    def inputs(self) -> List[str]:
+        return []
+
+    def outputs(self) -> List[str]:
+        return []
+
+    def requirements(self):
+        return self.threads, self.memory
+
     def __repr__(self) -> str:
         return " ".join(self.create_command())
 
 
 class Racon(Program):
-    """wrapper for racon commands
-
-    Args:
-        Program (_type_): _description_
-
-    Returns:
-        _type_: _description_
+    """Wrapper for racon, which writes the consensus of the contigs to stdout, redirected to output_name.
+    Racon reads one file of reads and the overlaps of those reads onto the contigs as PAF or SAM.
+    Contigs without overlaps are kept as they are unless include_unpolished is off
     """
 
     binary = "racon"
-    def __init__(self, reads: List[str], sam, contigs, output_name, *args, **kwargs) -> None:
+    def __init__(self, reads: str, overlaps: str, contigs: str, output_name: str, *args, threads: int = None,
+                 include_unpolished: bool = True, **kwargs) -> None:
         self.reads = reads
         self.contigs = contigs
-        self.sam = sam
-        self.output_name = output_name
-        self.args = args
+        self.overlaps = overlaps
+        self.stdout = output_name
+        self.args = list(args)
         self.kwargs = kwargs
+        if include_unpolished:
+            self.args.append("-u")
+        if threads is not None:
+            self.threads = threads
+            self.args.extend(["-t", str(threads)])
 
     def create_command(self) -> List[str]:
-        return [self.binary, *self.reads, self.sam, self.contigs, *self.args, ">", self.output_name]
+        return [self.binary, *self.args, self.reads, self.overlaps, self.contigs]
+
+    def inputs(self) -> List[str]:
+        return [self.reads, self.overlaps, self.contigs]
+
+    def outputs(self) -> List[str]:
+        return [self.stdout]
 
 class FlyeInputs(StrEnum):
     pacbio_raw = "--pacbio-raw"
@@ -68,15 +105,16 @@ class Flye(Program):
     """
     binary = "flye"
     
-    def __init__(self, mode: FlyeInputs, input_files: List[str], out_dir: str, *args, **kwargs) -> None:
+    def __init__(self, mode: FlyeInputs, input_files: List[str], out_dir: str, *args, threads: int = None, **kwargs) -> None:
         self.mode = mode
         self.input_files = input_files
         self.out_dir = out_dir
-        self.args = args
+        self.args = list(args)
         self.kwargs = kwargs
-        if self.kwargs.get(FlyeOpts.threads) is not None:
+        if threads is not None:
+            self.threads = threads
             self.args.append(FlyeOpts.threads)
-            self.args.append(self.kwargs[FlyeOpts.threads])
+            self.args.append(str(threads))
 
     
     def create_command(self):
@@ -84,29 +122,63 @@ class Flye(Program):
         """
         return [self.binary, self.mode, *self.input_files, "--out-dir", self.out_dir, *self.args, ]
 
+    def inputs(self) -> List[str]:
+        return list(self.input_files)
+
+    def outputs(self) -> List[str]:
+        return [os.path.join(self.out_dir, "assembly.fasta")]
+
 
 class Pilon(Program):
     """Class to wrap up the pilon command options
-        #TODO add in BWA as pilon wants that not minimap2
-        TODO need to track number of changes pilon outputs each time
+
+        The per base --vcf output is often larger than the bam, it is only written when vcf is set
     """
 
     __ram = str(16) # default GB of ram to hand pilon
     __default_args = ["--changes", "--vcf", "--vcfqe"]
+    __vcf_args = ["--vcf", "--vcfqe"]
     binary = "pilon"
     def __init__(self, contigs: str, bam_file: str, output: str, out_dir: str, 
-                 ram: int = __ram, *args, **kwargs):
+                 ram: int = __ram, *args, threads: int = None, targets: str = None, vcf: bool = True, **kwargs):
         self.contigs = contigs
         self.bam_file = bam_file
         self.output = output
         self.out_dir = out_dir
         self.__ram = str(ram)
+        self.memory = int(ram)
         self._binary = ["java", f"-Xmx{self.__ram}G", "-jar", "/usr/bin/pilon.jar"]
+        self.args = list(args)
+        self.targets = targets
+        self.default_args = [i for i in self.__default_args if vcf or i not in self.__vcf_args]
+        if threads is not None:
+            self.threads = threads
+            self.args.extend(["--threads", str(threads)])
+        if targets is not None:
+            self.args.extend(["--targets", targets])
     
     def create_command(self):
         """Create command for each parameter
         """
-        return [*self._binary, "--genome", self.contigs, "--bam", self.bam_file, "--output", self.output, "--outdir", self.out_dir, *self.__default_args]
+        return [*self._binary, "--genome", self.contigs, "--bam", self.bam_file, "--output", self.output, "--outdir", self.out_dir, *self.default_args, *self.args]
+
+    def version_command(self) -> List[str]:
+        return [*self._binary, *self.version_args]
+
+    def inputs(self) -> List[str]:
+        inputs = [self.contigs, self.bam_file, f"{self.bam_file}.bai"]
+        if self.targets is not None and os.path.isfile(self.targets):
+            inputs.append(self.targets)
+        return inputs
+
+    def outputs(self) -> List[str]:
+        output = os.path.join(self.out_dir, self.output)
+        outputs = [f"{output}.fasta"]
+        if "--changes" in self.default_args:
+            outputs.append(f"{output}.changes")
+        if "--vcf" in self.default_args:
+            outputs.append(f"{output}.vcf")
+        return outputs
 
 
 class Minimap2Settings(StrEnum):
@@ -129,9 +201,14 @@ class Minimap2(Program):
     __pipe_direction = ">"
     idx_suffix = ".idx"
 
-    def __init__(self, setting: Minimap2Settings, reads: List[str] = None, index: str = None, output_name: str = None, contigs: str = None, *args, **kwargs):
+    def __init__(self, setting: Minimap2Settings, reads: List[str] = None, index: str = None, output_name: str = None, contigs: str = None, *args, 
+                 threads: int = None, paf: bool = False, **kwargs):
         self.setting = setting.value
         self.args = list(args)
+        if threads is not None:
+            self.threads = threads
+            self.args.extend(["-t", str(threads)])
+        self.output_name = output_name
         if self.setting == Minimap2Settings.create_index:
             self.index_name = output_name
             self.contigs = contigs
@@ -142,14 +219,72 @@ class Minimap2(Program):
             else:     
                 self.index = index
             self.reads = reads
-            self.output_name = output_name
-            # direction operator added as minimap2 pipes to stdout
-            # -ax flag for mapping with minimap2
-            self.commands = ["-ax", self.setting, *self.args, self.index, *self.reads, "-o", self.output_name]
+            # -ax flag for mapping with minimap2, -x for PAF overlaps, without an output name minimap2 writes to stdout
+            self.commands = ["-x" if paf else "-ax", self.setting, *self.args, self.index, *self.reads]
+            if self.output_name is not None:
+                self.commands.extend(["-o", self.output_name])
 
     def create_command(self):
         return [self.binary, *self.commands]
 
+    def inputs(self) -> List[str]:
+        if self.setting == Minimap2Settings.create_index:
+            return [self.contigs]
+        return [self.index, *self.reads]
+
+    def outputs(self) -> List[str]:
+        return [self.output_name] if self.output_name is not None else []
+
+
+class BwaMem2Settings(StrEnum):
+    """Settings for bwa-mem2, building an index or mapping paired reads
+    """
+    create_index = "index"
+    map_reads = "mem"
+
+
+class BwaMem2(Program):
+    """Wrapper for bwa-mem2, the index is written as a set of files sharing the index prefix and
+    mapped reads are written to stdout unless an output name is given
+    """
+
+    binary = "bwa-mem2"
+    version_args = ["version"]
+    index_exts = [".0123", ".amb", ".ann", ".bwt.2bit.64", ".pac"]
+
+    def __init__(self, setting: BwaMem2Settings, reads: List[str] = None, index: str = None, output_name: str = None, contigs: str = None,
+                 *args, threads: int = None, **kwargs):
+        self.setting = BwaMem2Settings(setting)
+        self.reads = reads or []
+        self.index = index
+        self.output_name = output_name
+        self.contigs = contigs
+        self.args = list(args)
+        if threads is not None and self.setting == BwaMem2Settings.map_reads:
+            self.threads = threads
+            self.args.extend(["-t", str(threads)])
+
+    def create_command(self) -> List[str]:
+        if self.setting == BwaMem2Settings.create_index:
+            return [self.binary, self.setting.value, "-p", self.index, *self.args, self.contigs]
+        command = [self.binary, self.setting.value, *self.args, self.index, *self.reads]
+        if self.output_name is not None:
+            command.extend(["-o", self.output_name])
+        return command
+
+    def index_files(self) -> List[str]:
+        return [f"{self.index}{i}" for i in self.index_exts]
+
+    def inputs(self) -> List[str]:
+        if self.setting == BwaMem2Settings.create_index:
+            return [self.contigs]
+        return [*self.index_files(), *self.reads]
+
+    def outputs(self) -> List[str]:
+        if self.setting == BwaMem2Settings.create_index:
+            return self.index_files()
+        return [self.output_name] if self.output_name is not None else []
+
 
 class Samtools(Program):
     """Wrapper for samtools, as samtools has many functions this definition will intially be very simple
@@ -157,12 +292,57 @@ class Samtools(Program):
     """
 
     binary = "samtools"
-    def __init__(self, *args):
+    def __init__(self, *args, inputs: List[str] = None, outputs: List[str] = None, threads: int = 1, memory: int = 1, stdout: str = None):
         self.args = args
+        self.input_files = inputs or []
+        self.output_files = outputs or []
+        self.threads = threads
+        self.memory = memory
+        self.stdout = stdout
+        if stdout is not None:
+            self.output_files.append(stdout)
     
     def create_command(self) -> List[str]:
         return [self.binary, *self.args]
 
+    def inputs(self) -> List[str]:
+        return list(self.input_files)
+
+    def outputs(self) -> List[str]:
+        return list(self.output_files)
+
+class LiftOver(Program):
+    """Lift alignments on stdin onto a polished assembly with the liftover module, writing the read
+    pairs near edits to reads_out for realignment
+    """
+    binary = sys.executable
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "liftover.py")
+
+    def __init__(self, changes: str, assembly: str, affected: str, flank: int, reads_out: List[str], active: str = None):
+        self.changes = changes
+        self.assembly = assembly
+        self.affected = affected
+        self.flank = flank
+        self.reads_out = reads_out
+        self.active = active
+
+    def create_command(self) -> List[str]:
+        command = [self.binary, self.script, "--changes", self.changes, "--assembly", self.assembly, "--affected", self.affected,
+                   "--flank", str(self.flank), "--reads-out", *self.reads_out]
+        if self.active is not None:
+            command.extend(["--active", self.active])
+        return command
+
+    def inputs(self) -> List[str]:
+        inputs = [self.changes, self.assembly, self.affected]
+        if self.active is not None:
+            inputs.append(self.active)
+        return inputs
+
+    def outputs(self) -> List[str]:
+        return list(self.reads_out)
+
+
 class BCFTools(Program):
     """_summary_
 
@@ -177,12 +357,269 @@ class BCFTools(Program):
         return [self.binary, *self.args]
 
 
+@dataclass
+class ExecutionContext:
+    """State shared by every step executed in a run
+    """
+    cache: StepCache = None
+    scheduler: ResourceScheduler = None
+    instance: "ContainerInstance" = None
+    report: RunReport = None
+    iteration: int = None
+    engine: "WorkflowEngine" = None
+    cluster: "SlurmCluster" = None
+
+    def reserve(self, threads: int, memory: int):
+        """Hold the resources of a step when a scheduler is shared between workflows
+        """
+        if self.scheduler is None:
+            return nullcontext()
+        return self.scheduler.reserve(threads, memory)
+
+    def submit(self, *executors: "Executor", timeout: float = None, recoverable: Tuple[type, ...] = ()):
+        """Queue executors piped together as a step of the workflow graph, without a graph they are
+        run straight away and failures of the recoverable types are raised
+        """
+        if self.engine is not None:
+            self.engine.add(*executors, timeout=timeout)
+        elif len(executors) == 1:
+            executors[0].execute(recoverable)
+        else:
+            Pipeline(*executors).execute(recoverable)
+
+    def launched(self):
+        """Count a process started through the container instance, for its start up saving
+        """
+        if self.instance is not None:
+            self.instance.count_dispatch()
+
+    def flush(self, recoverable: Tuple[type, ...] = ()):
+        """Run every queued step, their outputs are complete once this returns. Failures of the
+        recoverable types are raised, any other failure exits
+        """
+        if self.engine is not None:
+            self.engine.run(recoverable)
+
+    def record(self, step: str, program: Program, started: float, wall_time: float = 0.0, rusage = None,
+               exit_code: int = 0, cached: bool = False):
+        """Add a step to the run report if one is being kept
+        """
+        if self.report is None:
+            return
+        self.report.add(StepRecord(step=step, command=" ".join(program.create_command()), iteration=self.iteration,
+                                   started=started, wall_time=wall_time,
+                                   user_time=rusage.ru_utime if rusage is not None else 0.0,
+                                   system_time=rusage.ru_stime if rusage is not None else 0.0,
+                                   max_rss_kb=rusage.ru_maxrss if rusage is not None else 0,
+                                   exit_code=exit_code, bytes_read=file_bytes(program.inputs()),
+                                   bytes_written=file_bytes(program.outputs()), cached=cached))
+
+
+def wait_with_rusage(proc: Popen):
+    """Reap a process with os.wait4 so its cpu time and peak memory are collected along with its exit code
+    """
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return rusage
+
+
+class StepFailure(Exception):
+    """A step exited non zero, timed out or could not be started, with the last lines of its stderr
+    """
+
+    def __init__(self, message: str, step: str = None, exit_code: int = None, stderr_tail: List[str] = None):
+        super().__init__(message)
+        self.step = step
+        self.exit_code = exit_code
+        self.stderr_tail = stderr_tail or []
+
+    def describe(self) -> str:
+        if not self.stderr_tail:
+            return str(self)
+        return f"{self}\nLast lines of {self.step} stderr:\n" + "\n".join(f"    {i}" for i in self.stderr_tail)
+
+
+class OutOfMemoryFailure(StepFailure):
+    """A step ran out of memory, a JVM OutOfMemoryError, an allocation failure or a kill by the
+    kernel or cluster out of memory killer
+    """
+
+
+OUT_OF_MEMORY_MARKERS = ["java.lang.OutOfMemoryError", "std::bad_alloc", "Cannot allocate memory", "Out of memory"]
+KILLED_EXIT_CODES = [-signal.SIGKILL, 128 + signal.SIGKILL]
+BROKEN_PIPE_EXIT_CODES = [-signal.SIGPIPE, 128 + signal.SIGPIPE]
+
+
+def failed_stage(exit_codes: List[int]) -> int:
+    """Index of the pipeline stage to blame for a failure, None when every stage succeeded. A stage
+    killed by SIGPIPE only lost the stage it was feeding, so it is passed over for a later failure
+    """
+    failed = [idx for idx, code in enumerate(exit_codes) if code != 0]
+    for idx in failed:
+        if exit_codes[idx] in BROKEN_PIPE_EXIT_CODES and idx != failed[-1]:
+            continue
+        return idx
+    return None
+
+
+def classify_failure(step: str, command: List[str], exit_code: int, stderr_tail: List[str], out_of_memory: bool = False) -> StepFailure:
+    """Typed failure for a step that exited non zero, a SIGKILL is taken to be the out of memory killer
+    """
+    out_of_memory = (out_of_memory or exit_code in KILLED_EXIT_CODES
+                     or any(marker in line for line in stderr_tail for marker in OUT_OF_MEMORY_MARKERS))
+    failure = OutOfMemoryFailure if out_of_memory else StepFailure
+    reason = "ran out of memory" if out_of_memory else f"exited with code {exit_code}"
+    return failure(f"{step} {reason}: {' '.join(command)}", step=step, exit_code=exit_code, stderr_tail=stderr_tail)
+
+
+def stop_on_failure(failure: StepFailure, recoverable: Tuple[type, ...] = ()):
+    """Raise failures the caller can recover from, report any other failure and exit
+    """
+    if isinstance(failure, recoverable):
+        raise failure
+    print(f"Workflow stopped: {failure.describe()}", flush=True)
+    sys.exit(-1)
+
+
+class StderrTail:
+    """Relay the stderr of a process to ours line by line, keeping its last lines for failure reports
+    """
+    keep_lines = 20
+
+    def __init__(self):
+        self.read_end, self.write_end = os.pipe()
+        self.tail = deque(maxlen=self.keep_lines)
+        self.thread = threading.Thread(target=self.relay, daemon=True)
+        self.thread.start()
+
+    def relay(self):
+        with open(self.read_end, "rb") as stream:
+            for line in stream:
+                text = line.decode(errors="replace")
+                sys.stderr.write(text)
+                sys.stderr.flush()
+                self.tail.append(text.rstrip())
+
+    def started(self):
+        """Close our copy of the write end once the process holds it, so the relay ends when the process exits
+        """
+        if self.write_end is not None:
+            os.close(self.write_end)
+            self.write_end = None
+
+    def lines(self) -> List[str]:
+        self.started()
+        self.thread.join()
+        return list(self.tail)
+
+
+class StageProcesses:
+    """Start executors with the stdout of each piped into the stdin of the next, then record and
+    check them once reaped. Pipelines, single executors and the workflow engine all start steps
+    through this so launching, reporting and failure blame are the same everywhere
+
+    With own_group the stages share a new process group the engine can terminate as a whole. A stage
+    that cannot be started kills and reaps the stages started before it and raises a StepFailure.
+    """
+
+    def __init__(self, executors: List["Executor"], own_group: bool = False):
+        self.executors = executors
+        self.context = executors[0].context
+        self.own_group = own_group
+        self.procs: List[Popen] = []
+        self.stderrs: List[StderrTail] = []
+        self.started = time.time()
+        self.start = time.perf_counter()
+        last_stdout = executors[-1].initialized.stdout
+        stdout = open(last_stdout, "wb") if last_stdout is not None else None
+        user_env = os.environ.copy()
+        upstream = None
+        try:
+            for idx, executor in enumerate(executors):
+                last_stage = idx == len(executors) - 1
+                read_end, write_end = (None, stdout) if last_stage else os.pipe()
+                self.stderrs.append(StderrTail())
+                group = dict(process_group=self.procs[0].pid if self.procs else 0) if own_group else {}
+                try:
+                    self.procs.append(Popen(executor.create_cmd(), env=user_env, stdin=upstream, stdout=write_end,
+                                            stderr=self.stderrs[-1].write_end, **group))
+                except OSError as error:
+                    if read_end is not None:
+                        os.close(read_end)
+                    self.abandon()
+                    raise StepFailure(f"{executor.program.__name__} could not be started: {error}", step=executor.program.__name__)
+                else:
+                    self.context.launched()
+                finally:
+                    self.stderrs[-1].started()
+                    if upstream is not None:
+                        os.close(upstream) # only the downstream process should hold the read end open
+                    if not last_stage:
+                        os.close(write_end)
+                upstream = read_end
+        finally:
+            if stdout is not None:
+                stdout.close()
+        print(f"Executing {self.names()}", flush=True)
+
+    def names(self) -> str:
+        return " | ".join(i.program.__name__ for i in self.executors)
+
+    def abandon(self):
+        """Kill and reap the stages already started when a later stage cannot be
+        """
+        for proc in self.procs:
+            proc.kill()
+            proc.wait()
+
+    def terminate(self):
+        """Terminate every stage, as one process group when they share one
+        """
+        if not self.procs:
+            return
+        try:
+            if self.own_group:
+                os.killpg(self.procs[0].pid, signal.SIGTERM)
+            else:
+                for proc in self.procs:
+                    proc.terminate()
+        except ProcessLookupError:
+            pass
+
+    def wait(self) -> StepFailure:
+        return self.finish([wait_with_rusage(i) for i in self.procs])
+
+    def finish(self, usage: list) -> StepFailure:
+        """Record every reaped stage in the run report, returning the failure of the stage to blame
+        if any stage failed
+        """
+        wall_time = time.perf_counter() - self.start
+        tails = [i.lines() for i in self.stderrs]
+        for executor, proc, rusage in zip(self.executors, self.procs, usage):
+            self.context.record(executor.program.__name__, executor.initialized, self.started, wall_time, rusage, proc.returncode)
+        failed = failed_stage([i.returncode for i in self.procs])
+        if failed is None:
+            return None
+        executor = self.executors[failed]
+        return classify_failure(executor.program.__name__, executor.create_cmd(), self.procs[failed].returncode, tails[failed])
+
+
 class ExecutorOptions(StrEnum):
     apptainer = "apptainer"
     singularity = "singularity"
     local = "local"
 
 
+@lru_cache(maxsize=None)
+def container_runtime() -> ExecutorOptions:
+    """Find apptainer or singularity in the user path, probed once per process
+    """
+    for runtime in (ExecutorOptions.apptainer, ExecutorOptions.singularity):
+        if shutil.which(runtime):
+            return runtime
+    return None
+
+
 class Executor:
     """Execute a given program based on passed args
 
@@ -192,12 +629,12 @@ class Executor:
     """
     __singularity_image_name = "HybridPolisher.sif" 
     __singularity_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), __singularity_image_name) #TODO clean this up with pathlib
-    __wait_time = 0
     __local_execution = True
     
-    def __init__(self, prog: Program, bind_mounts:str = None, *args, **kwargs):
+    def __init__(self, prog: Program, bind_mounts:str = None, *args, context: ExecutionContext = None, **kwargs):
         self.program = globals().get(prog) # TODO need to use AST module to create a StrEnum of all programs to use
         self.bind_mounts = bind_mounts
+        self.context = context if context is not None else ExecutionContext()
         if self.program is None:
             #TODO implement logging
             print(f"Program {prog} is not implemented.", flush=True)
@@ -216,37 +653,172 @@ class Executor:
             or if the binary for the file is in the path
         """
 
+        if self.context.instance is not None:
+            return self.context.instance.runtime
         if self.__local_execution:
             return ExecutorOptions.local
-        elif shutil.which(ExecutorOptions.apptainer):
-            return ExecutorOptions.apptainer
-        elif shutil.which(ExecutorOptions.singularity):
-            return ExecutorOptions.singularity
+        elif container_runtime() is not None:
+            return container_runtime()
         print("No valid executor specified")
         sys.exit(-1)
 
+    @classmethod
+    def container_image(cls) -> str:
+        return cls.__singularity_path
+
     def create_cmd(self):
         """Execute command in relation to whichever executor is too be used
         """
+        return self.wrap_cmd(self.initialized.create_command())
+
+    def wrap_cmd(self, command: List[str]):
+        """Wrap a command in whichever executor is too be used
+        """
+        if self.context.instance is not None:
+            return self.context.instance.wrap(command)
         # run apptainer
         executor = self.check_executor()
         if self.bind_mounts is not None and executor != ExecutorOptions.local:
-            return [executor.value, "run", "--bind", self.bind_mounts, self.__singularity_path, *self.initialized.create_command()]
+            return [executor.value, "run", "--bind", self.bind_mounts, self.__singularity_path, *command]
         elif executor == ExecutorOptions.local:
-            return [*self.initialized.create_command()]
+            return [*command]
         else:
             print(f"No bind mounts specified when executing singularity image, data will not be copied to and from container.", flush=True)
-            return [executor.value, "run", self.__singularity_path, *self.initialized.create_command()]
+            return [executor.value, "run", self.__singularity_path, *command]
+
+    def tool_version(self) -> str:
+        return tool_version(tuple(self.wrap_cmd(self.initialized.version_command())))
+
+    def cache_key(self) -> str:
+        return StepCache.key([self.initialized.create_command()], [self.tool_version()], self.initialized.inputs())
     
-    def execute(self):
-        """Execute passed commands
+    def execute(self, recoverable: Tuple[type, ...] = ()):
+        """Execute passed commands, skipping them if the step cache holds current outputs. A non zero
+        exit raises a failure of the recoverable types or exits
         """
-        user_env = os.environ.copy()
-        proc = Popen(self.create_cmd(), env=user_env)
-        print(f"Executing {self.program.__name__}", flush=True)
+        Pipeline(self).execute(recoverable)
+
+
+class ContainerInstance:
+    """A single long running container instance that every step of a workflow is executed in
+
+    Starting an instance once and dispatching each step with exec avoids paying container start up
+    for every tool call, the bind paths of every step must be known up front. The cost of a no-op
+    dispatch through the instance and through a fresh container run are measured at start up so
+    the saving can be reported when the instance is stopped.
+    """
+    instance_prefix = "pilonpolisher"
+
+    def __init__(self, bind_paths: List[str], image: str = None, runtime: ExecutorOptions = None):
+        self.runtime = runtime if runtime is not None else container_runtime()
+        self.image = image if image is not None else Executor.container_image()
+        self.bind_mounts = ",".join(sorted(set(bind_paths)))
+        self.name = f"{self.instance_prefix}_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+        self.dispatched = 0
+        self.__lock = threading.Lock()
+        self.instance_overhead = None
+        self.run_overhead = None
+        self.running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def wrap(self, command: List[str]) -> List[str]:
+        return [self.runtime.value, "exec", f"instance://{self.name}", *command]
+
+    def count_dispatch(self):
+        with self.__lock:
+            self.dispatched += 1
+
+    def timed_noop(self, command: List[str]) -> float:
+        start = time.perf_counter()
+        Popen(command, stdout=DEVNULL, stderr=DEVNULL).wait()
+        return time.perf_counter() - start
+
+    def start(self):
+        if self.runtime is None:
+            print("Neither apptainer nor singularity is in the path", flush=True)
+            sys.exit(-1)
+        if not os.path.isfile(self.image):
+            print(f"Container image {self.image} not found", flush=True)
+            sys.exit(-1)
+        proc = Popen([self.runtime.value, "instance", "start", "--bind", self.bind_mounts, self.image, self.name])
         proc.wait()
-        time.sleep(self.__wait_time) # added a wait as the next process may have been executed a bit too quick
-        
+        if proc.returncode != 0:
+            print(f"Could not start container instance {self.name}", flush=True)
+            sys.exit(-1)
+        self.running = True
+        self.instance_overhead = self.timed_noop([self.runtime.value, "exec", f"instance://{self.name}", "true"])
+        self.run_overhead = self.timed_noop([self.runtime.value, "exec", "--bind", self.bind_mounts, self.image, "true"])
+        print(f"Started container instance {self.name}, dispatch overhead per step {self.instance_overhead:.3f}s "
+              f"against {self.run_overhead:.3f}s for a new container", flush=True)
+
+    def stop(self):
+        if not self.running:
+            return
+        Popen([self.runtime.value, "instance", "stop", self.name], stdout=DEVNULL).wait()
+        self.running = False
+        saved = self.dispatched * (self.run_overhead - self.instance_overhead)
+        print(f"Stopped container instance {self.name} after {self.dispatched} dispatched commands, "
+              f"about {saved:.1f}s of container start up avoided", flush=True)
+
+
+class Pipeline:
+    """Chain the stdout of each executor into the stdin of the next through OS pipes
+
+    Every stage is started before any is waited on so data streams between them, once all stages
+    exit their return codes are checked and the failing stage is reported, passing over stages
+    killed by SIGPIPE when the stage they fed failed.
+    """
+
+    def __init__(self, *executors: Executor):
+        self.executors = executors
+        self.context = executors[0].context
+
+    def __repr__(self) -> str:
+        return " | ".join(" ".join(i.create_cmd()) for i in self.executors)
+
+    def outputs(self) -> List[str]:
+        return [j for i in self.executors for j in i.initialized.outputs()]
+
+    def requirements(self):
+        """Every stage runs at the same time so the pipeline needs the sum of their resources
+        """
+        needs = [i.initialized.requirements() for i in self.executors]
+        return sum(i[0] for i in needs), sum(i[1] for i in needs)
+
+    def cache_key(self) -> str:
+        return StepCache.key([i.initialized.create_command() for i in self.executors],
+                             [i.tool_version() for i in self.executors],
+                             [j for i in self.executors for j in i.initialized.inputs()])
+
+    def execute(self, recoverable: Tuple[type, ...] = ()):
+        """Start each stage with its stdin connected to the previous stages stdout
+        """
+        cache = self.context.cache
+        if cache is not None:
+            key = self.cache_key()
+            if cache.is_current(key, self.outputs()):
+                print(f"Skipping {' | '.join(i.program.__name__ for i in self.executors)}, cached outputs are current", flush=True)
+                for executor in self.executors:
+                    self.context.record(executor.program.__name__, executor.initialized, time.time(), cached=True)
+                return
+        with self.context.reserve(*self.requirements()):
+            try:
+                stages = StageProcesses(self.executors)
+            except StepFailure as failure:
+                stop_on_failure(failure, recoverable)
+            failure = stages.wait()
+        if failure is not None:
+            stop_on_failure(failure, recoverable)
+        if cache is not None:
+            cache.record(key, self.outputs())
+
 
 
 if __name__ == "__main__":